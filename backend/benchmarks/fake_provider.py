@@ -0,0 +1,239 @@
+"""
+Fake LLM provider for offline load tests.
+
+FakeProvider streams made-up completions with a configurable time to first
+token, tokens per second, error rate and rate of 429 (rate limited) answers.
+It is served two ways:
+
+    FakeBackend          an OpenAIBackend whose provider calls are answered in
+                         process, registered as AI_BACKEND=fake
+    fake OpenAI server   an OpenAI-compatible /v1/chat/completions endpoint, so
+                         the real backends (and their retries) can be pointed
+                         at it with OPENAI_API_BASE
+
+    python -m benchmarks.fake_provider --port 8001 --ttft 0.5 --tokens-per-second 40 --rate-limit-rate 0.05
+    OPENAI_API_BASE=http://127.0.0.1:8001/v1 OPENAI_API_KEY=sk-fake uvicorn main:app
+
+Both read their defaults from FAKE_LLM_TTFT_SECONDS, FAKE_LLM_TOKENS_PER_SECOND,
+FAKE_LLM_OUTPUT_TOKENS, FAKE_LLM_ERROR_RATE and FAKE_LLM_RATE_LIMIT_RATE.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from collections import namedtuple
+
+from aiohttp import web
+
+from llama.custom_type import OpenAIBackend
+
+SUCCESS = "success"
+ERROR = "error"
+RATE_LIMITED = "rate_limited"
+
+FakeProviderConfig = namedtuple("FakeProviderConfig", [
+    "ttft_seconds", "tokens_per_second", "output_tokens", "error_rate", "rate_limit_rate",
+], defaults=[0.5, 40.0, 64, 0.0, 0.0])
+
+
+def config_from_env():
+    defaults = FakeProviderConfig()
+    return FakeProviderConfig(
+        ttft_seconds=float(os.environ.get("FAKE_LLM_TTFT_SECONDS", defaults.ttft_seconds)),
+        tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", defaults.tokens_per_second)),
+        output_tokens=int(os.environ.get("FAKE_LLM_OUTPUT_TOKENS", defaults.output_tokens)),
+        error_rate=float(os.environ.get("FAKE_LLM_ERROR_RATE", defaults.error_rate)),
+        rate_limit_rate=float(os.environ.get("FAKE_LLM_RATE_LIMIT_RATE", defaults.rate_limit_rate)),
+    )
+
+
+class FakeProviderError(Exception):
+    pass
+
+
+class FakeRateLimited(FakeProviderError):
+    pass
+
+
+class FakeProvider:
+    def __init__(self, config=None, seed=None):
+        """
+        :param config: FakeProviderConfig, read from the FAKE_LLM_* variables if None
+        :param seed: seed of the injected failures, for reproducible runs
+        """
+        self.config = config or config_from_env()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {SUCCESS: 0, ERROR: 0, RATE_LIMITED: 0}
+
+    def outcome(self):
+        """
+        draws how the next request ends: SUCCESS, ERROR or RATE_LIMITED
+        """
+        with self._lock:
+            draw = self._random.random()
+            if draw < self.config.rate_limit_rate:
+                outcome = RATE_LIMITED
+            elif draw < self.config.rate_limit_rate + self.config.error_rate:
+                outcome = ERROR
+            else:
+                outcome = SUCCESS
+            self._counts[outcome] += 1
+            return outcome
+
+    def tokens(self, content):
+        """
+        :return: the deltas of the completion of content, the same for the same content
+        """
+        seed = sum(content.encode("utf-8")) % 997
+        return [f"word{(seed + i) % 997} " for i in range(self.config.output_tokens)]
+
+    def delays(self):
+        """
+        :return: seconds to wait before every token
+        """
+        return [self.config.ttft_seconds] + [1 / self.config.tokens_per_second] * (self.config.output_tokens - 1)
+
+    def stream(self, content):
+        """
+        :return: generator of (delta_content, finished), raising FakeRateLimited or FakeProviderError
+            before the first token of a failed request
+        """
+        outcome = self.outcome()
+        if outcome == RATE_LIMITED:
+            raise FakeRateLimited("rate limit reached")
+        for delay, token in zip(self.delays(), self.tokens(content)):
+            time.sleep(delay)
+            if outcome == ERROR:
+                raise FakeProviderError("the server had an error while processing your request")
+            yield token, False
+        yield "\n", True
+
+    async def astream(self, content):
+        """
+        like stream, without blocking the event loop
+        """
+        outcome = self.outcome()
+        if outcome == RATE_LIMITED:
+            raise FakeRateLimited("rate limit reached")
+        for delay, token in zip(self.delays(), self.tokens(content)):
+            await asyncio.sleep(delay)
+            if outcome == ERROR:
+                raise FakeProviderError("the server had an error while processing your request")
+            yield token, False
+        yield "\n", True
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, requests=sum(self._counts.values()))
+
+
+class FakeBackend(OpenAIBackend):
+    """
+    the GPT-4 pipeline (prompt budgets, caches, single flight) in front of a FakeProvider.
+    Failures are raised to the caller; there is no HTTP client to retry them.
+    """
+    model = "gpt-4"
+    backend_name = "fake"
+
+    def __init__(self, provider=None, **kwargs):
+        super().__init__(**kwargs)
+        self.provider = provider or FakeProvider()
+
+    def _stream_from_provider(self, system_prompt, content):
+        return self.provider.stream(content)
+
+    def _astream_from_provider(self, system_prompt, content):
+        return self.provider.astream(content)
+
+
+def completion_chunk(model, delta, finish_reason=None):
+    return {
+        "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def error_response(status, message, error_type, headers=None):
+    return web.json_response({"error": {"message": message, "type": error_type, "param": None, "code": None}},
+                             status=status, headers=headers)
+
+
+def make_app(provider):
+    """
+    :return: aiohttp application answering /v1/chat/completions like the OpenAI API
+    """
+    async def chat_completions(request):
+        body = await request.json()
+        content = body["messages"][-1]["content"]
+        outcome = provider.outcome()
+        if outcome == RATE_LIMITED:
+            return error_response(429, "Rate limit reached", "requests", headers={"Retry-After": "1"})
+        delays, tokens = provider.delays(), provider.tokens(content)
+        if outcome == ERROR:
+            await asyncio.sleep(delays[0])
+            return error_response(500, "The server had an error while processing your request", "server_error")
+
+        if not body.get("stream"):
+            await asyncio.sleep(sum(delays))
+            return web.json_response({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for delay, token in zip(delays, tokens):
+            await asyncio.sleep(delay)
+            await response.write(f"data: {json.dumps(completion_chunk(body['model'], {'content': token}))}\n\n".encode())
+        await response.write(f"data: {json.dumps(completion_chunk(body['model'], {}, 'stop'))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def stats(request):
+        return web.json_response(provider.stats())
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+async def start_server(provider, host="127.0.0.1", port=0):
+    """
+    :return: (aiohttp AppRunner to clean up, base url to use as OPENAI_API_BASE)
+    """
+    runner = web.AppRunner(make_app(provider))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}/v1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    defaults = config_from_env()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=defaults.ttft_seconds, help="seconds to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--output-tokens", type=int, default=defaults.output_tokens)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate,
+                        help="fraction answered with 429")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    provider = FakeProvider(FakeProviderConfig(args.ttft, args.tokens_per_second, args.output_tokens,
+                                               args.error_rate, args.rate_limit_rate), seed=args.seed)
+    web.run_app(make_app(provider), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+"""
+End-to-end load test of the API against a fake LLM provider.
+
+Starts main.app under uvicorn in its own process, with a local SQLite
+database (benchmarks.local_db) and a fake provider (benchmarks.fake_provider),
+optionally with summary workers, then drives concurrent /summary or /quiz SSE
+clients and book uploads and reports p50/p95/p99 time to first token, total
+latency, throughput and the CPU time of the server and worker processes.
+
+    python -m benchmarks.load_test --clients 64 --requests 4
+    python -m benchmarks.load_test --provider http --rate-limit-rate 0.05 --uploads 8 --workers 2
+    python -m benchmarks.load_test --output load.json --history load_history.jsonl
+
+--provider inprocess answers in the API process (AI_BACKEND=fake), --provider
+http runs the fake OpenAI server and points the real GPT-4 backend at it, so
+the HTTP client and its retries are measured too. Uploads and summary workers
+write under /home/swpp/readability_users like the deployed API, so they need
+that directory.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import timedelta
+
+import aiohttp
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# pickled trees and the backends reference top-level modules of backend/llama/
+sys.path.append(os.path.join(BACKEND_DIR, "llama"))
+
+from benchmarks.local_db import LocalDatabasePool, add_user, add_book
+from benchmarks.fake_provider import FakeBackend, FakeProvider, FakeProviderConfig, start_server
+from benchmarks.startup import git_revision
+
+USERS_ROOT = "/home/swpp/readability_users"
+DEFAULT_BOOK = os.path.join(BACKEND_DIR, "llama", "the_open_boat.txt")
+EMAIL = "load-test@example.com"
+USERNAME = "load-test"
+
+
+def percentile(values, q):
+    """
+    :param q: percentile between 0 and 100, linearly interpolated between the closest ranks
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(values):
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99),
+            "max": max(values) if values else None}
+
+
+def process_cpu_seconds(pid):
+    """
+    :return: user + system CPU seconds of a running process, read from /proc
+    """
+    with open(f"/proc/{pid}/stat") as stat_file:
+        # the command name may contain spaces, the fields after it do not
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(db_path, port):
+    """
+    runs main.app with the local database, in the process started by run_load_test
+    """
+    import uvicorn
+    from database import get_db_pool
+    from main import app
+
+    db_pool = LocalDatabasePool(db_path)
+    app.dependency_overrides[get_db_pool] = lambda: db_pool
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def work(db_path):
+    """
+    runs a summary worker with the local database
+    """
+    from llama.summary_jobs import get_summary_job_queue, run_worker
+    run_worker(get_summary_job_queue(), LocalDatabasePool(db_path), poll_interval=0.2)
+
+
+def seed(db_pool, workdir, book_path):
+    """
+    adds the load test user and its book, with a summary tree built by a zero latency fake provider
+    when the book is long enough to need one
+    :return: (access token, book id)
+    """
+    from routers.user import create_jwt_token
+    from llama.custom_type import ProxyAIBackend
+    from llama.content_store import store_book_content
+    from llama.preprocess_summary import generate_summary_tree
+
+    access_token = create_jwt_token({"sub": EMAIL}, timedelta(days=1))
+    add_user(db_pool, EMAIL, USERNAME, access_token)
+    with open(book_path) as book_file:
+        story = book_file.read()
+    content_url, _ = store_book_content(workdir, story)
+    # absolute, so the routers' os.path.join with the users root keeps it
+    book_id = add_book(db_pool, EMAIL, os.path.basename(book_path), os.path.join(workdir, content_url),
+                       num_total_inference=None)
+    instant = FakeProvider(FakeProviderConfig(ttft_seconds=0.0, tokens_per_second=1e9, output_tokens=32))
+    backend = FakeBackend(instant, response_cache=None, result_cache=None, single_flight=None)
+    generate_summary_tree(book_id, story, db_pool, proxy_ai_backend=ProxyAIBackend(backend), precompute_results=False)
+    return access_token, book_id
+
+
+def server_env(args, workdir, api_base=None):
+    env = dict(os.environ)
+    env.update({
+        "SUMMARY_JOB_DB": os.path.join(workdir, "summary_jobs.sqlite3"),
+        "PREFETCH_ENABLED": "0",
+        "LLM_RESPONSE_CACHE_DIR": os.path.join(workdir, "llm_cache"),
+        "LLM_RESULT_CACHE_DIR": os.path.join(workdir, "result_cache"),
+        "LLM_RESPONSE_CACHE_MODE": "read_write" if args.caches else "off",
+        "LLM_RESULT_CACHE_MODE": "read_write" if args.caches else "off",
+    })
+    if api_base is None:
+        env.update({
+            "AI_BACKEND": "fake",
+            "FAKE_LLM_TTFT_SECONDS": str(args.ttft),
+            "FAKE_LLM_TOKENS_PER_SECOND": str(args.tokens_per_second),
+            "FAKE_LLM_OUTPUT_TOKENS": str(args.output_tokens),
+            "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+            "FAKE_LLM_RATE_LIMIT_RATE": str(args.rate_limit_rate),
+        })
+    else:
+        env.update({"AI_BACKEND": "gpt-4", "OPENAI_API_BASE": api_base, "OPENAI_API_KEY": "sk-fake"})
+    return env
+
+
+def spawn(command, env):
+    return subprocess.Popen([sys.executable, "-m", "benchmarks.load_test", *command], cwd=BACKEND_DIR, env=env)
+
+
+async def wait_until_up(base_url, server, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"the API exited with {server.returncode}")
+            try:
+                async with session.get(f"{base_url}/metrics/db_pool") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"the API did not start within {timeout}s")
+
+
+async def read_sse(session, url, params):
+    """
+    :return: dict of ok, ttft, seconds and tokens of one streamed answer
+    """
+    started = time.perf_counter()
+    ttft = None
+    tokens = 0
+    try:
+        async with session.get(url, params=params) as response:
+            if response.status != 200:
+                await response.read()
+                return {"ok": False, "status": response.status, "ttft": None,
+                        "seconds": time.perf_counter() - started, "tokens": 0}
+            async for line in response.content:
+                if line.startswith(b"data:") and line[5:].strip():
+                    tokens += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+    except aiohttp.ClientError as e:
+        return {"ok": False, "status": repr(e), "ttft": ttft, "seconds": time.perf_counter() - started,
+                "tokens": tokens}
+    # a provider failure ends the stream without any token
+    return {"ok": tokens > 0, "status": 200, "ttft": ttft, "seconds": time.perf_counter() - started,
+            "tokens": tokens}
+
+
+async def run_clients(base_url, args, access_token, book_id):
+    """
+    :return: (results of read_sse, seconds until the last client finished)
+    """
+    async def client(index, session):
+        results = []
+        for request in range(args.requests):
+            # spread the readers over the book, so result caching does not answer every request
+            progress = ((index * args.requests + request) % 97 + 1) / 100 if args.spread else args.progress
+            params = {"book_id": book_id, "progress": progress, "access_token": access_token}
+            results.append(await read_sse(session, f"{base_url}/{args.endpoint}", params))
+        return results
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=args.timeout)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        per_client = await asyncio.gather(*[client(index, session) for index in range(args.clients)])
+    return [result for results in per_client for result in results], time.perf_counter() - started
+
+
+async def run_uploads(base_url, args, access_token, db_pool):
+    """
+    uploads distinct copies of the book and waits for their summary trees
+    :return: (upload latencies, seconds until every tree was finished or None without workers)
+    """
+    with open(args.book) as book_file:
+        story = book_file.read()
+    started = time.perf_counter()
+
+    async def upload(session, index):
+        request_started = time.perf_counter()
+        body = {"title": f"load test upload {index}", "content": f"Upload {index}.\n\n{story}", "cover_image": ""}
+        async with session.post(f"{base_url}/book/add", params={"access_token": access_token}, json=body) as response:
+            await response.read()
+            response.raise_for_status()
+        return time.perf_counter() - request_started
+
+    async with aiohttp.ClientSession() as session:
+        latencies = await asyncio.gather(*[upload(session, index) for index in range(args.uploads)])
+    if not args.workers:
+        return latencies, None
+
+    from llama.summary_jobs import SummaryJobQueue, ACTIVE_STATUSES
+    job_queue = SummaryJobQueue(os.path.join(args.workdir, "summary_jobs.sqlite3"))
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute("SELECT id FROM Books WHERE title LIKE 'load test upload %'")
+        book_ids = [row[0] for row in cursor.fetchall()]
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline:
+        statuses = [job_queue.status(book_id) for book_id in book_ids]
+        if all(status is not None and status["status"] not in ACTIVE_STATUSES for status in statuses):
+            return latencies, time.perf_counter() - started
+        await asyncio.sleep(0.2)
+    return latencies, None
+
+
+def report(results, clients_seconds, upload_latencies, trees_seconds, elapsed, cpu_seconds, args):
+    """
+    :param clients_seconds: duration of the SSE clients, the throughput is measured over it
+    :param elapsed: duration of the whole test, including summary trees, the CPU use is measured over it
+    """
+    succeeded = [result for result in results if result["ok"]]
+    return {
+        "endpoint": args.endpoint,
+        "provider": args.provider,
+        "clients": args.clients,
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "elapsed_seconds": elapsed,
+        "ttft_seconds": summarize([result["ttft"] for result in succeeded]),
+        "latency_seconds": summarize([result["seconds"] for result in succeeded]),
+        "requests_per_second": len(succeeded) / clients_seconds,
+        "tokens_per_second": sum(result["tokens"] for result in succeeded) / clients_seconds,
+        "uploads": len(upload_latencies),
+        "upload_seconds": summarize(upload_latencies),
+        "summary_trees_seconds": trees_seconds,
+        "cpu_seconds": cpu_seconds,
+        "cpu_percent": {name: seconds / elapsed * 100 for name, seconds in cpu_seconds.items()},
+    }
+
+
+async def run_load_test(args):
+    """
+    :return: report of one load test, see report
+    """
+    if args.uploads and not os.path.isdir(USERS_ROOT):
+        raise SystemExit(f"uploads write under {USERS_ROOT}, which does not exist")
+    db_path = os.path.join(args.workdir, "readability.sqlite3")
+    db_pool = LocalDatabasePool(db_path)
+    access_token, book_id = seed(db_pool, args.workdir, args.book)
+
+    fake_server = None
+    api_base = None
+    if args.provider == "http":
+        provider = FakeProvider(FakeProviderConfig(args.ttft, args.tokens_per_second, args.output_tokens,
+                                                   args.error_rate, args.rate_limit_rate), seed=args.seed)
+        fake_server, api_base = await start_server(provider)
+    env = server_env(args, args.workdir, api_base)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    processes = {"server": spawn(["serve", "--db", db_path, "--port", str(port)], env)}
+    for worker in range(args.workers):
+        processes[f"worker{worker}"] = spawn(["work", "--db", db_path], env)
+    try:
+        await wait_until_up(base_url, processes["server"])
+        cpu_before = {name: process_cpu_seconds(process.pid) for name, process in processes.items()}
+        started = time.perf_counter()
+        (results, clients_seconds), (upload_latencies, trees_seconds) = await asyncio.gather(
+            run_clients(base_url, args, access_token, book_id),
+            run_uploads(base_url, args, access_token, db_pool))
+        elapsed = time.perf_counter() - started
+        cpu_seconds = {name: process_cpu_seconds(process.pid) - cpu_before[name]
+                       for name, process in processes.items()}
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+        if fake_server is not None:
+            await fake_server.cleanup()
+    return report(results, clients_seconds, upload_latencies, trees_seconds, elapsed, cpu_seconds, args)
+
+
+def format_report(result):
+    def line(name, summary):
+        if summary["p50"] is None:
+            return f"{name:<16} -"
+        return (f"{name:<16} p50 {summary['p50'] * 1000:8.1f} ms  p95 {summary['p95'] * 1000:8.1f} ms  "
+                f"p99 {summary['p99'] * 1000:8.1f} ms")
+
+    lines = [
+        f"{result['requests']} {result['endpoint']} requests from {result['clients']} clients "
+        f"({result['provider']} provider), {result['errors']} errors, {result['elapsed_seconds']:.1f} s",
+        line("ttft", result["ttft_seconds"]),
+        line("latency", result["latency_seconds"]),
+        f"{'throughput':<16} {result['requests_per_second']:.1f} requests/s, {result['tokens_per_second']:.1f} tokens/s",
+    ]
+    if result["uploads"]:
+        lines.append(line("upload", result["upload_seconds"]))
+        if result["summary_trees_seconds"] is not None:
+            lines.append(f"{'summary trees':<16} {result['summary_trees_seconds']:.1f} s")
+    lines += [f"{'cpu ' + name:<16} {seconds:.2f} s ({result['cpu_percent'][name]:.0f}%)"
+              for name, seconds in result["cpu_seconds"].items()]
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help=argparse.SUPPRESS)
+    serve_parser.add_argument("--db", required=True)
+    serve_parser.add_argument("--port", type=int, required=True)
+    work_parser = subparsers.add_parser("work", help=argparse.SUPPRESS)
+    work_parser.add_argument("--db", required=True)
+
+    parser.add_argument("--endpoint", choices=("summary", "quiz"), default="summary")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent SSE clients")
+    parser.add_argument("--requests", type=int, default=4, help="requests per client, one after another")
+    parser.add_argument("--progress", type=float, default=0.5, help="reading progress of every request")
+    parser.add_argument("--spread", action="store_true", help="spread the requests over the whole book instead")
+    parser.add_argument("--uploads", type=int, default=0, help="books uploaded while the clients read")
+    parser.add_argument("--workers", type=int, default=0, help="summary worker processes")
+    parser.add_argument("--book", default=DEFAULT_BOOK)
+    parser.add_argument("--caches", action="store_true", help="keep the response and result caches on")
+    parser.add_argument("--provider", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds to the first token of the provider")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0)
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for a token or the trees")
+    parser.add_argument("--workdir", help="directory of the database and book, a temporary one by default")
+    parser.add_argument("--output", help="JSON file the report is written to")
+    parser.add_argument("--history", help="JSON lines file the report is appended to")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "serve":
+        return serve(args.db, args.port)
+    if args.command == "work":
+        return work(args.db)
+
+    with tempfile.TemporaryDirectory(prefix="load_test_") as tmp_dir:
+        args.workdir = args.workdir or tmp_dir
+        result = asyncio.run(run_load_test(args))
+    print(format_report(result))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+    if args.history:
+        with open(args.history, "a") as history_file:
+            history_file.write(json.dumps({"time": time.time(), "revision": git_revision(), "result": result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
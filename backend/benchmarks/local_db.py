@@ -0,0 +1,116 @@
+"""
+SQLite stand-in for the MySQL pool of database.py, so the API and the summary
+workers can run offline, e.g. under benchmarks.load_test.
+
+It has the Users and Books columns the routers read by position and accepts
+their queries, translating the %s placeholders of mysql.connector.
+"""
+import time
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Users (
+    email TEXT PRIMARY KEY,
+    password TEXT,
+    username TEXT,
+    created_at TEXT,
+    verified INTEGER,
+    refresh_token TEXT,
+    access_token TEXT
+);
+CREATE TABLE IF NOT EXISTS Books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT,
+    title TEXT,
+    author TEXT,
+    progress REAL,
+    cover_image TEXT,
+    content TEXT,
+    summary_tree TEXT,
+    num_total_inference INTEGER,
+    num_current_inference INTEGER
+);
+"""
+
+
+class LocalCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        return self._cursor.execute(query.replace("%s", "?"), params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+
+class LocalConnection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self):
+        return LocalCursor(self._connection.cursor())
+
+    def commit(self):
+        self._connection.commit()
+
+
+class LocalDatabasePool:
+    """
+    same interface as database.DatabasePool, with one SQLite connection per checkout
+    """
+    def __init__(self, path, busy_timeout=30.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._metrics_lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+        with closing(sqlite3.connect(path, timeout=busy_timeout)) as conn:
+            # the API and the workers write from separate processes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connection(self):
+        with self._metrics_lock:
+            self._checkouts += 1
+            self._in_use += 1
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+        try:
+            yield LocalConnection(conn)
+        finally:
+            conn.close()
+            with self._metrics_lock:
+                self._in_use -= 1
+
+    def metrics(self):
+        with self._metrics_lock:
+            return {"pool_size": None, "in_use": self._in_use, "checkouts": self._checkouts}
+
+
+def add_user(db_pool, email, username, access_token):
+    with db_pool.connection() as users_db:
+        cursor = users_db.cursor()
+        cursor.execute("INSERT OR REPLACE INTO Users (email, username, created_at, verified, access_token) "
+                       "VALUES (%s, %s, %s, 1, %s)", (email, username, time.strftime("%Y-%m-%d %H:%M:%S"), access_token))
+        users_db.commit()
+
+
+def add_book(db_pool, email, title, content_url, summary_tree_url=None, num_total_inference=1):
+    """
+    :return: id of the new book
+    """
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(
+            "INSERT INTO Books (email, title, author, progress, cover_image, content, summary_tree, "
+            "num_total_inference, num_current_inference) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+            (email, title, None, 0.0, None, content_url, summary_tree_url, num_total_inference, num_total_inference))
+        books_db.commit()
+        return cursor.lastrowid
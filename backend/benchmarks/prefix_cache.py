@@ -0,0 +1,138 @@
+"""
+Prefill time of the intermediate summary prompt on CPU, with the past
+key/values of PROMPT_TEMPLATE_INTERMEDIATE_FRONT computed once and reused
+(llama.generation_engine.PrefixCache) against prefilling the whole prompt.
+
+    python -m benchmarks.prefix_cache
+    python -m benchmarks.prefix_cache --layers 4 --hidden 256 --batch-size 4 --repeat 10 --history prefix_history.jsonl
+
+A randomly initialised LLaMA of the given size stands in for the real model
+and the prompts are tokenized one byte per token, so the numbers compare the
+two prefills rather than predict the latency of LLaMA-2-7B.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import torch
+from transformers import BatchEncoding, LlamaConfig, LlamaForCausalLM
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llama"))
+from llama.constants import PROMPT_TEMPLATE_INTERMEDIATE_FRONT, PROMPT_TEMPLATE_INTERMEDIATE_BACK
+from llama.generation_engine import PrefixCache, prefill
+from benchmarks.startup import git_revision
+
+PAD, BOS, EOS = 0, 1, 2
+
+
+class ByteTokenizer:
+    """
+    one token per utf-8 byte, bos first
+    """
+    pad_token_id = PAD
+    eos_token_id = EOS
+
+    def __call__(self, prompts, return_tensors="pt", padding=True, add_special_tokens=True):
+        rows = [([BOS] if add_special_tokens else []) + [3 + byte for byte in prompt.encode()] for prompt in prompts]
+        width = max(len(row) for row in rows)
+        return BatchEncoding({
+            "input_ids": torch.tensor([[PAD] * (width - len(row)) + row for row in rows]),
+            "attention_mask": torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in rows]),
+        })
+
+
+def make_model(layers, hidden):
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=259, hidden_size=hidden, intermediate_size=hidden * 4 // 3 * 2,
+                         num_hidden_layers=layers, num_attention_heads=max(hidden // 64, 1),
+                         max_position_embeddings=4096, pad_token_id=PAD, bos_token_id=BOS, eos_token_id=EOS)
+    return LlamaForCausalLM(config).eval()
+
+
+def make_suffixes(batch_size, words):
+    return [" ".join(f"word{i + row}" for i in range(words + row * 7)) + PROMPT_TEMPLATE_INTERMEDIATE_BACK
+            for row in range(batch_size)]
+
+
+def timed(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - started)
+    return statistics.median(seconds), result
+
+
+def benchmark(layers=2, hidden=256, batch_size=4, words=200, repeat=5):
+    """
+    :return: median prefill seconds without and with the cached prefix, and the largest difference
+             of the next token logits between the two
+    """
+    model = make_model(layers, hidden)
+    tokenizer = ByteTokenizer()
+    suffixes = make_suffixes(batch_size, words)
+
+    def uncached():
+        inputs = tokenizer([PROMPT_TEMPLATE_INTERMEDIATE_FRONT + suffix for suffix in suffixes])
+        position_ids = inputs.attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(inputs.attention_mask == 0, 1)
+        with torch.no_grad():
+            return model(**inputs, position_ids=position_ids, use_cache=True).logits[:, -1]
+
+    prefix_cache = PrefixCache(model, tokenizer)
+    prefix_ids, _ = prefix_cache.get(PROMPT_TEMPLATE_INTERMEDIATE_FRONT)
+
+    def cached():
+        prefix_ids, prefix_past = prefix_cache.get(PROMPT_TEMPLATE_INTERMEDIATE_FRONT)
+        inputs = tokenizer(suffixes, add_special_tokens=False)
+        input_ids, attention_mask, past_key_values = prefill(
+            model, prefix_ids, prefix_past, inputs.input_ids, inputs.attention_mask)
+        # the last token, as generate feeds it
+        position_ids = attention_mask.cumsum(-1)[:, -1:] - 1
+        with torch.no_grad():
+            return model(input_ids=input_ids[:, -1:], attention_mask=attention_mask, position_ids=position_ids,
+                         past_key_values=past_key_values, use_cache=True).logits[:, -1]
+
+    uncached(), cached()
+    uncached_seconds, uncached_logits = timed(uncached, repeat)
+    cached_seconds, cached_logits = timed(cached, repeat)
+    return {
+        "layers": layers,
+        "hidden": hidden,
+        "batch_size": batch_size,
+        "prefix_tokens": prefix_ids.shape[1],
+        "suffix_tokens": max(len(suffix.encode()) for suffix in suffixes),
+        "repeat": repeat,
+        "uncached_seconds": uncached_seconds,
+        "cached_seconds": cached_seconds,
+        "speedup": uncached_seconds / cached_seconds,
+        "max_logit_difference": (uncached_logits - cached_logits).abs().max().item(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--hidden", type=int, default=256)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--words", type=int, default=200, help="words of the shortest text after the template")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--history", help="JSON lines file the results are appended to")
+    args = parser.parse_args(argv)
+
+    result = benchmark(args.layers, args.hidden, args.batch_size, args.words, args.repeat)
+    print(f"prefix {result['prefix_tokens']} tokens, suffix up to {result['suffix_tokens']} tokens, "
+          f"batch {result['batch_size']}")
+    print(f"without cache {result['uncached_seconds'] * 1000:8.1f} ms")
+    print(f"with cache    {result['cached_seconds'] * 1000:8.1f} ms  ({result['speedup']:.2f}x, "
+          f"max logit difference {result['max_logit_difference']:.2e})")
+    if args.history:
+        with open(args.history, "a") as history_file:
+            history_file.write(json.dumps({"time": time.time(), "revision": git_revision(), "result": result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
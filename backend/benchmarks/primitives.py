@@ -0,0 +1,265 @@
+"""
+Micro-benchmarks of the chunking and summary tree primitives over synthetic
+books of 10k to 5M tokens and trees of 10 to 10k leaves:
+
+    split_large_text, split_list, get_number_of_inferences,
+    Summary.find_leaf_summary, Summary.find_included_summaries
+
+    python -m benchmarks.primitives --save-baseline benchmarks/primitives_baseline.json
+    python -m benchmarks.primitives --check benchmarks/primitives_baseline.json --threshold 1.5
+    python -m benchmarks.primitives --quick --check benchmarks/primitives_baseline.json
+
+Every case reports the median seconds per call. Besides comparing every case
+with the baseline, the check fits how each primitive scales with its input
+(the slope of log time over log size). That exponent does not depend on the
+machine, so a linear primitive turning quadratic fails the check even where
+absolute times are not comparable with the baseline.
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import statistics
+from collections import namedtuple
+from contextlib import redirect_stdout
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# preprocess_summary imports custom_type as a top-level module
+sys.path.append(os.path.join(BACKEND_DIR, "llama"))
+
+from llama.custom_type import Summary
+from llama.preprocess_summary import split_large_text, split_list, get_number_of_inferences, tokenizer
+from benchmarks.startup import git_revision
+
+BOOK_TOKENS = (10_000, 100_000, 1_000_000, 5_000_000)
+TREE_LEAVES = (10, 100, 1_000, 10_000)
+QUICK_BOOK_TOKENS = (10_000, 100_000)
+QUICK_TREE_LEAVES = (10, 100, 1_000)
+# lookups per measurement of the tree queries
+QUERIES = 1_000
+LEAF_TOKENS = 3_900
+DEFAULT_THRESHOLD = 1.5
+DEFAULT_MAX_EXPONENT_INCREASE = 0.3
+
+Case = namedtuple("Case", ["primitive", "size", "run", "calls"])
+
+
+def make_book(num_tokens, seed=0):
+    """
+    :return: text of about num_tokens tokens, made of the words of a bundled story in random order
+    """
+    with open(os.path.join(BACKEND_DIR, "llama", "the_open_boat.txt")) as story_file:
+        words = story_file.read().split()
+    rng = random.Random(seed)
+    sample = " ".join(rng.choices(words, k=10_000))
+    tokens_per_word = len(tokenizer.encode(sample)) / 10_000
+    return " ".join(rng.choices(words, k=int(num_tokens / tokens_per_word)))
+
+
+def make_tree(num_leaves, leaf_tokens=LEAF_TOKENS):
+    """
+    :return: (root, leaves) of a Summary tree reduced like preprocess_summary reduces one
+    """
+    leaves = [Summary(start_idx=i * leaf_tokens, end_idx=(i + 1) * leaf_tokens - 1,
+                      summary_content=f"leaf {i}", children=[]) for i in range(num_leaves)]
+    level = leaves
+    while len(level) > 1:
+        next_level = []
+        for children in split_list(level):
+            parent = Summary(start_idx=children[0].start_idx, end_idx=children[-1].end_idx,
+                             summary_content="reduced", children=children)
+            for child in children:
+                child.parent = parent
+            next_level.append(parent)
+        level = next_level
+    return level[0], leaves
+
+
+def make_cases(book_tokens=BOOK_TOKENS, tree_leaves=TREE_LEAVES):
+    cases = []
+    for num_tokens in book_tokens:
+        book = make_book(num_tokens)
+
+        def run_split_large_text(book=book):
+            # split_large_text prints every slice
+            with redirect_stdout(io.StringIO()):
+                split_large_text(book)
+
+        cases.append(Case("split_large_text", num_tokens, run_split_large_text, 1))
+
+    for num_leaves in tree_leaves:
+        items = list(range(num_leaves))
+        cases.append(Case("split_list", num_leaves, lambda items=items: split_list(items), 1))
+        cases.append(Case("get_number_of_inferences", num_leaves,
+                          lambda num_leaves=num_leaves: get_number_of_inferences(num_leaves), 1))
+
+        root, leaves = make_tree(num_leaves)
+        rng = random.Random(num_leaves)
+        word_indices = [rng.randrange(num_leaves * LEAF_TOKENS) for _ in range(QUERIES)]
+        query_leaves = [rng.choice(leaves) for _ in range(QUERIES)]
+
+        def find_leaf_summaries(root=root, word_indices=word_indices):
+            for word_index in word_indices:
+                root.find_leaf_summary(word_index)
+
+        def find_included_summaries(root=root, query_leaves=query_leaves):
+            for leaf in query_leaves:
+                root.find_included_summaries(leaf)
+
+        cases.append(Case("Summary.find_leaf_summary", num_leaves, find_leaf_summaries, QUERIES))
+        cases.append(Case("Summary.find_included_summaries", num_leaves, find_included_summaries, QUERIES))
+    return cases
+
+
+def timed_loops(run, loops):
+    started = time.perf_counter()
+    for _ in range(loops):
+        run()
+    return (time.perf_counter() - started) / loops
+
+
+def measure(run, calls, min_seconds=0.2, max_repeat=50, min_run_seconds=0.001):
+    """
+    times run until min_seconds passed, looping fast runs so every timing lasts min_run_seconds
+    :param calls: calls of the primitive in one run
+    :return: (median seconds per call, number of runs)
+    """
+    loops = 1
+    seconds = [timed_loops(run, loops)]
+    while seconds[-1] * loops < min_run_seconds:
+        loops *= 10
+        seconds = [timed_loops(run, loops)]
+    while sum(seconds) * loops < min_seconds and len(seconds) < max_repeat:
+        seconds.append(timed_loops(run, loops))
+    return statistics.median(seconds) / calls, len(seconds) * loops
+
+
+def scaling_exponent(points):
+    """
+    :param points: (size, seconds) of one primitive
+    :return: least squares slope of log seconds over log size, None with fewer than two sizes
+    """
+    points = [(math.log(size), math.log(max(seconds, 1e-12))) for size, seconds in points]
+    if len(points) < 2:
+        return None
+    mean_x = statistics.fmean(x for x, _ in points)
+    mean_y = statistics.fmean(y for _, y in points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def case_name(primitive, size):
+    return f"{primitive}[{size}]"
+
+
+def run_suite(book_tokens=BOOK_TOKENS, tree_leaves=TREE_LEAVES, min_seconds=0.2):
+    """
+    :return: dict of the seconds per call of every case and the scaling exponent of every primitive
+    """
+    results = {}
+    points = {}
+    for case in make_cases(book_tokens, tree_leaves):
+        seconds, runs = measure(case.run, case.calls, min_seconds)
+        results[case_name(case.primitive, case.size)] = {
+            "primitive": case.primitive, "size": case.size, "seconds": seconds, "runs": runs,
+        }
+        points.setdefault(case.primitive, []).append((case.size, seconds))
+    return {
+        "time": time.time(),
+        "revision": git_revision(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "processor": platform.processor() or platform.machine()},
+        "results": results,
+        "exponents": {primitive: scaling_exponent(primitive_points) for primitive, primitive_points in points.items()},
+    }
+
+
+def check(current, baseline, threshold=DEFAULT_THRESHOLD, max_exponent_increase=DEFAULT_MAX_EXPONENT_INCREASE):
+    """
+    compares a run with a baseline, on the cases and primitives both have
+    :param threshold: a case fails when it is this many times slower than the baseline
+    :param max_exponent_increase: a primitive fails when its scaling exponent grew by more
+    :return: list of failure messages, empty when there is no regression
+    """
+    failures = []
+    for name, result in current["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None:
+            continue
+        ratio = result["seconds"] / max(baseline_result["seconds"], 1e-12)
+        if ratio > threshold:
+            failures.append(f"{name} took {result['seconds']:.3g} s, {ratio:.2f}x the baseline "
+                            f"{baseline_result['seconds']:.3g} s")
+    for primitive, exponent in current["exponents"].items():
+        baseline_exponent = baseline["exponents"].get(primitive)
+        if exponent is None or baseline_exponent is None:
+            continue
+        if exponent - baseline_exponent > max_exponent_increase:
+            failures.append(f"{primitive} scales as size^{exponent:.2f}, the baseline as size^{baseline_exponent:.2f}")
+    return failures
+
+
+def restrict(baseline, current):
+    """
+    :return: the baseline with its exponents refitted on the sizes of current, e.g. a --quick run
+    """
+    points = {}
+    for name, result in baseline["results"].items():
+        if name in current["results"]:
+            points.setdefault(result["primitive"], []).append((result["size"], result["seconds"]))
+    return dict(baseline, exponents={primitive: scaling_exponent(primitive_points)
+                                     for primitive, primitive_points in points.items()})
+
+
+def format_results(current, baseline=None):
+    lines = []
+    for name, result in sorted(current["results"].items(), key=lambda item: (item[1]["primitive"], item[1]["size"])):
+        line = f"{name:<44} {result['seconds'] * 1e6:14.1f} us"
+        if baseline is not None and name in baseline["results"]:
+            line += f"  {result['seconds'] / max(baseline['results'][name]['seconds'], 1e-12):6.2f}x baseline"
+        lines.append(line)
+    for primitive, exponent in current["exponents"].items():
+        if exponent is not None:
+            lines.append(f"{primitive:<44} scales as size^{exponent:.2f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="books up to 100k tokens and trees up to 1k leaves")
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="measuring time of every case")
+    parser.add_argument("--save-baseline", help="JSON file the results are written to")
+    parser.add_argument("--check", help="JSON baseline to compare with, exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="slowdown of a case over the baseline that fails the check")
+    parser.add_argument("--max-exponent-increase", type=float, default=DEFAULT_MAX_EXPONENT_INCREASE,
+                        help="growth of a scaling exponent over the baseline that fails the check")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        current = run_suite(QUICK_BOOK_TOKENS, QUICK_TREE_LEAVES, args.min_seconds)
+    else:
+        current = run_suite(min_seconds=args.min_seconds)
+    baseline = None
+    if args.check:
+        with open(args.check) as baseline_file:
+            baseline = restrict(json.load(baseline_file), current)
+    print(format_results(current, baseline))
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(current, baseline_file, indent=2)
+    if baseline is not None:
+        failures = check(current, baseline, args.threshold, args.max_exponent_increase)
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+LLM calls, wall time and tokens of building a summary tree with every
+reduction fan-out, on the sample texts of llama/ repeated to book length:
+
+    python -m benchmarks.reduction_fan_out
+    python -m benchmarks.reduction_fan_out --book-tokens 500000 --fan-outs 2,4,8,budget --ttft 0.5
+    python -m benchmarks.reduction_fan_out --quick --history fan_out_history.jsonl
+
+Summaries come from the fake provider of benchmarks.fake_provider with the
+GPT-4 budgets, answering output_tokens words after the time to first token,
+so wall time shows the number of calls on the critical path of the tree
+rather than the speed of a real model. Prompt tokens include the system prompt
+of every call. Every build checks its calls against get_number_of_inferences.
+"""
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+from contextlib import redirect_stdout
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# preprocess_summary imports custom_type as a top-level module
+sys.path.append(os.path.join(BACKEND_DIR, "llama"))
+
+from llama.custom_type import ProxyAIBackend
+from llama.boundary_index import BoundaryIndex
+from llama.chunking import get_number_of_slices
+from llama.progress_tracker import progress_tracker
+from llama.prompt_builder import prompt_tokens
+from llama.preprocess_summary import (
+    BOOK_CONCURRENCY, BUDGET_FAN_OUT, SummaryTreeScheduler, get_fan_out, get_number_of_inferences,
+    iter_slices, tokenizer,
+)
+from benchmarks.fake_provider import FakeBackend, FakeProvider, FakeProviderConfig
+from benchmarks.startup import git_revision
+
+SAMPLE_TEXTS = ("the_open_boat.txt", "the_lottery.txt", "medium.txt")
+DEFAULT_FAN_OUTS = "2,3,4,8," + BUDGET_FAN_OUT
+DEFAULT_BOOK_TOKENS = 100_000
+QUICK_BOOK_TOKENS = 20_000
+
+
+class CountingBackend(FakeBackend):
+    """
+    FakeBackend counting the calls, prompt tokens and output tokens of its requests
+    """
+    def __init__(self, provider):
+        super().__init__(provider, response_cache=None, result_cache=None, single_flight=None)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def stream_completion(self, system_prompt, content):
+        num_prompt_tokens = prompt_tokens(system_prompt, len(tokenizer.encode(content)))
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += num_prompt_tokens
+        response = ""
+        for delta_content, finished in super().stream_completion(system_prompt, content):
+            if not finished:
+                response += delta_content
+            yield delta_content, finished
+        with self._lock:
+            self.output_tokens += len(tokenizer.encode(response))
+
+
+def make_book(sample_text, book_tokens):
+    """
+    :return: the sample text repeated to about book_tokens tokens, one copy per chapter
+    """
+    with open(os.path.join(BACKEND_DIR, "llama", sample_text)) as sample_file:
+        sample = sample_file.read().strip()
+    copies = max(math.ceil(book_tokens / len(tokenizer.encode(sample))), 1)
+    return "\n\n".join(f"CHAPTER {i + 1}\n\n{sample}" for i in range(copies))
+
+
+def tree_depth(summary):
+    return 1 + max((tree_depth(child) for child in summary.children), default=0)
+
+
+def build_tree(story, fan_out, config, max_workers=BOOK_CONCURRENCY):
+    """
+    builds the summary tree of story like generate_summary_tree, against a fake provider
+    :return: dict of the calls, tokens and seconds of the build
+    """
+    backend = CountingBackend(FakeProvider(config))
+    proxy_ai_backend = ProxyAIBackend(backend)
+    capped = fan_out == BUDGET_FAN_OUT
+    fan_out = get_fan_out(proxy_ai_backend, fan_out)
+    boundary_index = BoundaryIndex.build(story)
+    num_leaves = get_number_of_slices(boundary_index.num_tokens)
+    predicted_calls = get_number_of_inferences(num_leaves, fan_out, capped)
+
+    progress = progress_tracker.start(f"fan-out-{fan_out}-{id(backend)}", predicted_calls)
+    scheduler = SummaryTreeScheduler(proxy_ai_backend, None, None, max_workers=max_workers,
+                                     progress=progress, fan_out=fan_out, capped=capped)
+    started = time.perf_counter()
+    # the backends print every streamed token and split_large_text every slice
+    with redirect_stdout(io.StringIO()):
+        root = scheduler.run(iter_slices(story, boundary_index=boundary_index), num_leaves=num_leaves)
+    seconds = time.perf_counter() - started
+    progress.finish()
+    if backend.calls != predicted_calls:
+        raise AssertionError(f"fan-out {fan_out} made {backend.calls} calls, {predicted_calls} predicted")
+    return {
+        "fan_out": fan_out,
+        "leaves": num_leaves,
+        "calls": backend.calls,
+        "reductions": backend.calls - num_leaves,
+        "depth": tree_depth(root),
+        "prompt_tokens": backend.prompt_tokens,
+        "output_tokens": backend.output_tokens,
+        "seconds": seconds,
+    }
+
+
+def run_benchmark(fan_outs, book_tokens, config, sample_texts=SAMPLE_TEXTS, max_workers=BOOK_CONCURRENCY):
+    """
+    :param fan_outs: fan-outs to compare, numbers or BUDGET_FAN_OUT
+    :return: {sample text: {requested fan-out: result of build_tree}}
+    """
+    results = {}
+    for sample_text in sample_texts:
+        story = make_book(sample_text, book_tokens)
+        results[sample_text] = {str(fan_out): build_tree(story, fan_out, config, max_workers)
+                                for fan_out in fan_outs}
+    return results
+
+
+def format_results(results):
+    lines = [f"{'text':<18} {'fan-out':>10} {'leaves':>7} {'calls':>6} {'reduce':>7} {'depth':>6} "
+             f"{'prompt tok':>11} {'output tok':>11} {'seconds':>8}"]
+    for sample_text, by_fan_out in results.items():
+        for requested, result in by_fan_out.items():
+            fan_out = requested if requested == str(result["fan_out"]) else f"{requested}={result['fan_out']}"
+            lines.append(f"{sample_text:<18} {fan_out:>10} {result['leaves']:>7} {result['calls']:>6} "
+                         f"{result['reductions']:>7} {result['depth']:>6} {result['prompt_tokens']:>11} "
+                         f"{result['output_tokens']:>11} {result['seconds']:>8.2f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fan-outs", default=DEFAULT_FAN_OUTS, help="comma separated fan-outs, numbers or budget")
+    parser.add_argument("--book-tokens", type=int, default=DEFAULT_BOOK_TOKENS,
+                        help="tokens every sample text is repeated to")
+    parser.add_argument("--quick", action="store_true", help=f"books of {QUICK_BOOK_TOKENS} tokens, fast answers")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds to the first token of every call")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--output-tokens", type=int, default=128, help="words of every summary")
+    parser.add_argument("--max-workers", type=int, default=BOOK_CONCURRENCY, help="calls in flight for the book")
+    parser.add_argument("--history", help="JSON lines file the results are appended to")
+    args = parser.parse_args(argv)
+
+    config = FakeProviderConfig(ttft_seconds=args.ttft, tokens_per_second=args.tokens_per_second,
+                                output_tokens=args.output_tokens)
+    book_tokens = args.book_tokens
+    if args.quick:
+        book_tokens = QUICK_BOOK_TOKENS
+        config = config._replace(ttft_seconds=0.01, tokens_per_second=1e4)
+    fan_outs = [fan_out.strip() for fan_out in args.fan_outs.split(",") if fan_out.strip()]
+
+    results = run_benchmark(fan_outs, book_tokens, config, max_workers=args.max_workers)
+    print(format_results(results))
+    if args.history:
+        with open(args.history, "a") as history_file:
+            history_file.write(json.dumps({"time": time.time(), "revision": git_revision(), "book_tokens": book_tokens,
+                                           "provider": config._asdict(), "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Startup cost of the API: import time and memory of a fresh interpreter
+importing a module, and whether torch or transformers were pulled in.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --module main --repeat 5 --history startup_history.jsonl
+
+Every run can be appended to a JSON lines history to track startup over time.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULES = ("main", "llama.custom_type")
+HEAVY_MODULES = ("torch", "transformers")
+
+# runs in the child interpreter, whose only work is the import being measured
+PROBE = """
+import json, sys, time, resource
+started = time.perf_counter()
+import {module}
+import_seconds = time.perf_counter() - started
+rss_kb = None
+try:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+except OSError:
+    pass
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "rss_mb": rss_kb / 1024 if rss_kb is not None else None,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": [name for name in {heavy_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(module, env=None):
+    """
+    imports module in a fresh interpreter
+    :return: dict of import_seconds, rss_mb, max_rss_mb and the heavy_modules it loaded
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy_modules=HEAVY_MODULES)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def benchmark(module, repeat):
+    """
+    :return: medians of repeat measurements of measure_import
+    """
+    runs = [measure_import(module) for _ in range(repeat)]
+    return {
+        "module": module,
+        "repeat": repeat,
+        "import_seconds": statistics.median(run["import_seconds"] for run in runs),
+        "rss_mb": statistics.median(run["rss_mb"] or 0.0 for run in runs),
+        "max_rss_mb": statistics.median(run["max_rss_mb"] for run in runs),
+        "heavy_modules": runs[-1]["heavy_modules"],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", action="append", help=f"module to import, default {', '.join(DEFAULT_MODULES)}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--history", help="JSON lines file the results are appended to")
+    args = parser.parse_args(argv)
+
+    results = [benchmark(module, args.repeat) for module in args.module or DEFAULT_MODULES]
+    for result in results:
+        print(f"{result['module']:<24} {result['import_seconds']:7.3f} s  {result['rss_mb']:8.1f} MB RSS  "
+              f"heavy modules: {', '.join(result['heavy_modules']) or 'none'}")
+    if args.history:
+        with open(args.history, "a") as history_file:
+            history_file.write(json.dumps({"time": time.time(), "revision": git_revision(), "results": results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
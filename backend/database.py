@@ -0,0 +1,163 @@
+"""
+Process-wide MySQL connection pool.
+
+Routers receive the pool with ``Depends(get_db_pool)`` and check out a
+connection only for the duration of their queries:
+
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        ...
+
+Pool size and checkout timeout are read from MYSQL_POOL_SIZE and
+MYSQL_POOL_TIMEOUT.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from mysql.connector import pooling
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CHECKOUT_TIMEOUT = 30.0
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def connect_kwargs_from_env():
+    return {
+        "host": os.environ["MYSQL_ENDPOINT"],
+        "user": os.environ["MYSQL_USER"],
+        "password": os.environ["MYSQL_PWD"],
+        "database": "readability",
+    }
+
+
+class DatabasePool:
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT, **connect_kwargs):
+        """
+        :param pool_size: number of connections kept open by this process
+        :param checkout_timeout: seconds to wait for a free connection before giving up
+        :param connect_kwargs: arguments forwarded to mysql.connector.connect,
+            read from the MYSQL_* environment variables on first checkout if empty
+        """
+        if not 0 < pool_size <= pooling.CNX_POOL_MAXSIZE:
+            raise ValueError(f"pool_size must be between 1 and {pooling.CNX_POOL_MAXSIZE}, got {pool_size}")
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # mysql.connector raises immediately when the pool is exhausted,
+        # so callers queue on this semaphore instead.
+        self._available = threading.BoundedSemaphore(pool_size)
+
+        self._metrics_lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+        self._timeouts = 0
+        self._health_check_failures = 0
+        self._total_wait_seconds = 0.0
+        self._max_wait_seconds = 0.0
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = pooling.MySQLConnectionPool(
+                    pool_name="readability",
+                    pool_size=self.pool_size,
+                    pool_reset_session=True,
+                    **(self.connect_kwargs or connect_kwargs_from_env()),
+                )
+            return self._pool
+
+    def _record_wait(self, wait_seconds):
+        with self._metrics_lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._total_wait_seconds += wait_seconds
+            self._max_wait_seconds = max(self._max_wait_seconds, wait_seconds)
+
+    def acquire(self):
+        """
+        checks out a healthy connection, waiting up to checkout_timeout seconds
+        """
+        wait_started = time.perf_counter()
+        if not self._available.acquire(timeout=self.checkout_timeout):
+            with self._metrics_lock:
+                self._timeouts += 1
+            raise PoolTimeoutError(f"no database connection available after {self.checkout_timeout}s")
+        self._record_wait(time.perf_counter() - wait_started)
+
+        try:
+            connection = self._get_pool().get_connection()
+        except Exception:
+            self._release_slot()
+            raise
+
+        try:
+            # health check: transparently reconnect connections the server dropped
+            connection.ping(reconnect=True, attempts=2, delay=0)
+        except Exception:
+            with self._metrics_lock:
+                self._health_check_failures += 1
+            self.release(connection)
+            raise
+        return connection
+
+    def _release_slot(self):
+        with self._metrics_lock:
+            self._in_use -= 1
+        self._available.release()
+
+    def release(self, connection):
+        try:
+            # returns the connection to the pool and resets its session,
+            # rolling back anything left uncommitted
+            connection.close()
+        finally:
+            self._release_slot()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def metrics(self):
+        with self._metrics_lock:
+            checkouts = self._checkouts
+            return {
+                "pool_size": self.pool_size,
+                "in_use": self._in_use,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "health_check_failures": self._health_check_failures,
+                "total_wait_seconds": self._total_wait_seconds,
+                "mean_wait_seconds": self._total_wait_seconds / checkouts if checkouts else 0.0,
+                "max_wait_seconds": self._max_wait_seconds,
+            }
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    """
+    returns the process-wide pool, creating it on first use.
+    Use as a FastAPI dependency: ``db_pool = Depends(get_db_pool)``
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = DatabasePool(
+                pool_size=int(os.environ.get("MYSQL_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                checkout_timeout=float(os.environ.get("MYSQL_POOL_TIMEOUT", DEFAULT_CHECKOUT_TIMEOUT)),
+            )
+        return _db_pool
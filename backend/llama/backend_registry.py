@@ -0,0 +1,84 @@
+"""
+AI backends by name.
+
+Backends are registered as "module:attribute" strings and imported only when
+first resolved, so a process serving GPT-4 never imports torch or
+transformers. The backend of the API is chosen with AI_BACKEND (default gpt-4).
+get_backend shares one instance per name across the process, so a local model
+is loaded once rather than once per request or per book.
+"""
+import os
+import importlib
+import threading
+
+DEFAULT_BACKEND = "gpt-4"
+
+_backends = {
+    "gpt-4": "llama.custom_type:GPT4Backend",
+    "gpt-3.5-turbo": "llama.custom_type:GPT3Backend",
+    "llama-2-7b-chat": "llama.llama_backend:LLaMABackend",
+    # streams made-up answers, for load tests, see benchmarks/fake_provider.py
+    "fake": "benchmarks.fake_provider:FakeBackend",
+}
+_resolved = {}
+_lock = threading.Lock()
+_instances = {}
+# held while a backend is created, which may load a model for minutes
+_instances_lock = threading.Lock()
+
+
+class UnknownBackend(Exception):
+    pass
+
+
+def register_backend(name, target):
+    """
+    :param target: "module:attribute" of an AIBackend subclass, or the class itself
+    """
+    with _lock:
+        _backends[name] = target
+        _resolved.pop(name, None)
+    with _instances_lock:
+        _instances.pop(name, None)
+
+
+def backend_names():
+    with _lock:
+        return sorted(_backends)
+
+
+def get_backend_class(name):
+    """
+    imports the module of a backend on first use
+    """
+    with _lock:
+        if name in _resolved:
+            return _resolved[name]
+        if name not in _backends:
+            raise UnknownBackend(f"unknown backend {name!r}, expected one of {sorted(_backends)}")
+        target = _backends[name]
+        if isinstance(target, str):
+            module_name, attribute = target.split(":")
+            target = getattr(importlib.import_module(module_name), attribute)
+        _resolved[name] = target
+        return target
+
+
+def create_backend(name=None, **kwargs):
+    """
+    :param name: registered name, AI_BACKEND by default
+    :return: a new instance of the backend
+    """
+    return get_backend_class(name or os.environ.get("AI_BACKEND", DEFAULT_BACKEND))(**kwargs)
+
+
+def get_backend(name=None):
+    """
+    :param name: registered name, AI_BACKEND by default
+    :return: the instance of the backend shared by this process, created on first use
+    """
+    name = name or os.environ.get("AI_BACKEND", DEFAULT_BACKEND)
+    with _instances_lock:
+        if name not in _instances:
+            _instances[name] = create_backend(name)
+        return _instances[name]
@@ -0,0 +1,127 @@
+import os
+import re
+import struct
+import threading
+import tiktoken
+from array import array
+from bisect import bisect_left, bisect_right
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+BOUNDARY_INDEX_MAGIC = b"RBNDIDX1"
+# magic, number of characters, number of tokens, number of boundaries
+BOUNDARY_INDEX_HEADER = struct.Struct("<8sQQI")
+
+# kinds of boundaries, a stronger boundary has a larger kind
+NO_BOUNDARY = 0
+SENTENCE = 1
+PARAGRAPH = 2
+HEADING = 3
+
+# a line of its own after a blank line, like "CHAPTER IV", "Part Two: The Sea", "XII." or "3"
+HEADING_PATTERN = re.compile(
+    r"(?:\A|(?<=\n\n))[ \t]*((?:(?i:chapter|book|part|act|volume|prologue|epilogue)\b[^\n]{0,60}"
+    r"|[IVXLC]{1,7}\.?|\d{1,3}\.?)[ \t]*)(?=\n|\Z)")
+PARAGRAPH_PATTERN = re.compile(r"\n[ \t]*\n\s*(\S)")
+SENTENCE_PATTERN = re.compile(r"[.!?][\"'”’)\]]*\s+(\S)")
+
+
+def boundary_index_url(book_content_url):
+    """
+    the boundary index is stored next to the book, like the offset index
+    """
+    return os.path.splitext(book_content_url)[0] + "_boundaries.bin"
+
+
+class BoundaryIndex:
+    """
+    Sorted token offsets at which a sentence, a paragraph or a chapter heading of a book starts.
+
+    An offset is the first token of the new unit, so cutting the tokens there keeps
+    the unit whole. Where several units start at the same token the strongest kind is kept.
+    """
+    def __init__(self, token_offsets, kinds, num_chars, num_tokens):
+        self.token_offsets = token_offsets
+        self.kinds = kinds
+        self.num_chars = num_chars
+        self.num_tokens = num_tokens
+
+    @classmethod
+    def build(cls, text, token_char_starts=None):
+        """
+        :param token_char_starts: character offset of every token of text, tokenized here by default
+        """
+        if token_char_starts is None:
+            _, token_char_starts = tokenizer.decode_with_offsets(tokenizer.encode(text))
+        kinds_by_offset = {}
+        for kind, pattern in ((SENTENCE, SENTENCE_PATTERN), (PARAGRAPH, PARAGRAPH_PATTERN), (HEADING, HEADING_PATTERN)):
+            for match in pattern.finditer(text):
+                # the token holding the first character of the unit, which may start with a space
+                token_offset = bisect_right(token_char_starts, match.start(1)) - 1
+                if token_offset > 0:
+                    kinds_by_offset[token_offset] = kind
+        if token_char_starts:
+            # the start of the book starts its first chapter
+            kinds_by_offset[0] = HEADING
+
+        token_offsets = array('q', sorted(kinds_by_offset))
+        kinds = array('b', (kinds_by_offset[token_offset] for token_offset in token_offsets))
+        return cls(token_offsets, kinds, len(text), len(token_char_starts))
+
+    def kind_at(self, token_offset):
+        """
+        :return: kind of the boundary at token_offset, NO_BOUNDARY when a cut there splits a sentence
+        """
+        i = bisect_left(self.token_offsets, token_offset)
+        if i < len(self.token_offsets) and self.token_offsets[i] == token_offset:
+            return self.kinds[i]
+        return NO_BOUNDARY
+
+    def best_boundary(self, target, low, high):
+        """
+        :return: token offset of the strongest boundary in [low, high], the nearest to target
+            among equally strong ones, or None when there is no boundary in the range
+        """
+        best, best_key = None, None
+        for i in range(bisect_left(self.token_offsets, low), bisect_right(self.token_offsets, high)):
+            key = (self.kinds[i], -abs(self.token_offsets[i] - target))
+            if best_key is None or key > best_key:
+                best, best_key = self.token_offsets[i], key
+        return best
+
+    def save(self, path):
+        # written like OffsetIndex.save, through a file of this thread
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(BOUNDARY_INDEX_HEADER.pack(
+                BOUNDARY_INDEX_MAGIC, self.num_chars, self.num_tokens, len(self.token_offsets)))
+            self.token_offsets.tofile(index_file)
+            self.kinds.tofile(index_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as index_file:
+            magic, num_chars, num_tokens, count = BOUNDARY_INDEX_HEADER.unpack(
+                index_file.read(BOUNDARY_INDEX_HEADER.size))
+            if magic != BOUNDARY_INDEX_MAGIC:
+                raise ValueError(f"{path} is not a boundary index")
+            token_offsets = array('q')
+            token_offsets.fromfile(index_file, count)
+            kinds = array('b')
+            kinds.fromfile(index_file, count)
+        return cls(token_offsets, kinds, num_chars, num_tokens)
+
+
+def load_boundary_index(book_content_url, book_content):
+    """
+    :return: the stored boundary index of a book, None when it is missing or does not match book_content.
+        Books uploaded before boundary indexes existed have none.
+    """
+    try:
+        boundary_index = BoundaryIndex.load(boundary_index_url(book_content_url))
+    except (OSError, ValueError):
+        return None
+    if boundary_index.num_chars != len(book_content):
+        return None
+    return boundary_index
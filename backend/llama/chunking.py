@@ -0,0 +1,52 @@
+"""
+Where a book is cut into the leaves of its summary tree.
+
+The API plans the cuts at upload, to checkpoint them in the offset index, and
+the summary workers cut the book there, so both import this module, which
+unlike preprocess_summary loads no backend.
+"""
+import os
+import math
+
+MAX_SIZE = 3900
+# how far, as a fraction of the slice size, a cut may move to land on a boundary
+BOUNDARY_TOLERANCE = float(os.environ.get("SUMMARY_BOUNDARY_TOLERANCE", 0.1))
+
+
+def get_number_of_slices(num_tokens):
+    return math.ceil(num_tokens / MAX_SIZE)
+
+
+def slice_bounds(num_tokens, boundary_index=None, tolerance=BOUNDARY_TOLERANCE):
+    """
+    divides the tokens evenly across the slices, the last num_tokens % number_of_slices slices get one more.
+    With a boundary index every cut moves to the strongest boundary (heading, then paragraph, then sentence)
+    within tolerance of the even cut, the nearest among equals. Slices stay at most MAX_SIZE tokens either way
+    and there are always get_number_of_slices(num_tokens) of them.
+    :param boundary_index: llama.boundary_index.BoundaryIndex of the book
+    :return: generator of (start_idx, end_idx) of every slice, end_idx excluded
+    """
+    number_of_slices = get_number_of_slices(num_tokens)
+    if number_of_slices == 0:
+        return
+    if boundary_index is None:
+        slice_size, remainder = divmod(num_tokens, number_of_slices)
+        first_longer = number_of_slices - remainder
+        for i in range(number_of_slices):
+            start_idx = i * slice_size + max(0, i - first_longer)
+            yield start_idx, start_idx + slice_size + (i >= first_longer)
+        return
+
+    start_idx = 0
+    for remaining in range(number_of_slices, 1, -1):
+        target = start_idx + round((num_tokens - start_idx) / remaining)
+        slack = int(tolerance * (target - start_idx))
+        # the remaining slices must still fit in MAX_SIZE tokens each
+        low = max(target - slack, start_idx + 1, num_tokens - (remaining - 1) * MAX_SIZE)
+        high = min(target + slack, start_idx + MAX_SIZE, num_tokens - (remaining - 1))
+        end_idx = boundary_index.best_boundary(target, low, high)
+        if end_idx is None:
+            end_idx = target
+        yield start_idx, end_idx
+        start_idx = end_idx
+    yield start_idx, num_tokens
@@ -0,0 +1,67 @@
+"""
+Content-addressed store of uploaded books.
+
+A book is stored once as _content/<sha256>.txt under the users directory, so
+identical uploads share the text, its offset and boundary indexes and its
+summary tree, which are all named after the content path.
+"""
+import os
+import hashlib
+import threading
+
+from llama.offset_index import OffsetIndex, offset_index_url, tokenizer
+from llama.boundary_index import BoundaryIndex, boundary_index_url
+from llama.chunking import slice_bounds
+
+CONTENT_DIRNAME = "_content"
+
+
+def content_hash(book_content):
+    return hashlib.sha256(book_content.encode("utf-8")).hexdigest()
+
+
+def content_url_for(book_content):
+    """
+    :return: path of the book relative to the users directory, as stored in Books.content
+    """
+    return f"{CONTENT_DIRNAME}/{content_hash(book_content)}.txt"
+
+
+def build_book_indexes(book_content_url, book_content):
+    """
+    builds the boundary index and the offset index of a book from one tokenization and persists
+    them next to the book content. The cuts of the summary tree are exact offset index checkpoints,
+    so the tree and the offset index agree on which characters every leaf covers.
+    :return: (offset_index, boundary_index)
+    """
+    _, token_char_starts = tokenizer.decode_with_offsets(tokenizer.encode(book_content))
+    boundary_index = BoundaryIndex.build(book_content, token_char_starts)
+    cuts = [start_idx for start_idx, _ in slice_bounds(len(token_char_starts), boundary_index)]
+    offset_index = OffsetIndex.build(book_content, token_char_starts=token_char_starts, exact_token_offsets=cuts)
+    boundary_index.save(boundary_index_url(book_content_url))
+    offset_index.save(offset_index_url(book_content_url))
+    return offset_index, boundary_index
+
+
+def store_book_content(users_dirname, book_content):
+    """
+    writes a book to the store unless identical content is already there
+    :param users_dirname: root of the user files, e.g. /home/swpp/readability_users
+    :return: (content url relative to users_dirname, True if the content was new)
+    """
+    content_url = content_url_for(book_content)
+    book_content_url = os.path.join(users_dirname, content_url)
+    if os.path.exists(book_content_url):
+        return content_url, False
+
+    os.makedirs(os.path.dirname(book_content_url), exist_ok=True)
+    # char -> token checkpoints, so /summary and /quiz never tokenize the book, and the
+    # boundaries the summary tree is cut at. Built before the content appears, so a stored
+    # book always has its indexes.
+    build_book_indexes(book_content_url, book_content)
+    # identical uploads may be stored by several threads at once, each through its own file
+    tmp_url = f"{book_content_url}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_url, 'w') as book_file:
+        book_file.write(book_content)
+    os.replace(tmp_url, book_content_url)
+    return content_url, True
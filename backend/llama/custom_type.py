@@ -1,17 +1,24 @@
 import tiktoken
 import sys
+import os
+import asyncio
 from tenacity import (
     retry,
 	stop_after_attempt,
 	wait_random_exponential,
 )  # for exponential backoff
 import openai
-import pickle
-import torch
 
-from threading import Thread
-from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer
+from concurrent.futures import ThreadPoolExecutor
 
+from llama.flat_summary_tree import FlatSummaryTree
+from llama.response_cache import response_cache, request_key
+from llama.single_flight import single_flight
+from llama.result_cache import result_cache, ResultKey, SUMMARY, QUIZ
+from llama.request_pipeline import (
+	TEXT, INTERMEDIATE, prepare_pool, prepare_request, timed_stream
+)
+from llama.prompt_builder import content_budget, output_budget, prompt_tokens, prompt_report, reduction_fan_out
 from llama.constants import (
     GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, 
 	GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW,
@@ -20,13 +27,27 @@ from llama.constants import (
 	GPT_TEXT_TO_INTERMEDIATE_SYSTEM_PROMPT,
 	GPT_INTERMEDIATE_TO_INTERMEDAITE_SYSTEM_SUMMARY_PROMPT,
 	GPT_INTERMEDAITE_TO_FINAL_SYSTEM_SUMMARY_PROMPT,
-	PROMPT_TEMPLATE_INTERMEDIATE_FRONT,
-	PROMPT_TEMPLATE_INTERMEDIATE_BACK,
-	PROMPT_TEMPLATE_FINAL_FRONT,
-	PROMPT_TEMPLATE_FINAL_BACK,
 )
 
+# system prompt answering a TEXT request that fell back to the summary tree, see answer_prompt
+FALLBACK_SYSTEM_PROMPTS = {
+	GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW: GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE,
+	GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW: GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE,
+}
+
+
+def answer_prompt(system_prompt, prepared):
+	"""
+	:return: the system prompt to answer a prepared request with: the content of a TEXT request
+		that fell back to the summary tree is summaries, like the content of an INTERMEDIATE one
+	"""
+	if prepared.fell_back:
+		return FALLBACK_SYSTEM_PROMPTS.get(system_prompt, system_prompt)
+	return system_prompt
+
 class Summary:
+	__slots__ = ("parent", "children", "start_idx", "end_idx", "summary_content")
+
 	def __init__(
 		self,
 		parent=None,
@@ -44,6 +65,20 @@ class Summary:
 		self.end_idx = end_idx
 		self.summary_content = summary_content
 	
+	def __getstate__(self):
+		return {name: getattr(self, name) for name in self.__slots__}
+
+	def __setstate__(self, state):
+		# trees pickled before __slots__ was added carry their __dict__, which has the same keys
+		for name, value in state.items():
+			setattr(self, name, value)
+
+	def to_flat(self):
+		"""
+		converts the tree rooted at this node into a FlatSummaryTree for fast lookups
+		"""
+		return FlatSummaryTree.from_summary(self)
+
 	def find_leaf_summary(self, word_index):
 		if len(self.children) == 0:
 			return self
@@ -72,7 +107,45 @@ class Summary:
 		return hash((self.start_idx, self.end_idx, self.summary_content))
 
 
+# threads shared by every stream bridged from a synchronous backend to the event loop
+STREAM_BRIDGE_CONCURRENCY = int(os.environ.get("STREAM_BRIDGE_CONCURRENCY", 32))
+_stream_bridge_executor = ThreadPoolExecutor(max_workers=STREAM_BRIDGE_CONCURRENCY, thread_name_prefix="stream")
+
+
+async def iterate_in_executor(generator):
+	"""
+	iterates a blocking generator without blocking the event loop:
+	every next() runs on the bounded stream bridge pool
+	"""
+	exhausted = object()
+	pending = None
+	try:
+		while True:
+			pending = _stream_bridge_executor.submit(next, generator, exhausted)
+			item = await asyncio.wrap_future(pending)
+			if item is exhausted:
+				return
+			yield item
+	finally:
+		# the generator cannot be closed while a next() is still running on the pool
+		if pending is not None and not pending.done():
+			pending.add_done_callback(lambda _: generator.close())
+		else:
+			generator.close()
+
+
 class AIBackend:
+	# maximum number of calls that may run on one instance at the same time, None for no limit
+	max_concurrency = None
+	# name of the backend in llama.backend_registry, which keys its answers in the result cache
+	backend_name = None
+
+	def max_reduction_fan_out(self):
+		"""
+		:return: summaries that fit in one precompute_*_from_intermediate request, None when unknown
+		"""
+		return None
+
 	def get_summary_from_text(self, progress, book_content_url):
 		pass
 
@@ -85,6 +158,24 @@ class AIBackend:
 	def get_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
 		pass
 
+	# async variants of the get_* methods, for request handlers running on the event loop.
+	# By default they bridge the blocking generators through iterate_in_executor.
+	async def aget_summary_from_text(self, progress, book_content_url):
+		async for item in iterate_in_executor(self.get_summary_from_text(progress, book_content_url)):
+			yield item
+
+	async def aget_summary_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		async for item in iterate_in_executor(self.get_summary_from_intermediate(progress, book_content_url, summary_tree_url)):
+			yield item
+
+	async def aget_quiz_from_text(self, progress, book_content_url):
+		async for item in iterate_in_executor(self.get_quiz_from_text(progress, book_content_url)):
+			yield item
+
+	async def aget_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		async for item in iterate_in_executor(self.get_quiz_from_intermediate(progress, book_content_url, summary_tree_url)):
+			yield item
+
 	def precompute_intermediate_from_text(self, sliced_text):
 		pass
 
@@ -94,10 +185,24 @@ class AIBackend:
 	def precompute_final_from_intermediate(self, content):
 		pass
 
+	def precompute_summary_from_intermediate(self, content):
+		pass
+
 class ProxyAIBackend(AIBackend):
 	def __init__(self, summary_generator):
 		self.summary_generator = summary_generator
 
+	@property
+	def max_concurrency(self):
+		return self.summary_generator.max_concurrency
+
+	@property
+	def backend_name(self):
+		return self.summary_generator.backend_name
+
+	def max_reduction_fan_out(self):
+		return self.summary_generator.max_reduction_fan_out()
+
 	def precompute_intermediate_from_text(self, sliced_text):
 		return self.summary_generator.precompute_intermediate_from_text(sliced_text)
 
@@ -107,6 +212,9 @@ class ProxyAIBackend(AIBackend):
 	def precompute_final_from_intermediate(self, content):
 		return self.summary_generator.precompute_final_from_intermediate(content)
 
+	def precompute_summary_from_intermediate(self, content):
+		return self.summary_generator.precompute_summary_from_intermediate(content)
+
 	def get_summary_from_text(self, progress, book_content_url):
 		return self.summary_generator.get_summary_from_text(progress, book_content_url)
 
@@ -119,95 +227,59 @@ class ProxyAIBackend(AIBackend):
 	def get_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
 		return self.summary_generator.get_quiz_from_intermediate(progress, book_content_url, summary_tree_url)
 
-class GPT4Backend(AIBackend):
-	def __init__(self):
-		self.tokenizer = tiktoken.get_encoding("cl100k_base")
+	def aget_summary_from_text(self, progress, book_content_url):
+		return self.summary_generator.aget_summary_from_text(progress, book_content_url)
 
-	@retry(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(6))
-	def completion_with_backoff(self, **kwargs):
-		return openai.ChatCompletion.create(**kwargs)
-
-	def get_summary_from_text(self, progress, book_content_url):
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
+	def aget_summary_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		return self.summary_generator.aget_summary_from_intermediate(progress, book_content_url, summary_tree_url)
 
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW},
-				{"role": "user", "content": read_content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
+	def aget_quiz_from_text(self, progress, book_content_url):
+		return self.summary_generator.aget_quiz_from_text(progress, book_content_url)
 
-			yield delta_content, finished
+	def aget_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		return self.summary_generator.aget_quiz_from_intermediate(progress, book_content_url, summary_tree_url)
 
-			if finished:
-				break
+class OpenAIBackend(AIBackend):
+	"""
+	streams chat completions of `model`, replaying responses already in the response cache
+	and /summary, /quiz answers already in the result cache
+	"""
+	model = None
 
-	def get_summary_from_intermediate(self, progress, book_content_url, summary_tree_url):
+	def __init__(self, response_cache=response_cache, result_cache=result_cache, single_flight=single_flight):
 		"""
-		generates summary based on the word_index
-		:param progress: progress of the book
-		:param book_id: book id to generate quiz from
-		:param callback: callback function to call when a delta content is generated
+		:param response_cache: llama.response_cache.ResponseCache, None to always call the provider
+		:param result_cache: llama.result_cache.ResultCache, None to answer every request
+		:param single_flight: llama.single_flight.SingleFlight joining identical async streams, None to never join
 		"""
+		self.tokenizer = tiktoken.get_encoding("cl100k_base")
+		self.response_cache = response_cache
+		self.result_cache = result_cache
+		self.single_flight = single_flight
 
-		summary_tree = ""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		with open(summary_tree_url, 'rb') as pickle_file:
-			summary_tree = pickle.load(pickle_file)
-
-		# word_index -> the number of characters read by the user.
-		# start_index, end_idx is the number of tokens processed by the summary
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
-		tokenized_read_content = self.tokenizer.encode(read_content)
-		word_index = len(tokenized_read_content) - 1
-
-		leaf = summary_tree.find_leaf_summary(word_index=word_index)
-		available_summary_list = summary_tree.find_included_summaries(leaf)
-
-		content = "\n\n".join([summary.summary_content for summary in available_summary_list])
-		content += "\n\n" + book_content[leaf.start_idx:word_index]
-
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
+	@retry(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(6))
+	def completion_with_backoff(self, **kwargs):
+		return openai.ChatCompletion.create(**kwargs)
 
-			yield delta_content, finished
-			if finished:
-				break
+	@retry(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(6))
+	async def acompletion_with_backoff(self, **kwargs):
+		return await openai.ChatCompletion.acreate(**kwargs)
 
-	def get_quiz_from_text(self, progress, book_content_url):
+	def stream_completion(self, system_prompt, content):
 		"""
-		generates 10 quizzes based on the word_index
-		:param progress: progress of the book
-		:param book_id: book id to generate quiz from
+		:return: generator of (delta_content, finished)
 		"""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
+		if self.response_cache is None:
+			return self._stream_from_provider(system_prompt, content)
+		return self.response_cache.stream(
+			self.model, system_prompt, content, lambda: self._stream_from_provider(system_prompt, content))
 
+	def _stream_from_provider(self, system_prompt, content):
 		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW},
-				{"role": "user", "content": read_content}
-			], stream=True
+			model=self.model, messages=[
+				{"role": "system", "content": system_prompt},
+				{"role": "user", "content": content}
+			], max_tokens=output_budget(self.model), stream=True
 		):
 			finished = resp.choices[0].finish_reason is not None
 			delta_content = "\n" if (finished) else resp.choices[0].delta.content
@@ -219,129 +291,60 @@ class GPT4Backend(AIBackend):
 			if finished:
 				break
 
-	def get_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
+	def astream_completion(self, system_prompt, content):
 		"""
-		generates 10 quizzes based on the word_index
-		:param progress: progress of the book
-		:param book_id: book id to generate quiz from
+		like stream_completion, reading the provider's stream with a non-blocking HTTP client.
+		Identical requests in flight at the same time share one stream.
+		:return: async generator of (delta_content, finished)
 		"""
-		summary_tree = ""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		with open(summary_tree_url, 'rb') as pickle_file:
-			summary_tree = pickle.load(pickle_file)
-
-		# word_index -> the number of characters read by the user.
-		# start_index, end_idx is the number of tokens processed by the summary
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
-		tokenized_read_content = self.tokenizer.encode(read_content)
-		word_index = len(tokenized_read_content)-1
-		
-		# generate new quiz
-		leaf = summary_tree.find_leaf_summary(word_index=word_index)
-		available_summary_list = summary_tree.find_included_summaries(leaf)
-
-		content = "\n\n".join([summary.summary_content for summary in available_summary_list])
-		content += "\n\n" + book_content[leaf.start_idx:word_index]
-
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
-
-			if finished:
-				break
-			
-	def precompute_intermediate_from_text(self, sliced_text):
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_TEXT_TO_INTERMEDIATE_SYSTEM_PROMPT},
-				{"role": "user", "content": sliced_text}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
-			if finished:
-				break
-
-	def precompute_intermediate_from_intermediate(self, content):
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_INTERMEDIATE_TO_INTERMEDAITE_SYSTEM_SUMMARY_PROMPT},
+		generate = lambda: self._astream_from_provider(system_prompt, content)
+		if self.response_cache is not None:
+			generate = lambda: self.response_cache.astream(
+				self.model, system_prompt, content, lambda: self._astream_from_provider(system_prompt, content))
+		if self.single_flight is None:
+			return generate()
+		return self.single_flight.stream(request_key(self.model, system_prompt, content), generate)
+
+	async def _astream_from_provider(self, system_prompt, content):
+		async for resp in await self.acompletion_with_backoff(
+			model=self.model, messages=[
+				{"role": "system", "content": system_prompt},
 				{"role": "user", "content": content}
-			], stream=True
+			], max_tokens=output_budget(self.model), stream=True
 		):
 			finished = resp.choices[0].finish_reason is not None
 			delta_content = "\n" if (finished) else resp.choices[0].delta.content
 
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
-
-			if finished:
-				break
-
-	def precompute_final_from_intermediate(self, content):
-		for resp in self.completion_with_backoff(
-			model="gpt-4", messages=[
-				{"role": "system", "content": GPT_INTERMEDAITE_TO_FINAL_SYSTEM_SUMMARY_PROMPT},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
 			yield delta_content, finished
 
 			if finished:
 				break
 
+	def prepare(self, kind, system_prompt, progress, book_content_url, summary_tree_url=None):
+		"""
+		prepares the content of a request within the token budget of the model, reporting its prompt tokens
+		:return: llama.request_pipeline.PreparedRequest
+		"""
+		prepared = prepare_request(kind, progress, book_content_url, summary_tree_url,
+					   *self.content_budgets(system_prompt))
+		self.report_prompt(answer_prompt(system_prompt, prepared), prepared)
+		return prepared
 
-class GPT3Backend(AIBackend):
-	def __init__(self):
-		self.tokenizer = tiktoken.get_encoding("cl100k_base")
+	def content_budgets(self, system_prompt):
+		"""
+		:return: content budgets of a request with system_prompt and of its fallback to the summary tree
+		"""
+		return (content_budget(self.model, system_prompt),
+			content_budget(self.model, FALLBACK_SYSTEM_PROMPTS.get(system_prompt, system_prompt)))
 
-	@retry(wait=wait_random_exponential(multiplier=1, max=60), stop=stop_after_attempt(6))
-	def completion_with_backoff(self, **kwargs):
-		return openai.ChatCompletion.create(**kwargs)
+	def report_prompt(self, system_prompt, prepared):
+		prompt_report.record(self.model, prompt_tokens(system_prompt, prepared.num_tokens),
+				     prepared.trimmed_tokens, prepared.fell_back)
 
 	def get_summary_from_text(self, progress, book_content_url):
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
+		prepared = self.prepare(TEXT, GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW, progress, book_content_url)
 
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW},
-				{"role": "user", "content": read_content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
-
-			if finished:
-				break
+		yield from self.stream_completion(answer_prompt(GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW, prepared), prepared.content)
 
 	def get_summary_from_intermediate(self, progress, book_content_url, summary_tree_url):
 		"""
@@ -351,39 +354,10 @@ class GPT3Backend(AIBackend):
 		:param callback: callback function to call when a delta content is generated
 		"""
 
-		summary_tree = ""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		with open(summary_tree_url, 'rb') as pickle_file:
-			summary_tree = pickle.load(pickle_file)
-
-		# word_index -> the number of characters read by the user.
-		# start_index, end_idx is the number of tokens processed by the summary
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
-		tokenized_read_content = self.tokenizer.encode(read_content)
-		word_index = len(tokenized_read_content) - 1
-
-		leaf = summary_tree.find_leaf_summary(word_index=word_index)
-		available_summary_list = summary_tree.find_included_summaries(leaf)
-
-		content = "\n\n".join([summary.summary_content for summary in available_summary_list])
-		content += "\n\n" + book_content[leaf.start_idx:word_index]
+		prepared = self.prepare(INTERMEDIATE, GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE,
+					progress, book_content_url, summary_tree_url)
 
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
-			if finished:
-				break
+		yield from self.stream_completion(GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, prepared.content)
 
 	def get_quiz_from_text(self, progress, book_content_url):
 		"""
@@ -391,27 +365,9 @@ class GPT3Backend(AIBackend):
 		:param progress: progress of the book
 		:param book_id: book id to generate quiz from
 		"""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
-
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW},
-				{"role": "user", "content": read_content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-
-			yield delta_content, finished
+		prepared = self.prepare(TEXT, GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW, progress, book_content_url)
 
-			if finished:
-				break
+		yield from self.stream_completion(answer_prompt(GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW, prepared), prepared.content)
 
 	def get_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
 		"""
@@ -419,153 +375,89 @@ class GPT3Backend(AIBackend):
 		:param progress: progress of the book
 		:param book_id: book id to generate quiz from
 		"""
-		summary_tree = ""
-		with open(book_content_url, 'r') as book_file:
-			book_content = book_file.read()
-		with open(summary_tree_url, 'rb') as pickle_file:
-			summary_tree = pickle.load(pickle_file)
-
-		# word_index -> the number of characters read by the user.
-		# start_index, end_idx is the number of tokens processed by the summary
-		word_index = int(progress * len(book_content))
-		read_content = book_content[:word_index]
-		tokenized_read_content = self.tokenizer.encode(read_content)
-		word_index = len(tokenized_read_content)-1
-		
-		# generate new quiz
-		leaf = summary_tree.find_leaf_summary(word_index=word_index)
-		available_summary_list = summary_tree.find_included_summaries(leaf)
-
-		content = "\n\n".join([summary.summary_content for summary in available_summary_list])
-		content += "\n\n" + book_content[leaf.end_idx:word_index]
-
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
+		prepared = self.prepare(INTERMEDIATE, GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE,
+					progress, book_content_url, summary_tree_url)
 
-			yield delta_content, finished
+		yield from self.stream_completion(GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE, prepared.content)
 
-			if finished:
-				break
-			
-	def precompute_intermediate_from_text(self, sliced_text):
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_TEXT_TO_INTERMEDIATE_SYSTEM_PROMPT},
-				{"role": "user", "content": sliced_text}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
+	def astream_answer(self, kind, system_prompt, prepared):
+		"""
+		streams the answer to a prepared request, from the result cache when its bucket was answered before
+		:param kind: llama.result_cache.SUMMARY or QUIZ
+		:param prepared: llama.request_pipeline.PreparedRequest. A TEXT request that fell back to the summary
+			tree is answered and cached like an INTERMEDIATE one, see answer_prompt
+		"""
+		system_prompt = answer_prompt(system_prompt, prepared)
+		self.report_prompt(system_prompt, prepared)
+		generate = lambda: timed_stream(self.astream_completion(system_prompt, prepared.content))
+		if self.result_cache is None:
+			return generate()
+		key = ResultKey(prepared.content_hash, prepared.leaf_id, prepared.bucket, kind, self.backend_name)
+		return self.result_cache.astream(key, self.model, system_prompt, prepared.content, generate)
+
+	async def aprepare(self, kind, system_prompt, progress, book_content_url, summary_tree_url=None):
+		"""
+		like prepare, on the prepare pool, off the event loop
+		"""
+		return await prepare_pool.prepare(kind, progress, book_content_url, summary_tree_url,
+						  *self.content_budgets(system_prompt))
 
-			yield delta_content, finished
-			if finished:
-				break
+	async def aget_summary_from_text(self, progress, book_content_url):
+		prepared = await self.aprepare(TEXT, GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW, progress, book_content_url)
 
-	def precompute_intermediate_from_intermediate(self, content):
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_INTERMEDIATE_TO_INTERMEDAITE_SYSTEM_SUMMARY_PROMPT},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
+		async for item in self.astream_answer(SUMMARY, GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW, prepared):
+			yield item
 
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
+	async def aget_summary_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		prepared = await self.aprepare(INTERMEDIATE, GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE,
+					       progress, book_content_url, summary_tree_url)
 
-			yield delta_content, finished
+		async for item in self.astream_answer(SUMMARY, GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, prepared):
+			yield item
 
-			if finished:
-				break
+	async def aget_quiz_from_text(self, progress, book_content_url):
+		prepared = await self.aprepare(TEXT, GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW, progress, book_content_url)
 
-	def precompute_final_from_intermediate(self, content):
-		for resp in self.completion_with_backoff(
-			model="gpt-3.5-turbo", messages=[
-				{"role": "system", "content": GPT_INTERMEDAITE_TO_FINAL_SYSTEM_SUMMARY_PROMPT},
-				{"role": "user", "content": content}
-			], stream=True
-		):
-			finished = resp.choices[0].finish_reason is not None
-			delta_content = "\n" if (finished) else resp.choices[0].delta.content
+		async for item in self.astream_answer(QUIZ, GPT_SYSTEM_QUIZ_PROMPT_FROM_RAW, prepared):
+			yield item
 
-			sys.stdout.write(delta_content)
-			sys.stdout.flush()
-			yield delta_content, finished
+	async def aget_quiz_from_intermediate(self, progress, book_content_url, summary_tree_url):
+		prepared = await self.aprepare(INTERMEDIATE, GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE,
+					       progress, book_content_url, summary_tree_url)
 
-			if finished:
-				break
+		async for item in self.astream_answer(QUIZ, GPT_SYSTEM_QUIZ_PROMPT_FROM_INTERMEDIATE, prepared):
+			yield item
 
-class LLaMABackend(AIBackend):
-	def __init__(self):
-		self.model_name_or_path = "TheBloke/Llama-2-7b-Chat-GPTQ"
-		self.model = AutoModelForCausalLM.from_pretrained(self.model_name_or_path,
-											device_map="cuda:0",
-                                            trust_remote_code=False,
-                                            revision="main")
-		self.tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path, use_fast=True)
-		self.streamer = TextIteratorStreamer(self.tokenizer)
-
-	def get_summary_from_text(self):
-		pass
-	def get_summary_from_intermediate(self):
-		pass
-	def get_quiz_from_text(self):
-		pass
-	def get_quiz_from_intermediate(self):
-		pass
+	def max_reduction_fan_out(self):
+		return reduction_fan_out(self.model, (GPT_INTERMEDIATE_TO_INTERMEDAITE_SYSTEM_SUMMARY_PROMPT,
+						      GPT_INTERMEDAITE_TO_FINAL_SYSTEM_SUMMARY_PROMPT))
 
 	def precompute_intermediate_from_text(self, sliced_text):
-		# inserted_input_ids = torch.cat([
-		# 	self.tokenizer(PROMPT_TEMPLATE_INTERMEDIATE, return_tensors='pt').input_ids[:, :-4],
-		# 	self.tokenizer(sliced_text, return_tensors='pt').input_ids,
-		# 	self.tokenizer(PROMPT_TEMPLATE_INTERMEDIATE,return_tensors='pt').input_ids[:, -4:]],
-		# 	dim=1).cuda()
-
-		inputs = self.tokenizer(
-			PROMPT_TEMPLATE_INTERMEDIATE_FRONT + sliced_text + PROMPT_TEMPLATE_INTERMEDIATE_BACK,
-			return_tensors='pt').to('cuda:0')
-		generation_kwargs = dict(inputs, streamer=self.streamer, max_new_tokens=512)
-		thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-		thread.start()
-		for new_text in self.streamer:
-			sys.stdout.write(new_text)
-			sys.stdout.flush()
-			yield new_text, False
-		yield "\n", True
+		yield from self.stream_completion(GPT_TEXT_TO_INTERMEDIATE_SYSTEM_PROMPT, sliced_text)
 
 	def precompute_intermediate_from_intermediate(self, content):
-		inputs = self.tokenizer(
-			PROMPT_TEMPLATE_INTERMEDIATE_FRONT + content + PROMPT_TEMPLATE_INTERMEDIATE_BACK,
-			return_tensors='pt').to('cuda:0')
-		generation_kwargs = dict(inputs, streamer=self.streamer, max_new_tokens=512)
-		thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-		thread.start()
-		for new_text in self.streamer:
-			sys.stdout.write(new_text)
-			sys.stdout.flush()
-			yield new_text, False
-		yield "\n", True
+		yield from self.stream_completion(GPT_INTERMEDIATE_TO_INTERMEDAITE_SYSTEM_SUMMARY_PROMPT, content)
 
 	def precompute_final_from_intermediate(self, content):
-		inputs = self.tokenizer(
-			PROMPT_TEMPLATE_FINAL_FRONT + content + PROMPT_TEMPLATE_FINAL_BACK,
-			return_tensors='pt').to('cuda:0')
-		generation_kwargs = dict(inputs, streamer=self.streamer, max_new_tokens=512)
-		thread = Thread(target=self.model.generate, kwargs=generation_kwargs)
-		thread.start()
-		for new_text in self.streamer:
-			sys.stdout.write(new_text)
-			sys.stdout.flush()
-			yield new_text, False
-		yield "\n", True
+		yield from self.stream_completion(GPT_INTERMEDAITE_TO_FINAL_SYSTEM_SUMMARY_PROMPT, content)
+
+	def precompute_summary_from_intermediate(self, content):
+		yield from self.stream_completion(GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, content)
+
+
+class GPT4Backend(OpenAIBackend):
+	model = "gpt-4"
+	backend_name = "gpt-4"
+
+
+class GPT3Backend(OpenAIBackend):
+	model = "gpt-3.5-turbo"
+	backend_name = "gpt-3.5-turbo"
+
+
+def __getattr__(name):
+	# LLaMABackend needs torch and transformers, which are only imported when it is asked for
+	if name == "LLaMABackend":
+		from llama.llama_backend import LLaMABackend
+		return LLaMABackend
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,98 @@
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+FlatSummaryNode = namedtuple("FlatSummaryNode", ["node_id", "start_idx", "end_idx", "summary_content"])
+
+
+class FlatSummaryTree:
+    """
+    Array-backed, read-only form of a Summary tree.
+
+    Nodes are numbered breadth first, so the children of a node are contiguous.
+    Leaves are kept sorted by start_idx for binary search, and every node stores
+    its covering set, i.e. what Summary.find_included_summaries would return for it.
+    Queries return FlatSummaryNode tuples, which have the same fields as Summary.
+    """
+    def __init__(self, start_idxs, end_idxs, parents, first_children, child_counts,
+                 summary_contents, leaf_nodes, covering_sets, leaf_boundaries=None):
+        self.start_idxs = start_idxs
+        self.end_idxs = end_idxs
+        self.parents = parents
+        self.first_children = first_children
+        self.child_counts = child_counts
+        self.summary_contents = summary_contents
+        self.leaf_nodes = leaf_nodes
+        self.leaf_start_idxs = array('q', (start_idxs[node_id] for node_id in leaf_nodes))
+        self.covering_sets = covering_sets
+        # kind of boundary every leaf starts at, see llama.boundary_index, None when the cuts are unknown
+        self.leaf_boundaries = leaf_boundaries
+
+    @classmethod
+    def from_summary(cls, root):
+        start_idxs, end_idxs, parents = array('q'), array('q'), array('q')
+        first_children, child_counts = array('q'), array('q')
+        summary_contents = []
+
+        nodes = [root]
+        parents.append(-1)
+        node_id = 0
+        while node_id < len(nodes):
+            node = nodes[node_id]
+            start_idxs.append(node.start_idx)
+            end_idxs.append(node.end_idx)
+            summary_contents.append(node.summary_content)
+            first_children.append(len(nodes) if node.children else -1)
+            child_counts.append(len(node.children))
+            for child in node.children:
+                nodes.append(child)
+                parents.append(node_id)
+            node_id += 1
+
+        # parents are numbered before their children, so their covering sets are ready
+        covering_sets = [()]
+        for node_id in range(1, len(nodes)):
+            parent = parents[node_id]
+            first_child = first_children[parent]
+            siblings = tuple(
+                sibling for sibling in range(first_child, first_child + child_counts[parent])
+                if end_idxs[sibling] <= start_idxs[node_id]
+            )
+            covering_sets.append(siblings + covering_sets[parent])
+
+        leaf_nodes = array('q', sorted(
+            (node_id for node_id in range(len(nodes)) if child_counts[node_id] == 0),
+            key=lambda node_id: start_idxs[node_id]))
+        return cls(start_idxs, end_idxs, parents, first_children, child_counts,
+                   summary_contents, leaf_nodes, covering_sets)
+
+    def __len__(self):
+        return len(self.start_idxs)
+
+    def node(self, node_id):
+        return FlatSummaryNode(node_id, self.start_idxs[node_id], self.end_idxs[node_id],
+                               self.summary_contents[node_id])
+
+    def find_leaf_summary(self, word_index):
+        if len(self) == 1:
+            # like Summary.find_leaf_summary, a tree without children is its own leaf
+            return self.node(0)
+        i = bisect_right(self.leaf_start_idxs, word_index) - 1
+        if i < 0:
+            return None
+        leaf = self.leaf_nodes[i]
+        if word_index > self.end_idxs[leaf]:
+            return None
+        return self.node(leaf)
+
+    def leaf_boundary(self, leaf):
+        """
+        :param leaf: FlatSummaryNode returned by find_leaf_summary
+        :return: kind of boundary the leaf starts at, None when unknown
+        """
+        if self.leaf_boundaries is None:
+            return None
+        return self.leaf_boundaries[bisect_right(self.leaf_start_idxs, leaf.start_idx) - 1]
+
+    def find_included_summaries(self, child_summary):
+        return [self.node(node_id) for node_id in self.covering_sets[child_summary.node_id]]
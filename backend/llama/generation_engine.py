@@ -0,0 +1,317 @@
+"""
+Batched text generation with a local Hugging Face model.
+
+One engine owns one model. Callers submit prompts and get a RequestStreamer
+of their own; a single worker thread collects the queued prompts into batches
+of up to max_batch_size (waiting at most max_wait_seconds for a batch to
+fill), left-pads them and runs one model.generate per batch, routing every
+generated token back to the stream of its request. The queue of waiting
+prompts is bounded, so callers block (or fail with EngineOverloaded) instead
+of piling up work. Everything runs on CPU as well as on a GPU.
+
+Prompts may be split into a constant prefix (a prompt template) and the rest.
+The past key/values of each prefix are computed once by a PrefixCache and
+reused by every batch of that prefix, which then only prefills the rest.
+"""
+import time
+import queue
+import threading
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+DEFAULT_MAX_BATCH_SIZE = 8
+DEFAULT_MAX_WAIT_SECONDS = 0.05
+DEFAULT_MAX_QUEUE = 64
+
+_END = object()
+
+
+class EngineOverloaded(Exception):
+    pass
+
+
+class RequestStreamer:
+    """
+    text generated for one request, iterated as it is produced
+    """
+    def __init__(self, prompt, max_new_tokens, prefix=None):
+        """
+        :param prompt: the prompt, or its part after prefix
+        """
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.prefix = prefix
+        self.cancelled = False
+        self._chunks = queue.Queue()
+
+    def put(self, text):
+        self._chunks.put(text)
+
+    def end(self, error=None):
+        self._chunks.put(_END if error is None else error)
+
+    def cancel(self):
+        """
+        stops generating for this request, e.g. when its reader went away
+        """
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is _END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+
+class BatchStreamer:
+    """
+    streamer of one model.generate call, splitting the batch into the streams of its requests
+    """
+    def __init__(self, tokenizer, requests, eos_token_id):
+        self.tokenizer = tokenizer
+        self.requests = requests
+        self.eos_token_id = eos_token_id
+        self.tokens = [[] for _ in requests]
+        self.sent = [0] * len(requests)
+        self.done = [request.cancelled for request in requests]
+        self._prompt_seen = False
+
+    def _finish(self, row):
+        if self.done[row]:
+            return
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        if len(text) > self.sent[row]:
+            self.requests[row].put(text[self.sent[row]:])
+        self.done[row] = True
+        self.requests[row].end()
+
+    def put(self, value):
+        # generate first passes the prompt ids, then the next token of every row
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        for row, token in enumerate(value.reshape(-1).tolist()):
+            if self.done[row]:
+                continue
+            if self.requests[row].cancelled:
+                self.done[row] = True
+                self.requests[row].end()
+                continue
+            if token == self.eos_token_id:
+                self._finish(row)
+                continue
+            self.tokens[row].append(token)
+            text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+            # an incomplete multi-byte character decodes to U+FFFD, wait for its next token
+            if not text.endswith("\ufffd") and len(text) > self.sent[row]:
+                self.requests[row].put(text[self.sent[row]:])
+                self.sent[row] = len(text)
+            if len(self.tokens[row]) >= self.requests[row].max_new_tokens:
+                self._finish(row)
+
+    def end(self):
+        for row in range(len(self.requests)):
+            self._finish(row)
+
+    def fail(self, error):
+        for row, request in enumerate(self.requests):
+            if not self.done[row]:
+                self.done[row] = True
+                request.end(error)
+
+
+class PrefixCache:
+    """
+    past key/values of constant prompt prefixes
+    """
+    def __init__(self, model, tokenizer, device="cpu"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, prefix):
+        """
+        :return: (input_ids of shape (1, prefix tokens), past_key_values of the prefix)
+        """
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            input_ids = self.tokenizer([prefix], return_tensors="pt").input_ids.to(self.device)
+            with torch.no_grad():
+                past_key_values = self.model(input_ids=input_ids, use_cache=True).past_key_values
+            self._entries[prefix] = entry = (input_ids, past_key_values)
+            return entry
+
+
+def expand_past(past_key_values, batch_size):
+    return tuple(tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer) for layer in past_key_values)
+
+
+def prefill(model, prefix_ids, prefix_past, suffix_ids, suffix_mask):
+    """
+    runs the suffixes of a batch through the model after a cached prefix, except their last token,
+    which generate feeds itself
+    :param suffix_ids, suffix_mask: left-padded suffixes, padding sits between the prefix and the suffix
+    :return: (input_ids, attention_mask, past_key_values) for model.generate
+    """
+    batch_size = len(suffix_ids)
+    input_ids = torch.cat([prefix_ids.expand(batch_size, -1), suffix_ids], dim=1)
+    attention_mask = torch.cat([torch.ones_like(prefix_ids).expand(batch_size, -1), suffix_mask], dim=1)
+    past_key_values = expand_past(prefix_past, batch_size)
+    if suffix_ids.shape[1] > 1:
+        # positions skip the padding, like generate computes them
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        with torch.no_grad():
+            past_key_values = model(
+                input_ids=suffix_ids[:, :-1], attention_mask=attention_mask[:, :-1],
+                position_ids=position_ids[:, prefix_ids.shape[1]:-1],
+                past_key_values=past_key_values, use_cache=True,
+            ).past_key_values
+    return input_ids, attention_mask, past_key_values
+
+
+class _AllRowsDone(StoppingCriteria):
+    # stops the batch early once every request finished or was cancelled
+    def __init__(self, streamer):
+        self.streamer = streamer
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return all(self.streamer.done)
+
+
+class GenerationEngine:
+    def __init__(self, model, tokenizer, device="cpu", max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_seconds=DEFAULT_MAX_WAIT_SECONDS, max_queue=DEFAULT_MAX_QUEUE, prefix_cache=True,
+                 **generation_kwargs):
+        """
+        :param model: causal language model, used by this engine only
+        :param tokenizer: its tokenizer; prompts are padded on the left, with eos when it has no pad token
+        :param max_wait_seconds: how long a prompt may wait for others to join its batch
+        :param max_queue: prompts waiting for a batch beyond which submit blocks
+        :param prefix_cache: reuse the past key/values of prompt prefixes, else prefixes are prefilled every time
+        :param generation_kwargs: passed to every model.generate call
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.generation_kwargs = generation_kwargs
+
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self.prefix_cache = PrefixCache(model, tokenizer, device) if prefix_cache else None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopping = False
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, max_new_tokens=512, timeout=None, prefix=None):
+        """
+        :param prefix: constant start of the prompt, e.g. a template, followed by prompt
+        :param timeout: seconds to wait for room in the queue, None to wait as long as needed
+        :return: RequestStreamer of the generated text
+        """
+        if prefix is not None and self.prefix_cache is None:
+            prompt, prefix = prefix + prompt, None
+        request = RequestStreamer(prompt, max_new_tokens, prefix)
+        try:
+            self._queue.put(request, timeout=timeout)
+        except queue.Full:
+            raise EngineOverloaded(f"{self._queue.maxsize} prompts are already waiting")
+        return request
+
+    def _next_batch(self):
+        """
+        :return: the queued requests of the next batch, None once the engine is shut down
+        """
+        request = self._queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                # shut down after this batch
+                self._stopping = True
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while not self._stopping:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # a batch shares one prefix
+            batches_by_prefix = {}
+            for request in batch:
+                if not request.cancelled:
+                    batches_by_prefix.setdefault(request.prefix, []).append(request)
+            for prefix_batch in batches_by_prefix.values():
+                self._generate(prefix_batch)
+
+    def _generate(self, batch):
+        with self._stats_lock:
+            self.batches += 1
+            self.requests += len(batch)
+        streamer = BatchStreamer(self.tokenizer, batch, self.tokenizer.eos_token_id)
+        try:
+            prompts = [request.prompt for request in batch]
+            if batch[0].prefix is None:
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+            else:
+                prefix_ids, prefix_past = self.prefix_cache.get(batch[0].prefix)
+                suffixes = self.tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False)
+                suffixes = suffixes.to(self.device)
+                input_ids, attention_mask, past_key_values = prefill(
+                    self.model, prefix_ids, prefix_past, suffixes.input_ids, suffixes.attention_mask)
+                inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "past_key_values": past_key_values}
+            with torch.no_grad():
+                self.model.generate(
+                    **inputs, streamer=streamer,
+                    max_new_tokens=max(request.max_new_tokens for request in batch),
+                    stopping_criteria=StoppingCriteriaList([_AllRowsDone(streamer)]),
+                    pad_token_id=self.tokenizer.pad_token_id, **self.generation_kwargs)
+            streamer.end()
+        except Exception as e:
+            streamer.fail(e)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queued": self._queue.qsize(),
+                "batches": self.batches,
+                "requests": self.requests,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+                "prefix_hits": self.prefix_cache.hits if self.prefix_cache is not None else 0,
+                "prefix_misses": self.prefix_cache.misses if self.prefix_cache is not None else 0,
+            }
+
+    def shutdown(self):
+        """
+        finishes the queued requests and stops the worker thread
+        """
+        self._queue.put(None)
+        self._thread.join()
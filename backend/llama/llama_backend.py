@@ -0,0 +1,95 @@
+import sys
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from llama.custom_type import AIBackend
+from llama.generation_engine import GenerationEngine, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_QUEUE
+from llama.constants import (
+	PROMPT_TEMPLATE_INTERMEDIATE_FRONT,
+	PROMPT_TEMPLATE_INTERMEDIATE_BACK,
+	PROMPT_TEMPLATE_FINAL_FRONT,
+	PROMPT_TEMPLATE_FINAL_BACK,
+)
+
+
+class LLaMABackend(AIBackend):
+	"""
+	local LLaMA 2 chat model; concurrent calls are batched by one GenerationEngine
+	"""
+	model_name_or_path = "TheBloke/Llama-2-7b-Chat-GPTQ"
+	backend_name = "llama-2-7b-chat"
+
+	def __init__(self, model=None, tokenizer=None, device="cuda:0",
+		     max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_queue=DEFAULT_MAX_QUEUE, max_new_tokens=512,
+		     prefix_cache=True):
+		"""
+		:param model, tokenizer: loaded from model_name_or_path unless given, e.g. a small model on CPU
+		:param max_batch_size: prompts generated together; also the concurrency callers should use
+		:param prefix_cache: prefill the prompt templates once, see llama.generation_engine.PrefixCache
+		"""
+		if model is None:
+			model = AutoModelForCausalLM.from_pretrained(self.model_name_or_path,
+								     device_map=device,
+								     trust_remote_code=False,
+								     revision="main")
+		if tokenizer is None:
+			tokenizer = AutoTokenizer.from_pretrained(self.model_name_or_path, use_fast=True)
+		self.model = model
+		self.tokenizer = tokenizer
+		self.max_new_tokens = max_new_tokens
+		self.engine = GenerationEngine(model, tokenizer, device=device, max_batch_size=max_batch_size,
+					       max_queue=max_queue, prefix_cache=prefix_cache)
+		# enough concurrent callers to fill a batch, e.g. the leaf pass of a summary tree
+		self.max_concurrency = max_batch_size
+
+	def get_summary_from_text(self):
+		pass
+	def get_summary_from_intermediate(self):
+		pass
+	def get_quiz_from_text(self):
+		pass
+	def get_quiz_from_intermediate(self):
+		pass
+
+	def generate(self, prompt, prefix=None):
+		"""
+		:param prefix: constant template the prompt follows
+		:return: generator of (delta_content, finished), like the other backends
+		"""
+		stream = self.engine.submit(prompt, self.max_new_tokens, prefix=prefix)
+		try:
+			for new_text in stream:
+				sys.stdout.write(new_text)
+				sys.stdout.flush()
+				yield new_text, False
+		finally:
+			# an abandoned generator frees its row of the batch
+			stream.cancel()
+		yield "\n", True
+
+	def max_reduction_fan_out(self):
+		context_tokens = getattr(self.model.config, "max_position_embeddings", None)
+		if context_tokens is None:
+			return None
+		template_tokens = max(len(self.tokenizer.encode(front + back)) for front, back in (
+			(PROMPT_TEMPLATE_INTERMEDIATE_FRONT, PROMPT_TEMPLATE_INTERMEDIATE_BACK),
+			(PROMPT_TEMPLATE_FINAL_FRONT, PROMPT_TEMPLATE_FINAL_BACK),
+		))
+		# every summary is at most max_new_tokens, joined with "\n"
+		return (context_tokens - self.max_new_tokens - template_tokens) // (self.max_new_tokens + 1)
+
+	def precompute_intermediate_from_text(self, sliced_text):
+		yield from self.generate(sliced_text + PROMPT_TEMPLATE_INTERMEDIATE_BACK, prefix=PROMPT_TEMPLATE_INTERMEDIATE_FRONT)
+
+	def precompute_intermediate_from_intermediate(self, content):
+		yield from self.generate(content + PROMPT_TEMPLATE_INTERMEDIATE_BACK, prefix=PROMPT_TEMPLATE_INTERMEDIATE_FRONT)
+
+	def precompute_final_from_intermediate(self, content):
+		yield from self.generate(content + PROMPT_TEMPLATE_FINAL_BACK, prefix=PROMPT_TEMPLATE_FINAL_FRONT)
+
+	def precompute_summary_from_intermediate(self, content):
+		# the summary of everything read so far, written from the bullet points like the final summary
+		yield from self.generate(content + PROMPT_TEMPLATE_FINAL_BACK, prefix=PROMPT_TEMPLATE_FINAL_FRONT)
+
+	def shutdown(self):
+		self.engine.shutdown()
@@ -0,0 +1,151 @@
+import os
+import struct
+import threading
+import tiktoken
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+OFFSET_INDEX_MAGIC = b"ROFFIDX1"
+# magic, stride, number of characters, number of tokens, number of checkpoints
+OFFSET_INDEX_HEADER = struct.Struct("<8sIQQI")
+DEFAULT_STRIDE = 16
+
+
+def offset_index_url(book_content_url):
+    """
+    the offset index is stored next to the book, like the summary tree
+    """
+    return os.path.splitext(book_content_url)[0] + "_offsets.bin"
+
+
+class OffsetIndex:
+    """
+    Sorted checkpoints mapping character offsets of a book to token offsets.
+
+    A checkpoint is stored every `stride` tokens; positions in between are
+    linearly interpolated, so lookups are a binary search and never tokenize.
+    """
+    def __init__(self, char_offsets, token_offsets, num_chars, num_tokens, stride):
+        self.char_offsets = char_offsets
+        self.token_offsets = token_offsets
+        self.num_chars = num_chars
+        self.num_tokens = num_tokens
+        self.stride = stride
+
+    @classmethod
+    def build(cls, text, stride=DEFAULT_STRIDE, token_char_starts=None, exact_token_offsets=()):
+        """
+        :param token_char_starts: character offset of every token of text, tokenized here by default
+        :param exact_token_offsets: sorted token offsets to checkpoint besides every stride-th token,
+            e.g. where the summary tree cuts the book, so they map to characters without interpolation
+        """
+        if token_char_starts is None:
+            _, token_char_starts = tokenizer.decode_with_offsets(tokenizer.encode(text))
+        num_tokens = len(token_char_starts)
+
+        char_offsets = array('q')
+        token_offsets = array('q')
+        for token_index in merge(range(0, num_tokens, stride), exact_token_offsets):
+            if token_offsets and token_offsets[-1] == token_index:
+                continue
+            char_offset = token_char_starts[token_index]
+            # several tokens can start at the same character (multi-byte characters),
+            # keep the first one so the char offsets stay strictly increasing
+            if char_offsets and char_offsets[-1] == char_offset:
+                continue
+            char_offsets.append(char_offset)
+            token_offsets.append(token_index)
+        char_offsets.append(len(text))
+        token_offsets.append(num_tokens)
+        return cls(char_offsets, token_offsets, len(text), num_tokens, stride)
+
+    def char_to_token(self, char_index):
+        """
+        :param char_index: number of characters read
+        :return: number of tokens needed to cover book_content[:char_index]
+        """
+        char_index = min(max(char_index, 0), self.num_chars)
+        # checkpoint i is the last one starting strictly before char_index
+        i = bisect_left(self.char_offsets, char_index) - 1
+        if i < 0:
+            return 0
+        read_chars = char_index - self.char_offsets[i]
+        span_chars = self.char_offsets[i + 1] - self.char_offsets[i]
+        span_tokens = self.token_offsets[i + 1] - self.token_offsets[i]
+        # a token that starts before char_index is (partially) read, so round up
+        return self.token_offsets[i] + -(-read_chars * span_tokens // span_chars)
+
+    def token_to_char(self, token_index):
+        """
+        :param token_index: index of a token, e.g. Summary.start_idx
+        :return: character offset at which that token starts
+        """
+        token_index = min(max(token_index, 0), self.num_tokens)
+        i = bisect_right(self.token_offsets, token_index) - 1
+        if i + 1 >= len(self.token_offsets):
+            return self.num_chars
+        skipped_tokens = token_index - self.token_offsets[i]
+        span_chars = self.char_offsets[i + 1] - self.char_offsets[i]
+        span_tokens = self.token_offsets[i + 1] - self.token_offsets[i]
+        return self.char_offsets[i] + skipped_tokens * span_chars // span_tokens
+
+    def save(self, path):
+        # readers never see a partial index, and concurrent saves of the same book do not share a file
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as index_file:
+            index_file.write(OFFSET_INDEX_HEADER.pack(
+                OFFSET_INDEX_MAGIC, self.stride, self.num_chars, self.num_tokens, len(self.char_offsets)))
+            self.char_offsets.tofile(index_file)
+            self.token_offsets.tofile(index_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as index_file:
+            magic, stride, num_chars, num_tokens, count = OFFSET_INDEX_HEADER.unpack(
+                index_file.read(OFFSET_INDEX_HEADER.size))
+            if magic != OFFSET_INDEX_MAGIC:
+                raise ValueError(f"{path} is not an offset index")
+            char_offsets = array('q')
+            char_offsets.fromfile(index_file, count)
+            token_offsets = array('q')
+            token_offsets.fromfile(index_file, count)
+        return cls(char_offsets, token_offsets, num_chars, num_tokens, stride)
+
+
+def build_offset_index(book_content_url, book_content):
+    """
+    builds the offset index of a book and persists it next to the book content
+    """
+    offset_index = OffsetIndex.build(book_content)
+    offset_index.save(offset_index_url(book_content_url))
+    return offset_index
+
+
+def load_offset_index(book_content_url, book_content):
+    """
+    :return: the stored offset index of a book, None when it is missing or does not match book_content
+    """
+    try:
+        offset_index = OffsetIndex.load(offset_index_url(book_content_url))
+    except (OSError, ValueError):
+        return None
+    if offset_index.num_chars != len(book_content):
+        return None
+    return offset_index
+
+
+def get_offset_index(book_content_url, book_content):
+    """
+    loads the offset index of a book, building it for books uploaded before indexes existed
+    """
+    offset_index = load_offset_index(book_content_url, book_content)
+    if offset_index is not None:
+        return offset_index
+    try:
+        return build_offset_index(book_content_url, book_content)
+    except OSError:
+        return OffsetIndex.build(book_content)
@@ -0,0 +1,253 @@
+"""
+Speculative prefetch of summaries from reading progress.
+
+Every progress update of a book refines an estimate of the reader's speed.
+When the reader is predicted to cross the next leaf boundary of the summary
+tree within PREFETCH_LEAD_SECONDS, the summary at that boundary is generated
+in the background and stored in the result cache, so asking for a summary
+there replays it instead of waiting for the model.
+
+Progress updates only refine the speed; finding the boundary and scheduling
+its prefetch run on a small pool of their own, behind user requests. Each
+user may spend at most PREFETCH_USER_BUDGET_TOKENS tokens per
+PREFETCH_BUDGET_WINDOW_SECONDS on them. Set PREFETCH_ENABLED=0 to turn
+prefetching off.
+"""
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from llama.result_cache import result_cache, ResultKey, SUMMARY
+from llama.request_pipeline import get_content_hash, get_leaf_content, locate_reader
+from llama.response_cache import tokenizer
+from llama.custom_type import ProxyAIBackend
+from llama.backend_registry import get_backend
+from llama.constants import GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE
+
+DEFAULT_LEAD_SECONDS = 120.0
+DEFAULT_USER_BUDGET_TOKENS = 20000
+DEFAULT_BUDGET_WINDOW_SECONDS = 24 * 60 * 60
+DEFAULT_WORKERS = 2
+# progress updates waiting for a worker beyond this are dropped
+DEFAULT_MAX_PENDING = 32
+# weight of the newest sample in the reading speed
+SPEED_SMOOTHING = 0.3
+# updates further apart than this belong to different reading sessions
+MAX_SAMPLE_GAP_SECONDS = 10 * 60
+
+
+class ReadingState:
+    __slots__ = ("progress", "observed_at", "speed")
+
+    def __init__(self, progress, observed_at):
+        self.progress = progress
+        self.observed_at = observed_at
+        # progress per second, None until two updates of one session were seen
+        self.speed = None
+
+    def update(self, progress, observed_at):
+        elapsed = observed_at - self.observed_at
+        if 0 < elapsed <= MAX_SAMPLE_GAP_SECONDS and progress > self.progress:
+            sample = (progress - self.progress) / elapsed
+            self.speed = sample if self.speed is None else \
+                SPEED_SMOOTHING * sample + (1 - SPEED_SMOOTHING) * self.speed
+        elif elapsed > MAX_SAMPLE_GAP_SECONDS or progress < self.progress:
+            # a new session, or the reader jumped back
+            self.speed = None
+        self.progress = progress
+        self.observed_at = observed_at
+
+
+class UserBudget:
+    """
+    tokens spent by one user within a sliding window
+    """
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._spent = deque()
+        self.total = 0
+
+    def spent(self, now):
+        while self._spent and now - self._spent[0][0] >= self.window_seconds:
+            self.total -= self._spent.popleft()[1]
+        return self.total
+
+    def charge(self, now, tokens):
+        self._spent.append((now, tokens))
+        self.total += tokens
+
+
+class PrefetchScheduler:
+    def __init__(self, ai_backend=None, result_cache=result_cache, lead_seconds=DEFAULT_LEAD_SECONDS,
+                 user_budget_tokens=DEFAULT_USER_BUDGET_TOKENS, budget_window_seconds=DEFAULT_BUDGET_WINDOW_SECONDS,
+                 max_workers=DEFAULT_WORKERS, max_pending=DEFAULT_MAX_PENDING, clock=time.monotonic):
+        """
+        :param ai_backend: backend generating the summaries, the one named by AI_BACKEND by default,
+            created on the first prefetch
+        :param lead_seconds: how long before the predicted crossing of a boundary its summary is generated
+        :param user_budget_tokens: prompt and completion tokens a user may spend on prefetches per window
+        """
+        self._ai_backend = ai_backend
+        self._ai_backend_lock = threading.Lock()
+        self.result_cache = result_cache
+        self.lead_seconds = lead_seconds
+        self.user_budget_tokens = user_budget_tokens
+        self.budget_window_seconds = budget_window_seconds
+        self.max_pending = max_pending
+        self.clock = clock
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._readers = {}
+        self._budgets = {}
+        self._in_flight = set()
+        self._pending = 0
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.over_budget = 0
+        self.dropped = 0
+
+    @property
+    def ai_backend(self):
+        with self._ai_backend_lock:
+            if self._ai_backend is None:
+                self._ai_backend = ProxyAIBackend(get_backend())
+            return self._ai_backend
+
+    def observe(self, email, book_id, progress, book_content_url, summary_tree_url):
+        """
+        records a progress update. Once the reader's speed is known, whether the next leaf boundary is close
+        enough to prefetch its summary is decided on the prefetch pool, off the caller's thread.
+        :param summary_tree_url: None for books without a summary tree, which have nothing to prefetch
+        :return: future resolving to True once the summary is prefetched and to None when there is nothing
+            to prefetch, or None when the speed is unknown or too many updates are waiting
+        """
+        now = self.clock()
+        with self._lock:
+            state = self._readers.get((email, book_id))
+            if state is None:
+                # readers of ended sessions, and budgets with nothing spent in their window, are forgotten
+                # when a new session starts
+                for reader in [reader for reader, other in self._readers.items()
+                               if now - other.observed_at > MAX_SAMPLE_GAP_SECONDS]:
+                    del self._readers[reader]
+                for idle_email in [idle_email for idle_email, budget in self._budgets.items() if not budget.spent(now)]:
+                    del self._budgets[idle_email]
+                self._readers[(email, book_id)] = state = ReadingState(progress, now)
+            else:
+                state.update(progress, now)
+            speed = state.speed
+            if summary_tree_url is None or speed is None:
+                return None
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return None
+            self._pending += 1
+        return self._executor.submit(self._schedule, email, progress, speed, now, book_content_url, summary_tree_url)
+
+    def _schedule(self, email, progress, speed, now, book_content_url, summary_tree_url):
+        try:
+            prefetch = self._plan(email, progress, speed, now, book_content_url, summary_tree_url)
+        except Exception as e:
+            print(f"EXCEPTION IN PREFETCH {e}")
+            with self._lock:
+                self.failed += 1
+            return None
+        finally:
+            with self._lock:
+                self._pending -= 1
+        if prefetch is None:
+            return None
+        return self._prefetch(email, *prefetch)
+
+    def _plan(self, email, progress, speed, now, book_content_url, summary_tree_url):
+        """
+        :return: (key, content) of the summary to prefetch, charged to the user's budget, or None
+        """
+        boundary = self.next_boundary(progress, book_content_url, summary_tree_url)
+        if boundary is None:
+            return None
+        boundary_progress, summary_tree, leaf = boundary
+        if (boundary_progress - progress) / speed > self.lead_seconds:
+            return None
+
+        key = ResultKey(get_content_hash(book_content_url), leaf.node_id, 0, SUMMARY, self.ai_backend.backend_name)
+        if self.result_cache.contains(key):
+            return None
+        content = get_leaf_content(summary_tree, leaf)
+        prompt_tokens = len(tokenizer.encode(content))
+        with self._lock:
+            if key in self._in_flight:
+                return None
+            budget = self._budgets.setdefault(email, UserBudget(self.budget_window_seconds))
+            if budget.spent(now) + prompt_tokens > self.user_budget_tokens:
+                self.over_budget += 1
+                return None
+            budget.charge(now, prompt_tokens)
+            self._in_flight.add(key)
+            self.scheduled += 1
+        return key, content
+
+    def next_boundary(self, progress, book_content_url, summary_tree_url):
+        """
+        :return: (progress at the start of the next leaf, summary tree, next leaf), or None in the last leaf
+        """
+        book_content, offset_index, _, summary_tree, leaf = locate_reader(
+            progress, book_content_url, summary_tree_url)
+        if leaf is None:
+            return None
+        next_leaf = summary_tree.find_leaf_summary(word_index=leaf.end_idx + 1)
+        if next_leaf is None or next_leaf.node_id == leaf.node_id:
+            return None
+        return offset_index.token_to_char(next_leaf.start_idx) / len(book_content), summary_tree, next_leaf
+
+    def _prefetch(self, email, key, content):
+        try:
+            started = time.perf_counter()
+            deltas = [delta_content for delta_content, finished
+                      in self.ai_backend.precompute_summary_from_intermediate(content) if not finished]
+            self.result_cache.put(key, self.ai_backend.backend_name,
+                                  GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, content,
+                                  deltas, time.perf_counter() - started)
+            completion_tokens = len(tokenizer.encode("".join(deltas)))
+            with self._lock:
+                self._budgets.setdefault(email, UserBudget(self.budget_window_seconds)).charge(
+                    self.clock(), completion_tokens)
+                self.completed += 1
+            return True
+        except Exception as e:
+            # best effort, the reader's own request generates the summary instead
+            print(f"EXCEPTION IN PREFETCH {e}")
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "readers": len(self._readers),
+                "budgets": len(self._budgets),
+                "pending": self._pending,
+                "in_flight": len(self._in_flight),
+                "scheduled": self.scheduled,
+                "completed": self.completed,
+                "failed": self.failed,
+                "over_budget": self.over_budget,
+                "dropped": self.dropped,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+prefetch_scheduler = PrefetchScheduler(
+    lead_seconds=float(os.environ.get("PREFETCH_LEAD_SECONDS", DEFAULT_LEAD_SECONDS)),
+    user_budget_tokens=int(os.environ.get("PREFETCH_USER_BUDGET_TOKENS", DEFAULT_USER_BUDGET_TOKENS)),
+    budget_window_seconds=float(os.environ.get("PREFETCH_BUDGET_WINDOW_SECONDS", DEFAULT_BUDGET_WINDOW_SECONDS)),
+    max_workers=int(os.environ.get("PREFETCH_WORKERS", DEFAULT_WORKERS)),
+) if os.environ.get("PREFETCH_ENABLED", "1") == "1" else None
@@ -3,10 +3,25 @@ import pickle
 from custom_type import Summary
 import tiktoken
 import openai
-import mysql.connector
 import os
 import math
-from llama.custom_type import ProxyAIBackend, GPT4Backend, GPT3Backend, LLaMABackend
+import time
+import threading
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from llama.custom_type import ProxyAIBackend, GPT4Backend, GPT3Backend
+from llama.backend_registry import get_backend
+from llama.summary_cache import summary_cache
+from llama.progress_tracker import progress_tracker
+from llama.summary_tree_format import SUMMARY_TREE_EXTENSION, write_summary_tree
+from llama.content_store import content_hash
+from llama.offset_index import load_offset_index
+from llama.boundary_index import load_boundary_index
+from llama.chunking import MAX_SIZE, get_number_of_slices, slice_bounds
+from llama.request_pipeline import get_leaf_content
+from llama.result_cache import result_cache, ResultKey, SUMMARY
+from llama.constants import GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE
 
 from tenacity import (
     retry,
@@ -19,7 +34,17 @@ def completion_with_backoff(**kwargs):
     return openai.ChatCompletion.create(**kwargs)
 
 tokenizer = tiktoken.get_encoding("cl100k_base")
-MAX_SIZE = 3900
+# characters tokenized at a time when splitting a book
+WINDOW_CHARS = 1 << 16
+# number of summaries generated at the same time for one book
+BOOK_CONCURRENCY = int(os.environ.get("SUMMARY_BOOK_CONCURRENCY", 8))
+# number of summaries generated at the same time by this process, across all books
+INFERENCE_CONCURRENCY = int(os.environ.get("SUMMARY_INFERENCE_CONCURRENCY", 16))
+# children summarized by one reduction, a number or "budget" for as many as fit in the context of the model
+BUDGET_FAN_OUT = "budget"
+REDUCTION_FAN_OUT = os.environ.get("SUMMARY_REDUCTION_FAN_OUT", "2")
+# store the summary at the start of every leaf in the result cache once a tree is built
+PRECOMPUTE_RESULTS = os.environ.get("SUMMARY_PRECOMPUTE_RESULTS", "0") == "1"
 
 # FINAL_SYSTEM_SUMMARY_PROMPT='''
 # Hello again, ChatGPT. 
@@ -42,98 +67,229 @@ def update_summary_path_url(books_db, book_id, summary_path_url):
     cursor.execute(f"UPDATE Books SET summary_tree = '{summary_path_url}' WHERE id = {book_id}")
     books_db.commit()
 
-def update_num_current_inference(books_db, book_id):
+def update_inference_progress(books_db, book_id, num_current_inference, num_total_inference):
     cursor = books_db.cursor()
-    cursor.execute(f"UPDATE Books SET num_current_inference = num_current_inference + 1 WHERE id = {book_id}")
+    cursor.execute(f"UPDATE Books SET num_total_inference = {num_total_inference}, "
+                   f"num_current_inference = {num_current_inference} WHERE id = {book_id}")
     books_db.commit()
 
-def update_num_total_inference(books_db, book_id, num_total_inference):
-    cursor = books_db.cursor()
-    cursor.execute(f"UPDATE Books SET num_total_inference = {num_total_inference} WHERE id = {book_id}")
-    books_db.commit()
-    cursor.execute(f"UPDATE Books SET num_current_inference = {0} WHERE id = {book_id}")
-    books_db.commit()
-
-def get_number_of_inferences(num_splits):
+def persist_inference_progress(db_pool, book_id):
+    """
+    :return: persist callback of progress_tracker.start writing to the Books table
+    """
+    def persist(num_current_inference, num_total_inference):
+        with db_pool.connection() as books_db:
+            update_inference_progress(books_db, book_id, num_current_inference, num_total_inference)
+    return persist
+
+def get_number_of_inferences(num_splits, fan_out=2, capped=False):
+    """
+    :param fan_out: children per reduction, see split_list
+    :param capped: reductions take at most fan_out children, see build_reduction_plan
+    :return: number of summaries generated for a tree with num_splits leaves
+    """
     assert num_splits >= 0
-    if num_splits == 0:
-        return 0
-    return num_splits + get_number_of_inferences(num_splits//2)
-
-def split_large_text(story):
-    tokens = tokenizer.encode(story)
-    # calculate the number of splits
-    number_of_splits = math.ceil(len(tokens) / MAX_SIZE)
-    # Division by 0 is theoretically possible if len(tokens) == 0
-    # However, uploading an empty txt file is not allowed
-    # from the frontend, so this should never happen.
-
-    # divide the tokens evenly across the number of splits
-    start_end_indices = [len(tokens)//number_of_splits] * number_of_splits
-    # add the remainder evenly across the splits
-    remainder = len(tokens) % number_of_splits
-    while remainder:
-        for i in reversed(range(number_of_splits)):
-            if remainder:
-                start_end_indices[i] += 1
-                remainder -= 1
-            else:
+    num_inferences = num_splits
+    while num_splits > 1:
+        if capped:
+            num_groups = -(-num_splits // fan_out)
+            # groups of a single summary join the next level without a reduction
+            num_inferences += min(num_groups, num_splits - num_groups)
+            num_splits = num_groups
+            continue
+        # every level reduces its summaries to num_splits // fan_out groups
+        num_splits = num_splits // fan_out or 1
+        num_inferences += num_splits
+    return num_inferences
+
+
+def get_fan_out(proxy_ai_backend, fan_out):
+    """
+    :param fan_out: children per reduction, or BUDGET_FAN_OUT for as many as fit in one
+        reduction request to the backend, see AIBackend.max_reduction_fan_out.
+        The budget fan-out caps the reductions at that many children, see build_reduction_plan.
+    :return: children per reduction, at least 2
+    """
+    if fan_out == BUDGET_FAN_OUT:
+        fan_out = proxy_ai_backend.max_reduction_fan_out() or 2
+    return max(int(fan_out), 2)
+
+
+def get_fallback(fan_out, capped=False, fallback=GPT3Backend):
+    """
+    :param capped: reductions take at most fan_out children, otherwise up to 2 * fan_out - 1, see split_list
+    :return: fallback, the backend class precompute_with_retry falls back to, or None when the largest
+        reduction does not fit in its context, e.g. with the budget fan-out of GPT-4
+    """
+    max_children = fan_out if capped else 2 * fan_out - 1
+    if max_children > (fallback().max_reduction_fan_out() or 2):
+        return None
+    return fallback
+
+def is_token_boundary(text, index):
+    """
+    no piece of the cl100k_base pre-tokenizer holds a letter followed by another character,
+    so the text on both sides of such a position is tokenized independently
+    """
+    return text[index - 1].isalpha() and not text[index].isalpha()
+
+
+def iter_token_windows(text, window_chars=WINDOW_CHARS):
+    """
+    tokenizes text a window of about window_chars characters at a time
+    :return: generator of token lists which, concatenated, are tokenizer.encode(text)
+    """
+    start = 0
+    while start < len(text):
+        size = window_chars
+        while True:
+            end = start + size
+            if end >= len(text):
+                yield tokenizer.encode(text[start:])
+                return
+            cut = end
+            while cut > start and not is_token_boundary(text, cut):
+                cut -= 1
+            if cut > start:
                 break
-
-    sliced_lists = []
-    for i, current in enumerate(start_end_indices):
-        start_idx = sum(start_end_indices[:i])
-        end_idx = sum(start_end_indices[:i+1])
+            # no boundary in the window, e.g. a long run of letters
+            size *= 2
+        yield tokenizer.encode(text[start:cut])
+        start = cut
+
+
+def count_tokens(text, window_chars=WINDOW_CHARS):
+    return sum(len(tokens) for tokens in iter_token_windows(text, window_chars))
+
+
+def iter_slices(story, num_tokens=None, window_chars=WINDOW_CHARS, boundary_index=None):
+    """
+    splits a book into slices of at most MAX_SIZE tokens, yielding each one as soon as it is tokenized.
+    With num_tokens only about one slice and one window of tokens are held at a time.
+    :param num_tokens: number of tokens of story, e.g. OffsetIndex.num_tokens.
+        When None every token is read before the first slice is yielded.
+    :param boundary_index: BoundaryIndex of story, to cut at sentences, paragraphs and headings, see slice_bounds
+    :return: generator of {"sliced_text", "start_idx", "end_idx"}, end_idx included
+    """
+    if num_tokens is None and boundary_index is not None:
+        num_tokens = boundary_index.num_tokens
+    windows = iter_token_windows(story, window_chars)
+    buffer = array('I')
+    # token index of buffer[0]
+    offset = 0
+    if num_tokens is None:
+        for tokens in windows:
+            buffer.extend(tokens)
+        num_tokens = len(buffer)
+
+    for start_idx, end_idx in slice_bounds(num_tokens, boundary_index):
+        while offset + len(buffer) < end_idx:
+            tokens = next(windows, None)
+            if tokens is None:
+                raise ValueError(f"story has {offset + len(buffer)} tokens, expected {num_tokens}")
+            buffer.extend(tokens)
         sliced_story = {
-            "sliced_text": tokenizer.decode(tokens[start_idx:end_idx]), "start_idx": start_idx, "end_idx": end_idx-1
+            "sliced_text": tokenizer.decode(buffer[start_idx - offset:end_idx - offset].tolist()),
+            "start_idx": start_idx, "end_idx": end_idx - 1
         }
-        sliced_lists.append(sliced_story)
-        print("start_idx: ", start_idx, "end_idx: ", end_idx-1)
-    return sliced_lists
-
-
-def split_list(input_list):
+        print("start_idx: ", start_idx, "end_idx: ", end_idx - 1)
+        yield sliced_story
+        # drop the sliced tokens once they are half of the buffer, so dropping stays linear overall
+        if 2 * (end_idx - offset) >= len(buffer):
+            del buffer[:end_idx - offset]
+            offset = end_idx
+
+    if offset + len(buffer) > num_tokens or next(windows, None) is not None:
+        raise ValueError(f"story has more than {num_tokens} tokens")
+
+
+def split_large_text(story, num_tokens=None, boundary_index=None):
+    # Empty books have no slices. Uploading an empty txt file is not
+    # allowed from the frontend, so this should never happen.
+    return list(iter_slices(story, num_tokens, boundary_index=boundary_index))
+
+
+def split_list(input_list, split_size=2, capped=False):
+    """
+    groups the items in order, split_size per group. The items left over are spread
+    one per group from the last group backwards, so groups hold fewer than 2 * split_size items.
+    Capped groups hold at most split_size items: the items are spread evenly over
+    ceil(len(input_list) / split_size) groups, the longer groups last.
+    """
     if not input_list:
         return []
-    split_size = 2
+
+    if capped:
+        num_groups = -(-len(input_list) // split_size)
+        size, longer = divmod(len(input_list), num_groups)
+        output_list = []
+        start_idx = 0
+        for i in range(num_groups):
+            end_idx = start_idx + size + (i >= num_groups - longer)
+            output_list.append(input_list[start_idx:end_idx])
+            start_idx = end_idx
+        return output_list
 
     # split the input_list into groups
     num_groups = len(input_list) // split_size
-    remainder = len(input_list) % split_size
 
-    # if num_groups 0, but remainder is 1,
-    # we will run into an infinite loop when 
-    # distributing the remainder.
+    # with fewer items than split_size, they all go to one group
     if num_groups == 0:
         return [input_list]
 
-    output_sizes = []
+    # spread remainder: every group gets `extra` more, the last `longer` groups one more again
+    extra, longer = divmod(len(input_list) % split_size, num_groups)
     output_list = []
     start_idx = 0
     for i in range(num_groups):
-        output_sizes.append(split_size)
-        start_idx += split_size
-
-    # spread remainder
-    if remainder:
-        while remainder:
-            for i in reversed(range(num_groups)):
-                if remainder:
-                    output_sizes[i] += 1
-                    start_idx += 1
-                    remainder -= 1
-                else:
-                    break
-
-    # create output_list
-    for i in range(num_groups):
-        output_list.append(input_list[:output_sizes[i]])
-        input_list = input_list[output_sizes[i]:]
-
+        end_idx = start_idx + split_size + extra + (i >= num_groups - longer)
+        output_list.append(input_list[start_idx:end_idx])
+        start_idx = end_idx
     return output_list
 
 
-def reduce_multiple_summaries_to_one(proxy_ai_backend, books_db, book_id, summary_list, is_intermediate):
+def precompute_with_retry(proxy_ai_backend, precompute_name, content, fallback=GPT3Backend):
+    """
+    runs one precompute call of the proxy backend and collects the streamed response.
+    After 5 failed attempts this call falls back to the fallback backend. The proxy is shared
+    by the other calls in flight and keeps its backend.
+    :param precompute_name: name of the AIBackend.precompute_* method to call
+    :param fallback: backend class to fall back to, None to keep retrying the same backend, see get_fallback
+    """
+    ai_backend = proxy_ai_backend
+    for attempt in range(10):
+        response = ""
+        try:
+            for delta_content, finished in getattr(ai_backend, precompute_name)(content):
+                delta_content = "\n" if (finished) else delta_content
+                response += delta_content
+            return response
+        except Exception as e:
+            if attempt == 5 and fallback is not None:
+                ai_backend = fallback()
+            print(f"EXCEPTION IN {precompute_name.upper()} {e}")
+    raise RuntimeError(f"{precompute_name} failed 10 times")
+
+
+def get_concurrency(proxy_ai_backend, max_workers):
+    """
+    caps the requested parallelism by what the backend supports
+    """
+    if proxy_ai_backend.max_concurrency is not None:
+        max_workers = min(max_workers, proxy_ai_backend.max_concurrency)
+    return max(max_workers, 1)
+
+
+def summarize_leaf(proxy_ai_backend, sliced_text_dict, fallback=GPT3Backend):
+    response = precompute_with_retry(proxy_ai_backend, "precompute_intermediate_from_text", sliced_text_dict["sliced_text"],
+                                     fallback)
+    return Summary(summary_content=response,
+                   start_idx=sliced_text_dict["start_idx"],
+                   end_idx=sliced_text_dict["end_idx"],
+                   children=[])
+
+
+def reduce_multiple_summaries_to_one(proxy_ai_backend, summary_list, is_intermediate, fallback=GPT3Backend):
     summary_content_list = [summary.summary_content for summary in summary_list]
     reduced_start_idx = min([summary.start_idx for summary in summary_list])
     reduced_end_idx = max([summary.end_idx for summary in summary_list])
@@ -141,35 +297,10 @@ def reduce_multiple_summaries_to_one(proxy_ai_backend, books_db, book_id, summar
     print("CONTENT INPUT TO REDUCE MULTIPLE SUMMARIES TO ONE: ", content)
 
     if is_intermediate:
-        response = ""
-        for attempt in range(10):
-            try:
-                for delta_content, finished in proxy_ai_backend.precompute_intermediate_from_intermediate(content):
-                    delta_content = "\n" if (finished) else delta_content
-                    response += delta_content
-
-            except Exception as e:
-                if attempt == 5:
-                    proxy_ai_backend.summary_generator = GPT3Backend()
-                print("EXCEPTION IN REDUCE_MULTIPLE_SUMMARIES_TO_ONE INTERMEDIATE " + e)
-                continue
-            break
+        response = precompute_with_retry(proxy_ai_backend, "precompute_intermediate_from_intermediate", content, fallback)
     else:
-        response = ""
-        for attempt in range(10):
-            try:
-                for delta_content, finished in proxy_ai_backend.precompute_final_from_intermediate(content):
-                    delta_content = "\n" if (finished) else delta_content
-                    response += delta_content
-
-            except Exception as e:
-                if attempt == 5:
-                    proxy_ai_backend.summary_generator = GPT3Backend()
-                print("EXCEPTION IN REDUCE_MULTIPLE_SUMMARIES_TO_ONE FINAL " + e)
-                continue
-            break
+        response = precompute_with_retry(proxy_ai_backend, "precompute_final_from_intermediate", content, fallback)
 
-    update_num_current_inference(books_db, book_id)
     reduced_summary = Summary(summary_content=response,
                               start_idx=reduced_start_idx, end_idx=reduced_end_idx, children=summary_list)
     for summary in summary_list:
@@ -177,61 +308,335 @@ def reduce_multiple_summaries_to_one(proxy_ai_backend, books_db, book_id, summar
     return reduced_summary
 
 
-def reduce_summaries_list(proxy_ai_backend, books_db, book_id, summaries_list):
-    while len(summaries_list) > 1:
-        double_paired_list = split_list(summaries_list)
-        summaries_list = [reduce_multiple_summaries_to_one(proxy_ai_backend, books_db, book_id, double_pair, is_intermediate=(
-            len(summaries_list) > 3)) for double_pair in double_paired_list]
-    return summaries_list[0]
-
-
-def generate_summary_tree(book_id, story):
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-
-    summaries_list = []
-    sliced_text_dict_list = split_large_text(story)
-    num_total_inferences = get_number_of_inferences(len(sliced_text_dict_list))
-
-    if num_total_inferences == 1:
-        update_num_total_inference(books_db, book_id, 1)
-        update_num_current_inference(books_db, book_id)
-        return
-    proxy_ai_backend = ProxyAIBackend(GPT4Backend())
-    update_num_total_inference(books_db, book_id, num_total_inferences)
-
-    for prompt in sliced_text_dict_list:
-        response = ""
-        for attempt in range(10):
-            try:
-                for delta_content, finished in proxy_ai_backend.precompute_intermediate_from_text(prompt["sliced_text"]):
-                    delta_content = "\n" if (finished) else delta_content
-                    response += delta_content
-                update_num_current_inference(books_db, book_id)
-                first_level_summary = Summary(summary_content=response,
-                                        start_idx=prompt["start_idx"],
-                                        end_idx=prompt["end_idx"])
-                summaries_list.append(first_level_summary)
-            except Exception as e:
-                if attempt == 5:
-                    proxy_ai_backend.summary_generator = GPT3Backend()
-                print("EXCEPTION IN INTERMEDAITE FROM TEXT " + e)
+ReductionNode = namedtuple("ReductionNode", ["node_id", "children", "is_intermediate"])
+
+
+def build_reduction_plan(num_leaves, fan_out=2, capped=False):
+    """
+    lays out the reductions of a tree with num_leaves leaves, level by level.
+    Leaves are nodes 0..num_leaves-1 and reductions are numbered after them,
+    so the last node of the plan is the root.
+    :param fan_out: children per reduction, see split_list
+    :param capped: reductions take at most fan_out children, e.g. all that fit in the context.
+        A group of a single node is not reduced, the node joins the next level.
+    """
+    plan = []
+    level = list(range(num_leaves))
+    next_node_id = num_leaves
+    while len(level) > 1:
+        groups = split_list(level, fan_out, capped)
+        # the last reduction summarizes the whole book, not just a passage
+        is_intermediate = len(groups) > 1
+        next_level = []
+        for children in groups:
+            if len(children) == 1:
+                next_level.append(children[0])
                 continue
-            break
+            plan.append(ReductionNode(next_node_id, children, is_intermediate))
+            next_level.append(next_node_id)
+            next_node_id += 1
+        level = next_level
+    return plan
+
+
+_inference_executor = None
+_inference_executor_lock = threading.Lock()
+
+
+def get_inference_executor():
+    """
+    worker pool shared by every summary tree built in this process
+    """
+    global _inference_executor
+    with _inference_executor_lock:
+        if _inference_executor is None:
+            _inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_CONCURRENCY, thread_name_prefix="summary")
+        return _inference_executor
+
+
+class SummaryTreeScheduler:
+    """
+    Builds a summary tree as a dataflow graph: every node is submitted to the
+    shared worker pool as soon as its children are summarized, instead of
+    waiting for the whole level, so the critical path is the depth of the tree.
+    """
+    def __init__(self, proxy_ai_backend, db_pool, book_id, max_workers=BOOK_CONCURRENCY, executor=None,
+                 on_node_complete=None, progress=None, fan_out=REDUCTION_FAN_OUT, capped=False):
+        """
+        :param max_workers: maximum number of this book's nodes in flight at the same time
+        :param executor: worker pool to run on, the shared inference pool by default
+        :param on_node_complete: called with (node_id, summary) after each node is summarized,
+            e.g. to checkpoint it. An exception raised by the callback aborts the run.
+        :param progress: progress_tracker.JobProgress advanced once per summarized node.
+            By default run() tracks the book itself, persisting to the Books table, and finishes it.
+        :param fan_out: children per reduction, or BUDGET_FAN_OUT, see get_fan_out.
+            Checkpoints only resume a run with the same fan-out, which numbers the nodes the same way.
+            Failing calls only fall back to GPT-3.5 when its context fits the fan-out, see get_fallback.
+        :param capped: reductions take at most fan_out children, see build_reduction_plan.
+            Always true for BUDGET_FAN_OUT.
+        """
+        self.proxy_ai_backend = proxy_ai_backend
+        self.db_pool = db_pool
+        self.book_id = book_id
+        self.max_workers = get_concurrency(proxy_ai_backend, max_workers)
+        self.capped = capped or fan_out == BUDGET_FAN_OUT
+        self.fan_out = get_fan_out(proxy_ai_backend, fan_out)
+        self.fallback = get_fallback(self.fan_out, self.capped)
+        self.executor = executor or get_inference_executor()
+        self.on_node_complete = on_node_complete
+        self.progress = progress
+
+        self._lock = threading.Lock()
+        # leaves are pulled from their iterator by the workers, one at a time
+        self._leaves_lock = threading.Lock()
+        self._done = threading.Event()
+        self._ready = deque()
+        self._in_flight = 0
+        self._error = None
+
+    def run(self, leaves, checkpoints=None, num_leaves=None):
+        """
+        :param leaves: sliced text dicts to summarize, or Summary objects that are already summarized
+        :param checkpoints: {node_id: (start_idx, end_idx, summary_content)} of nodes
+            finished by an earlier run, which are restored instead of summarized again
+        :param num_leaves: number of leaves, which makes leaves an iterable of sliced text dicts
+            read lazily, e.g. iter_slices: the first leaves are summarized while the next are produced
+        :return: root Summary of the tree
+        """
+        if num_leaves is None:
+            leaves = list(leaves)
+            num_leaves = len(leaves)
+        if not num_leaves:
+            raise ValueError("a summary tree needs at least one leaf")
+        plan = build_reduction_plan(num_leaves, self.fan_out, self.capped)
+        self._num_leaves = num_leaves
+        self._unread_leaves = enumerate(leaves)
+        # leaves read from the iterator before the worker summarizing them asked for them
+        self._read_leaves = {}
+        self._skipped_leaves = set()
+        self._nodes = {node.node_id: node for node in plan}
+        self._parents = {child: node.node_id for node in plan for child in node.children}
+        self._remaining_children = {node.node_id: len(node.children) for node in plan}
+        self._root_id = plan[-1].node_id if plan else 0
+        self._summaries = {}
+
+        checkpoints = checkpoints or {}
+        with self._lock:
+            for leaf_id in range(num_leaves):
+                if leaf_id in checkpoints:
+                    self._skipped_leaves.add(leaf_id)
+                    self._complete(leaf_id, self._restore(leaf_id, checkpoints[leaf_id]))
+                elif isinstance(leaves, list) and not isinstance(leaves[leaf_id], dict):
+                    self._skipped_leaves.add(leaf_id)
+                    self._complete(leaf_id, leaves[leaf_id])
+                else:
+                    self._ready.append(leaf_id)
+            # children are checkpointed before their parent, so plan order restores bottom up
+            for node in plan:
+                if node.node_id in checkpoints:
+                    self._complete(node.node_id, self._restore(node.node_id, checkpoints[node.node_id]))
+            self._ready = deque(node_id for node_id in self._ready if node_id not in self._summaries)
+
+        progress = self.progress
+        if progress is None:
+            self._progress = progress_tracker.start(
+                self.book_id, num_leaves + len(plan), len(self._summaries),
+                persist=persist_inference_progress(self.db_pool, self.book_id))
+        else:
+            self._progress = progress
+        self._submit_ready()
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        if progress is None:
+            self._progress.finish()
+        return self._summaries[self._root_id]
+
+    def _read_leaf(self, leaf_id):
+        with self._leaves_lock:
+            while leaf_id not in self._read_leaves:
+                read_id, leaf = next(self._unread_leaves, (None, None))
+                if read_id is None:
+                    raise ValueError(f"expected {self._num_leaves} leaves, got fewer")
+                if read_id not in self._skipped_leaves:
+                    self._read_leaves[read_id] = leaf
+            return self._read_leaves.pop(leaf_id)
+
+    def _summarize_node(self, node_id):
+        if node_id < self._num_leaves:
+            return summarize_leaf(self.proxy_ai_backend, self._read_leaf(node_id), self.fallback)
+        node = self._nodes[node_id]
+        children = [self._summaries[child] for child in node.children]
+        return reduce_multiple_summaries_to_one(self.proxy_ai_backend, children, node.is_intermediate, self.fallback)
+
+    def _restore(self, node_id, checkpoint):
+        start_idx, end_idx, summary_content = checkpoint
+        children = [] if node_id < self._num_leaves else [self._summaries[child] for child in self._nodes[node_id].children]
+        summary = Summary(summary_content=summary_content, start_idx=start_idx, end_idx=end_idx, children=children)
+        for child in children:
+            child.parent = summary
+        return summary
+
+    def _complete(self, node_id, summary):
+        # must hold self._lock
+        self._summaries[node_id] = summary
+        if node_id == self._root_id:
+            self._done.set()
+            return
+        parent = self._parents[node_id]
+        self._remaining_children[parent] -= 1
+        if self._remaining_children[parent] == 0:
+            # reductions go first: they are on the critical path
+            self._ready.appendleft(parent)
+
+    def _run_node(self, node_id):
+        try:
+            summary = self._summarize_node(node_id)
+            if self.on_node_complete is not None:
+                self.on_node_complete(node_id, summary)
+            self._progress.advance()
+        except Exception as e:
+            with self._lock:
+                self._in_flight -= 1
+                self._error = self._error or e
+                self._done.set()
+            return
+        with self._lock:
+            self._in_flight -= 1
+            self._complete(node_id, summary)
+        # the finished node may have made its parent ready
+        self._submit_ready()
+
+    def _submit_ready(self):
+        with self._lock:
+            while self._ready and self._in_flight < self.max_workers and self._error is None:
+                self._in_flight += 1
+                self.executor.submit(self._run_node, self._ready.popleft())
+
+
+def reduce_summaries_list(proxy_ai_backend, db_pool, book_id, summaries_list):
+    return SummaryTreeScheduler(proxy_ai_backend, db_pool, book_id).run(summaries_list)
+
+
+def precompute_leaf_results(proxy_ai_backend, story, summary_tree, result_cache=result_cache):
+    """
+    answers the summary request at the start of every leaf ahead of time, i.e. the summary of
+    everything before the leaf, and stores it as the first progress bucket of the leaf in the result cache
+    :param story: full text of the book, whose hash keys the results
+    :param summary_tree: FlatSummaryTree of the book
+    :return: number of summaries generated
+    """
+    book_hash = content_hash(story)
+
+    def precompute(leaf_id):
+        leaf = summary_tree.node(leaf_id)
+        key = ResultKey(book_hash, leaf_id, 0, SUMMARY, proxy_ai_backend.backend_name)
+        # nothing is summarized before the first leaf
+        if not summary_tree.find_included_summaries(leaf) or result_cache.contains(key):
+            return 0
+        content = get_leaf_content(summary_tree, leaf)
+        started = time.perf_counter()
+        # no fallback: the answer of another backend would be stored where requests to this one never look
+        response = precompute_with_retry(proxy_ai_backend, "precompute_summary_from_intermediate", content, None)
+        # stored like a streamed answer, without the final "\n"
+        result_cache.put(key, proxy_ai_backend.backend_name, GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE, content,
+                         [response[:-1]], time.perf_counter() - started)
+        return 1
+
+    return sum(get_inference_executor().map(precompute, summary_tree.leaf_nodes))
+
+
+def generate_summary_tree(book_id, story, db_pool, max_workers=BOOK_CONCURRENCY,
+                          proxy_ai_backend=None, checkpoints=None, on_node_complete=None, on_progress=None,
+                          precompute_results=PRECOMPUTE_RESULTS, num_tokens=None, fan_out=REDUCTION_FAN_OUT,
+                          checkpoint_fan_out=None, on_fan_out=None):
+    """
+    builds the summary tree of a book and stores it next to the book content
+    :param book_id: id of the book in the Books table
+    :param story: full text of the book
+    :param db_pool: database.DatabasePool used for progress updates
+    :param max_workers: maximum number of summaries of this book generated at the same time
+    :param proxy_ai_backend: backend to summarize with, the one named by AI_BACKEND (GPT-4) by default
+    :param checkpoints: nodes finished by an interrupted run, see SummaryTreeScheduler.run
+    :param on_node_complete: see SummaryTreeScheduler
+    :param on_progress: called with (num_current_inference, num_total_inference) after every inference.
+        The Books table itself is only updated every few seconds, see llama.progress_tracker.
+    :param precompute_results: also run precompute_leaf_results once the tree is published
+    :param num_tokens: number of tokens of story, read from its offset index or counted by default
+    :param fan_out: children per reduction, or BUDGET_FAN_OUT, see get_fan_out
+    :param checkpoint_fan_out: (fan-out, capped) of the run that made the checkpoints. They are ignored when
+        it is not the one resolved for this run, whose nodes are numbered differently.
+    :param on_fan_out: called with the resolved fan-out and capped before any node is summarized,
+        e.g. to record them with the checkpoints
+    """
+    user_dirname = f"/home/swpp/readability_users/"
+    with db_pool.connection() as books_db:
+        book_content_url = get_book_content_url(books_db, book_id)
+    # books uploaded before boundary indexes existed are cut at even token counts
+    boundary_index = load_boundary_index(os.path.join(user_dirname, book_content_url), story)
+    if num_tokens is None and boundary_index is not None:
+        num_tokens = boundary_index.num_tokens
+    if num_tokens is None:
+        offset_index = load_offset_index(os.path.join(user_dirname, book_content_url), story)
+        num_tokens = offset_index.num_tokens if offset_index is not None else count_tokens(story)
+    num_leaves = get_number_of_slices(num_tokens)
+
+    def finish_without_inference(num_total_inferences):
+        # reported like a finished build, so the job queue, this process and the Books table all read it done
+        progress_tracker.start(book_id, num_total_inferences, num_total_inferences,
+                               persist=persist_inference_progress(db_pool, book_id), on_change=on_progress).finish()
+
+    if num_leaves == 1:
+        # the only slice is its own summary
+        finish_without_inference(1)
+        return
 
-    single_summary = reduce_summaries_list(proxy_ai_backend, books_db, book_id, summaries_list)
-    book_content_url = get_book_content_url(books_db, book_id)
-    summary_path_url = book_content_url.split('.')[0] + "_summary.pkl"
-    update_summary_path_url(books_db, book_id, summary_path_url)
+    proxy_ai_backend = proxy_ai_backend or ProxyAIBackend(get_backend())
+    capped = fan_out == BUDGET_FAN_OUT
+    fan_out = get_fan_out(proxy_ai_backend, fan_out)
+    num_total_inferences = get_number_of_inferences(num_leaves, fan_out, capped)
+    summary_path_url = book_content_url.split('.')[0] + "_summary" + SUMMARY_TREE_EXTENSION
+    if os.path.exists(os.path.join(user_dirname, summary_path_url)):
+        # identical content was summarized for another upload, share its tree
+        with db_pool.connection() as books_db:
+            update_summary_path_url(books_db, book_id, summary_path_url)
+        finish_without_inference(num_total_inferences)
+        return
 
-    user_dirname = f"/home/swpp/readability_users/"
-    summary_path_url = os.path.join(user_dirname, summary_path_url)
-    with open(summary_path_url, 'wb') as pickle_file:
-        pickle.dump(single_summary, pickle_file)
+    checkpoints = checkpoints or {}
+    if checkpoints and checkpoint_fan_out != (fan_out, capped):
+        print(f"IGNORING {len(checkpoints)} CHECKPOINTS OF FAN-OUT {checkpoint_fan_out}, "
+              f"THIS RUN HAS FAN-OUT {(fan_out, capped)}")
+        checkpoints = {}
+    if on_fan_out is not None:
+        on_fan_out(fan_out, capped)
+    progress = progress_tracker.start(book_id, num_total_inferences, len(checkpoints),
+                                      persist=persist_inference_progress(db_pool, book_id), on_change=on_progress)
+
+    scheduler = SummaryTreeScheduler(proxy_ai_backend, db_pool, book_id, max_workers=max_workers,
+                                     on_node_complete=on_node_complete, progress=progress, fan_out=fan_out,
+                                     capped=capped)
+    # leaves are summarized while the rest of the book is being tokenized
+    single_summary = scheduler.run(iter_slices(story, num_tokens, boundary_index=boundary_index), checkpoints,
+                                   num_leaves=num_leaves)
+
+    summary_tree = single_summary.to_flat()
+    if boundary_index is not None:
+        summary_tree.leaf_boundaries = array('b', (boundary_index.kind_at(start_idx)
+                                                   for start_idx in summary_tree.leaf_start_idxs))
+    # write the tree before publishing its path, so readers never see a missing file
+    write_summary_tree(summary_tree, os.path.join(user_dirname, summary_path_url))
+    summary_cache.invalidate(os.path.join(user_dirname, summary_path_url))
+    with db_pool.connection() as books_db:
+        update_summary_path_url(books_db, book_id, summary_path_url)
+    progress.finish()
+
+    if precompute_results:
+        # the tree is already published: a failed precompute leaves its answers to be generated on request
+        try:
+            precompute_leaf_results(proxy_ai_backend, story, summary_tree)
+        except Exception as e:
+            print(f"EXCEPTION IN PRECOMPUTE_LEAF_RESULTS {e!r}")
 
 
 # def main():
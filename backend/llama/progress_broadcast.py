@@ -0,0 +1,108 @@
+"""
+Summary progress of a book, read once per book for all its subscribers.
+
+The workers building summary trees run in other processes, so the API server
+reads their progress from the job queue (and the Books table for old books).
+Instead of every SSE subscriber reading it on its own, the first subscriber of
+a book starts one poll of the book, which hands every change to all of its
+subscribers. The poll stops once the build is no longer active, or once its
+last subscriber has gone away.
+
+Polls live on the event loop of the server, like llama.single_flight.
+"""
+import asyncio
+
+from llama.summary_jobs import ACTIVE_STATUSES
+
+# seconds between two progress reads of a book, whatever its number of subscribers
+DEFAULT_POLL_SECONDS = 0.5
+
+
+class BookPoll:
+    def __init__(self):
+        # latest progress dict read, and how many different ones were read
+        self.progress = None
+        self.version = 0
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        # set and replaced whenever progress, done or error change
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class ProgressBroadcast:
+    def __init__(self, poll_seconds=DEFAULT_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._polls = {}
+        self.reads = 0
+
+    async def _run(self, book_id, poll, read):
+        try:
+            while True:
+                progress = await asyncio.get_running_loop().run_in_executor(None, read)
+                self.reads += 1
+                if progress != poll.progress:
+                    poll.progress = progress
+                    poll.version += 1
+                    poll.notify()
+                if progress["status"] not in ACTIVE_STATUSES:
+                    return
+                await asyncio.sleep(self.poll_seconds)
+        except Exception as e:
+            poll.error = e
+        finally:
+            poll.done = True
+            if self._polls.get(book_id) is poll:
+                del self._polls[book_id]
+            poll.notify()
+
+    async def subscribe(self, book_id, read):
+        """
+        streams the progress of a book, joining its poll if there is one
+        :param read: no-argument blocking callable returning the progress dict of the book, with a "status".
+            It runs on the default executor, off the event loop.
+        :return: async generator of the latest progress dict whenever it changed, starting with the current one
+            and ending after the first one whose status is not active
+        """
+        poll = self._polls.get(book_id)
+        if poll is None:
+            poll = self._polls[book_id] = BookPoll()
+            poll.task = asyncio.create_task(self._run(book_id, poll, read))
+        poll.subscribers += 1
+
+        version = 0
+        try:
+            while True:
+                changed = poll.changed
+                if poll.version != version:
+                    version = poll.version
+                    yield poll.progress
+                    if poll.progress["status"] not in ACTIVE_STATUSES:
+                        return
+                    continue
+                if poll.done:
+                    if poll.error is not None:
+                        raise poll.error
+                    return
+                await changed.wait()
+        finally:
+            poll.subscribers -= 1
+            if poll.subscribers == 0 and not poll.done:
+                # nobody is left to read the progress of this book
+                if self._polls.get(book_id) is poll:
+                    del self._polls[book_id]
+                poll.task.cancel()
+
+    def stats(self):
+        return {
+            "polled_books": len(self._polls),
+            "reads": self.reads,
+        }
+
+
+progress_broadcast = ProgressBroadcast()
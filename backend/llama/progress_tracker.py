@@ -0,0 +1,137 @@
+"""
+In-memory progress of summary tree builds.
+
+Each build owns one JobProgress, its single writer. Every finished node is
+recorded in memory and reported to a cheap local sink (the job queue), while
+MySQL is written only every SUMMARY_PROGRESS_FLUSH_SECONDS and when the
+build finishes, instead of once per LLM call. Readers use read_progress,
+which never touches MySQL.
+"""
+import os
+import time
+import threading
+
+from llama.summary_jobs import RUNNING, DONE
+
+DEFAULT_FLUSH_SECONDS = 5.0
+# finished builds stay readable for this long, so late subscribers still see them complete
+FINISHED_RETENTION_SECONDS = 60.0
+
+
+class JobProgress:
+    def __init__(self, tracker, book_id, num_total, num_current, persist, on_change, flush_seconds):
+        self.tracker = tracker
+        self.book_id = book_id
+        self.num_total = num_total
+        self.num_current = num_current
+        self.status = RUNNING
+        self.finished_at = None
+        self.persist = persist
+        self.on_change = on_change
+        self.flush_seconds = flush_seconds
+
+        self._persist_lock = threading.Lock()
+        self._persisted = None
+        self._last_flush = float("-inf")
+
+    def snapshot(self):
+        return {
+            "book_id": self.book_id,
+            "num_current_inference": self.num_current,
+            "num_total_inference": self.num_total,
+            "status": self.status,
+        }
+
+    def advance(self, num_inferences=1):
+        """
+        records finished inferences, persisting to MySQL if the last flush is old enough
+        """
+        with self.tracker._lock:
+            self.num_current = min(self.num_current + num_inferences, self.num_total)
+            num_current = self.num_current
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+            if due:
+                self._last_flush = time.monotonic()
+        if self.on_change is not None:
+            self.on_change(num_current, self.num_total)
+        if due:
+            self._persist(num_current)
+
+    def finish(self):
+        with self.tracker._lock:
+            self.num_current = self.num_total
+            self.status = DONE
+            self.finished_at = time.monotonic()
+        if self.on_change is not None:
+            self.on_change(self.num_total, self.num_total)
+        self._persist(self.num_total)
+
+    def _persist(self, num_current):
+        if self.persist is None:
+            return
+        with self._persist_lock:
+            # concurrent writers may flush out of order, never move progress backwards
+            if self._persisted is not None and num_current <= self._persisted:
+                return
+            self.persist(num_current, self.num_total)
+            self._persisted = num_current
+
+
+class ProgressTracker:
+    def __init__(self, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        self.flush_seconds = flush_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def start(self, book_id, num_total, num_current=0, persist=None, on_change=None):
+        """
+        registers a build and persists its starting point
+        :param persist: called with (num_current, num_total) at coarse intervals and on finish, e.g. a MySQL update
+        :param on_change: called with (num_current, num_total) on every change
+        :return: JobProgress, the writer of this build's progress
+        """
+        progress = JobProgress(self, book_id, num_total, num_current, persist, on_change, self.flush_seconds)
+        with self._lock:
+            now = time.monotonic()
+            for finished_book_id in [other_book_id for other_book_id, other in self._jobs.items()
+                                     if other.finished_at is not None
+                                     and now - other.finished_at > FINISHED_RETENTION_SECONDS]:
+                del self._jobs[finished_book_id]
+            self._jobs[book_id] = progress
+        if on_change is not None:
+            on_change(num_current, num_total)
+        progress._persist(num_current)
+        progress._last_flush = time.monotonic()
+        return progress
+
+    def get(self, book_id):
+        """
+        :return: snapshot dict of a build running (or recently finished) in this process, or None
+        """
+        with self._lock:
+            progress = self._jobs.get(book_id)
+            return progress.snapshot() if progress is not None else None
+
+
+def read_progress(book_id, job_queue=None):
+    """
+    progress of a book from this process's tracker, or else from the job queue
+    shared with the summary workers
+    :return: dict like JobProgress.snapshot, with a job queue status, or None if neither knows the book.
+        num_total_inference is 0 until a worker starts the job.
+    """
+    snapshot = progress_tracker.get(book_id)
+    if snapshot is not None or job_queue is None:
+        return snapshot
+    job_status = job_queue.status(book_id)
+    if job_status is None:
+        return None
+    return {
+        "book_id": book_id,
+        "num_current_inference": job_status["num_current_inference"],
+        "num_total_inference": job_status["num_total_inference"],
+        "status": job_status["status"],
+    }
+
+
+progress_tracker = ProgressTracker(float(os.environ.get("SUMMARY_PROGRESS_FLUSH_SECONDS", DEFAULT_FLUSH_SECONDS)))
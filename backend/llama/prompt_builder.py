@@ -0,0 +1,118 @@
+"""
+Token budgets of chat prompts.
+
+A request must leave room for its answer within the model's context window:
+
+    system prompt + user content + message overhead + output budget <= context
+
+fit_content counts the tokens of the user content once and, when it does not
+fit, keeps only the most recently read tokens. The prepare stage
+(llama.request_pipeline.prepare_request) first falls back to the summary tree
+of the book when the raw text is too long. prompt_report keeps the prompt
+token counts of every request, per model.
+"""
+import threading
+from functools import lru_cache
+from collections import namedtuple
+
+import tiktoken
+
+# tokens of the context window
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 4096,
+}
+# tokens reserved for the answer, also sent as max_tokens
+MODEL_OUTPUT_TOKENS = {
+    "gpt-4": 1024,
+    "gpt-3.5-turbo": 1024,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+DEFAULT_OUTPUT_TOKENS = 1024
+# role and separator tokens of a system and a user message, plus the priming of the reply
+MESSAGE_OVERHEAD_TOKENS = 11
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+# content: the content that fits, num_tokens: its tokens, trimmed_tokens: tokens removed from the start
+FittedContent = namedtuple("FittedContent", ["content", "num_tokens", "trimmed_tokens"])
+
+
+def output_budget(model):
+    return MODEL_OUTPUT_TOKENS.get(model, DEFAULT_OUTPUT_TOKENS)
+
+
+@lru_cache(maxsize=64)
+def count_system_prompt_tokens(system_prompt):
+    # system prompts are constants, counted once
+    return len(tokenizer.encode(system_prompt))
+
+
+def content_budget(model, system_prompt):
+    """
+    :return: tokens left for the user content of a request to model
+    """
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    return context_tokens - output_budget(model) - count_system_prompt_tokens(system_prompt) - MESSAGE_OVERHEAD_TOKENS
+
+
+def reduction_fan_out(model, system_prompts):
+    """
+    :param system_prompts: system prompts of the reduction requests
+    :return: summaries that fit in the user content of one reduction request to model,
+        counting every summary at the output budget, the longest it can be
+    """
+    budget = min(content_budget(model, system_prompt) for system_prompt in system_prompts)
+    # summaries are joined with "\n"
+    return budget // (output_budget(model) + 1)
+
+
+def prompt_tokens(system_prompt, content_tokens):
+    """
+    :return: tokens of a request, given the tokens of its user content
+    """
+    return count_system_prompt_tokens(system_prompt) + content_tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_content(content, max_tokens=None):
+    """
+    :param max_tokens: tokens the content may use, None for no limit
+    :return: FittedContent
+    """
+    tokens = tokenizer.encode(content)
+    if max_tokens is None or len(tokens) <= max_tokens:
+        return FittedContent(content, len(tokens), 0)
+    # the end of the text is where the reader is, drop the oldest tokens
+    trimmed_tokens = len(tokens) - max(max_tokens, 0)
+    kept = tokens[trimmed_tokens:]
+    return FittedContent(tokenizer.decode(kept), len(kept), trimmed_tokens)
+
+
+class PromptReport:
+    """
+    prompt tokens of the requests to every model
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model, prompt_tokens, trimmed_tokens=0, fell_back=False):
+        with self._lock:
+            stats = self._models.setdefault(model, {
+                "requests": 0, "prompt_tokens": 0, "max_prompt_tokens": 0, "trimmed": 0, "fallbacks": 0,
+            })
+            stats["requests"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["max_prompt_tokens"] = max(stats["max_prompt_tokens"], prompt_tokens)
+            stats["trimmed"] += trimmed_tokens > 0
+            stats["fallbacks"] += fell_back
+
+    def stats(self):
+        with self._lock:
+            return {
+                model: dict(stats, mean_prompt_tokens=stats["prompt_tokens"] / stats["requests"])
+                for model, stats in self._models.items()
+            }
+
+
+prompt_report = PromptReport()
@@ -0,0 +1,261 @@
+"""
+Request-time stages of /summary and /quiz.
+
+The prepare stage (reading the book, loading the summary tree, offset
+lookups) builds the user content of a request. It runs on a thread or process
+pool, so the event loop only waits for the finished prompt:
+
+    PREPARE_POOL=thread|process     kind of pool (default thread)
+    PREPARE_POOL_WORKERS=4          number of workers
+
+Every stage reports its timing to stage_timings, so prepare latency and model
+latency (first token, whole stream) can be told apart.
+"""
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from functools import lru_cache
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from llama.summary_cache import summary_cache
+from llama.content_store import content_hash
+from llama.prompt_builder import fit_content
+from llama.summary_tree_format import SUMMARY_TREE_EXTENSION
+
+# content kinds: the raw text read so far, or the summaries of the summary tree plus the current leaf
+TEXT = "text"
+INTERMEDIATE = "intermediate"
+
+DEFAULT_POOL_KIND = "thread"
+DEFAULT_POOL_WORKERS = 4
+# answers within the same fraction of a leaf share a result, see llama.result_cache
+BUCKETS_PER_LEAF = int(os.environ.get("RESULT_CACHE_BUCKETS_PER_LEAF", 4))
+
+# content: user content of the request
+# content_hash, leaf_id, bucket: where the reader is, the key of llama.result_cache
+# num_tokens: tokens of content, trimmed_tokens: tokens cut to fit the budget,
+# fell_back: whether raw text too long for the budget was replaced by the summary tree
+PreparedRequest = namedtuple("PreparedRequest", [
+    "content", "content_hash", "leaf_id", "bucket", "num_tokens", "trimmed_tokens", "fell_back"
+])
+
+
+def get_bucket(position, start, end):
+    """
+    :return: which of BUCKETS_PER_LEAF equal parts of [start, end] position falls in
+    """
+    if end <= start:
+        return 0
+    return min(int((position - start) / (end - start) * BUCKETS_PER_LEAF), BUCKETS_PER_LEAF - 1)
+
+
+@lru_cache(maxsize=4096)
+def _content_hash(book_content_url, mtime_ns):
+    return content_hash(summary_cache.get_book_content(book_content_url))
+
+
+def summary_tree_url_for(book_content_url):
+    """
+    :return: where generate_summary_tree stores the summary tree of a book
+    """
+    return os.path.splitext(book_content_url)[0] + "_summary" + SUMMARY_TREE_EXTENSION
+
+
+def get_content_hash(book_content_url):
+    """
+    sha256 of a book, computed once per version of the file
+    """
+    return _content_hash(book_content_url, os.stat(book_content_url).st_mtime_ns)
+
+
+def locate_reader(progress, book_content_url, summary_tree_url):
+    """
+    :return: (book_content, offset_index, char_index, summary_tree, leaf) for the reader at progress
+    """
+    book_content = summary_cache.get_book_content(book_content_url)
+    summary_tree = summary_cache.get_summary_tree(summary_tree_url)
+    offset_index = summary_cache.get_offset_index(book_content_url)
+
+    # char_index -> the number of characters read by the user.
+    # start_index, end_idx is the number of tokens processed by the summary
+    char_index = int(progress * len(book_content))
+    word_index = max(offset_index.char_to_token(char_index) - 1, 0)
+
+    leaf = summary_tree.find_leaf_summary(word_index=word_index)
+    return book_content, offset_index, char_index, summary_tree, leaf
+
+
+def get_intermediate_content(progress, book_content_url, summary_tree_url):
+    """
+    builds the user content of a request from the summary tree:
+    the summaries of everything fully read, followed by the raw text read within the current leaf
+    :param progress: progress of the book
+    :param book_content_url: path of the book content
+    :param summary_tree_url: path of the summary tree
+    """
+    book_content, offset_index, char_index, summary_tree, leaf = locate_reader(
+        progress, book_content_url, summary_tree_url)
+    return get_leaf_content(summary_tree, leaf, book_content[offset_index.token_to_char(leaf.start_idx):char_index])
+
+
+def get_leaf_content(summary_tree, leaf, read_leaf_text=""):
+    """
+    :param read_leaf_text: raw text read within the leaf, empty at the start of the leaf
+    """
+    available_summary_list = summary_tree.find_included_summaries(leaf)
+    content = "\n\n".join([summary.summary_content for summary in available_summary_list])
+    content += "\n\n" + read_leaf_text
+    return content
+
+
+def get_text_content(progress, book_content_url):
+    """
+    :return: the raw text read so far
+    """
+    book_content = summary_cache.get_book_content(book_content_url)
+    word_index = int(progress * len(book_content))
+    return book_content[:word_index]
+
+
+def prepare_content(kind, progress, book_content_url, summary_tree_url=None):
+    """
+    the prepare stage; a top-level function so it can run in a process pool
+    :param kind: TEXT or INTERMEDIATE
+    """
+    if kind == TEXT:
+        return get_text_content(progress, book_content_url)
+    if kind == INTERMEDIATE:
+        return get_intermediate_content(progress, book_content_url, summary_tree_url)
+    raise ValueError(f"unknown content kind {kind!r}")
+
+
+def prepare_request(kind, progress, book_content_url, summary_tree_url=None, max_content_tokens=None,
+                    fallback_max_content_tokens=None):
+    """
+    like prepare_content, also locating the reader for the result cache and fitting the content in a token budget
+    :param summary_tree_url: for TEXT, a tree to fall back to, by default the one next to the book if it exists
+    :param max_content_tokens: tokens the content may use, see llama.prompt_builder.content_budget
+    :param fallback_max_content_tokens: tokens the content of a TEXT request that falls back to the tree may use,
+        the budget of the INTERMEDIATE system prompt it is answered with. max_content_tokens by default
+    :return: PreparedRequest
+    """
+    if kind == TEXT:
+        fitted = fit_content(get_text_content(progress, book_content_url), max_content_tokens)
+        fallback_tree_url = summary_tree_url or summary_tree_url_for(book_content_url)
+        if fitted.trimmed_tokens and os.path.exists(fallback_tree_url):
+            if fallback_max_content_tokens is None:
+                fallback_max_content_tokens = max_content_tokens
+            prepared = prepare_request(INTERMEDIATE, progress, book_content_url, fallback_tree_url,
+                                       fallback_max_content_tokens)
+            return prepared._replace(fell_back=True)
+        # books without a tree are a single leaf
+        return PreparedRequest(fitted.content, get_content_hash(book_content_url), 0, get_bucket(progress, 0.0, 1.0),
+                               fitted.num_tokens, fitted.trimmed_tokens, False)
+    if kind != INTERMEDIATE:
+        raise ValueError(f"unknown content kind {kind!r}")
+    book_content, offset_index, char_index, summary_tree, leaf = locate_reader(
+        progress, book_content_url, summary_tree_url)
+    leaf_start_char = offset_index.token_to_char(leaf.start_idx)
+    leaf_end_char = offset_index.token_to_char(leaf.end_idx + 1)
+    fitted = fit_content(get_leaf_content(summary_tree, leaf, book_content[leaf_start_char:char_index]),
+                         max_content_tokens)
+    return PreparedRequest(fitted.content, get_content_hash(book_content_url), leaf.node_id,
+                           get_bucket(char_index, leaf_start_char, leaf_end_char),
+                           fitted.num_tokens, fitted.trimmed_tokens, False)
+
+
+class StageTimings:
+    """
+    count, total and max seconds of every request stage
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            count, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(longest, seconds))
+
+    def stats(self):
+        with self._lock:
+            return {
+                stage: {
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count,
+                    "max_seconds": longest,
+                }
+                for stage, (count, total, longest) in self._stages.items()
+            }
+
+
+stage_timings = StageTimings()
+
+
+class PreparePool:
+    def __init__(self, kind=DEFAULT_POOL_KIND, max_workers=DEFAULT_POOL_WORKERS):
+        """
+        :param kind: "thread", or "process" to keep CPU-heavy preparation off the server's GIL.
+            Each process has its own summary cache.
+        """
+        if kind not in ("thread", "process"):
+            raise ValueError(f"kind must be 'thread' or 'process', got {kind!r}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    # spawned workers only import this module, not torch or the server
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="prepare")
+            return self._executor
+
+    async def prepare(self, kind, progress, book_content_url, summary_tree_url=None, max_content_tokens=None,
+                      fallback_max_content_tokens=None):
+        """
+        runs prepare_request on the pool, recording the "prepare" stage
+        :return: PreparedRequest
+        """
+        started = time.perf_counter()
+        prepared = await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), prepare_request, kind, progress, book_content_url, summary_tree_url,
+            max_content_tokens, fallback_max_content_tokens)
+        stage_timings.record("prepare", time.perf_counter() - started)
+        return prepared
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+async def timed_stream(stream):
+    """
+    passes a (delta_content, finished) async generator through, recording the
+    "model_first_token" and "model_stream" stages
+    """
+    started = time.perf_counter()
+    first_token = True
+    async for item in stream:
+        if first_token:
+            stage_timings.record("model_first_token", time.perf_counter() - started)
+            first_token = False
+        yield item
+    stage_timings.record("model_stream", time.perf_counter() - started)
+
+
+prepare_pool = PreparePool(
+    os.environ.get("PREPARE_POOL", DEFAULT_POOL_KIND),
+    int(os.environ.get("PREPARE_POOL_WORKERS", DEFAULT_POOL_WORKERS)),
+)
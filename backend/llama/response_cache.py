@@ -0,0 +1,268 @@
+"""
+Content-addressed cache of LLM responses.
+
+A response is stored under the sha256 of its full request (model, system
+prompt, user content), so a retried job or a second upload of the same book
+replays the first answer instead of paying for it again. Entries are JSON
+files sharded by the first two hex digits of the key, shared by every process
+using the same directory, and evicted least recently used once the directory
+grows past max_bytes.
+
+Configured with LLM_RESPONSE_CACHE_DIR, LLM_RESPONSE_CACHE_MAX_BYTES and
+LLM_RESPONSE_CACHE_MODE:
+    read_write  serve hits, store misses (default)
+    replay      serve hits only, a miss raises ResponseCacheMiss
+    off         always call the provider
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+
+import tiktoken
+
+DEFAULT_CACHE_DIR = "/home/swpp/readability_users/llm_cache"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# eviction frees space down to this fraction of max_bytes, so it does not run on every store
+LOW_WATERMARK = 0.9
+
+READ_WRITE = "read_write"
+REPLAY = "replay"
+OFF = "off"
+MODES = (READ_WRITE, REPLAY, OFF)
+
+# dollars per 1K (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+
+class ResponseCacheMiss(Exception):
+    pass
+
+
+def request_key(model, system_prompt, user_content):
+    request = json.dumps([model, system_prompt, user_content], ensure_ascii=False)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def request_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def make_entry(model, system_prompt, user_content, deltas, generation_seconds):
+    """
+    :param deltas: streamed delta contents, without the final "\\n"
+    :param generation_seconds: time the provider took to stream the response
+    """
+    prompt_tokens = len(tokenizer.encode(system_prompt)) + len(tokenizer.encode(user_content))
+    completion_tokens = len(tokenizer.encode("".join(deltas)))
+    return {
+        "model": model,
+        "deltas": deltas,
+        "generation_seconds": generation_seconds,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost": request_cost(model, prompt_tokens, completion_tokens),
+    }
+
+
+class EntryStore:
+    """
+    directory of JSON response entries shared by every process using it,
+    evicted least recently used once it grows past max_bytes
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, mode=READ_WRITE):
+        """
+        :param directory: where entries are stored, created on first store
+        :param max_bytes: size of the directory above which the least recently used entries are removed
+        :param mode: one of MODES
+        """
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mode = mode
+
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+        self.dollars_saved = 0.0
+
+    def _load(self, path):
+        """
+        :return: the entry stored at path, or None
+        """
+        if self.mode == OFF:
+            return None
+        try:
+            with open(path, 'r') as entry_file:
+                entry = json.load(entry_file)
+            # the mtime is the recency used by eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.seconds_saved += entry["generation_seconds"]
+            self.dollars_saved += entry["cost"]
+        return entry
+
+    def _store(self, path, entry):
+        if self.mode != READ_WRITE:
+            return
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, 'wb') as entry_file:
+            entry_file.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.stores += 1
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            else:
+                self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, os.path.join(dirpath, filename)))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # must hold self._lock. Rescans the directory, which other processes write to as well.
+        entries = sorted(self._entries())
+        self._total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._total_bytes <= self.max_bytes * LOW_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "seconds_saved": self.seconds_saved,
+                "dollars_saved": self.dollars_saved,
+            }
+
+
+class ResponseCache(EntryStore):
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, mode=READ_WRITE):
+        super().__init__(directory, max_bytes, mode)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, model, system_prompt, user_content):
+        """
+        :return: the cached entry of a request, or None
+        """
+        return self._load(self._path(request_key(model, system_prompt, user_content)))
+
+    def put(self, model, system_prompt, user_content, deltas, generation_seconds):
+        """
+        stores a complete response
+        :param deltas: streamed delta contents, without the final "\\n"
+        :param generation_seconds: time the provider took to stream the response
+        """
+        if self.mode != READ_WRITE:
+            return
+        self._store(self._path(request_key(model, system_prompt, user_content)),
+                    make_entry(model, system_prompt, user_content, deltas, generation_seconds))
+
+    def stream(self, model, system_prompt, user_content, generate):
+        """
+        streams the response of a request, replaying it from the cache when possible
+        :param generate: no-argument callable returning the provider's (delta_content, finished) generator
+        :return: generator of (delta_content, finished), like AIBackend methods
+        """
+        entry = self.get(model, system_prompt, user_content)
+        if entry is not None:
+            for delta_content in entry["deltas"]:
+                yield delta_content, False
+            yield "\n", True
+            return
+        if self.mode == REPLAY:
+            raise ResponseCacheMiss(f"{model} response not cached in replay mode")
+
+        deltas = []
+        started = time.perf_counter()
+        for delta_content, finished in generate():
+            yield delta_content, finished
+            if finished:
+                # only complete responses are stored, an abandoned stream is not
+                self.put(model, system_prompt, user_content, deltas, time.perf_counter() - started)
+                return
+            deltas.append(delta_content)
+
+    async def astream(self, model, system_prompt, user_content, agenerate):
+        """
+        async variant of stream. Cache reads and writes, file I/O and tokenization, run on the default executor.
+        :param agenerate: no-argument callable returning the provider's async generator of (delta_content, finished)
+        """
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, self.get, model, system_prompt, user_content)
+        if entry is not None:
+            for delta_content in entry["deltas"]:
+                yield delta_content, False
+            yield "\n", True
+            return
+        if self.mode == REPLAY:
+            raise ResponseCacheMiss(f"{model} response not cached in replay mode")
+
+        deltas = []
+        started = time.perf_counter()
+        async for delta_content, finished in agenerate():
+            yield delta_content, finished
+            if finished:
+                await loop.run_in_executor(None, self.put, model, system_prompt, user_content, deltas,
+                                           time.perf_counter() - started)
+                return
+            deltas.append(delta_content)
+
+
+response_cache = ResponseCache(
+    os.environ.get("LLM_RESPONSE_CACHE_DIR", DEFAULT_CACHE_DIR),
+    max_bytes=int(os.environ.get("LLM_RESPONSE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    mode=os.environ.get("LLM_RESPONSE_CACHE_MODE", READ_WRITE),
+)
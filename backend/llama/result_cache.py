@@ -0,0 +1,96 @@
+"""
+Cache of /summary and /quiz answers by reading position.
+
+Readers at nearly the same place of the same book get nearly the same answer,
+so answers are stored under (book content hash, leaf of the summary tree,
+progress bucket within the leaf, kind, backend) rather than the exact prompt. The
+first answer generated for a bucket is replayed, as a stream, to every later
+reader in it. Each leaf is split into RESULT_CACHE_BUCKETS_PER_LEAF buckets,
+see llama.request_pipeline.get_bucket.
+
+Entries are stored like the response cache and configured with
+LLM_RESULT_CACHE_DIR, LLM_RESULT_CACHE_MAX_BYTES and LLM_RESULT_CACHE_MODE.
+With SUMMARY_PRECOMPUTE_RESULTS=1, summary workers also store the summary at
+the start of every leaf once the book's tree is built, see
+llama.preprocess_summary.precompute_leaf_results.
+"""
+import os
+import time
+import asyncio
+from collections import namedtuple
+
+from llama.response_cache import (
+    EntryStore, ResponseCacheMiss, make_entry, DEFAULT_MAX_BYTES, READ_WRITE, REPLAY
+)
+
+DEFAULT_CACHE_DIR = "/home/swpp/readability_users/result_cache"
+
+SUMMARY = "summary"
+QUIZ = "quiz"
+
+# leaf_id: node id of the leaf in the summary tree, 0 for books without a tree
+# backend: AIBackend.backend_name of the answer, so no backend serves another's answers
+ResultKey = namedtuple("ResultKey", ["content_hash", "leaf_id", "bucket", "kind", "backend"])
+
+
+class ResultCache(EntryStore):
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, mode=READ_WRITE):
+        super().__init__(directory, max_bytes, mode)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.content_hash[:2], key.content_hash, key.backend,
+                            f"{key.kind}-{key.leaf_id}-{key.bucket}.json")
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """
+        :return: the cached entry of a ResultKey, or None
+        """
+        return self._load(self._path(key))
+
+    def put(self, key, model, system_prompt, user_content, deltas, generation_seconds):
+        """
+        stores a complete answer
+        :param model, system_prompt, user_content: the request that generated it, for its cost
+        :param deltas: streamed delta contents, without the final "\\n"
+        """
+        if self.mode != READ_WRITE:
+            return
+        self._store(self._path(key), make_entry(model, system_prompt, user_content, deltas, generation_seconds))
+
+    async def astream(self, key, model, system_prompt, user_content, agenerate):
+        """
+        streams the answer of a request, replaying the answer of its bucket when there is one.
+        Cache reads and writes run on the default executor, off the event loop.
+        :param agenerate: no-argument callable returning an async generator of (delta_content, finished)
+        :return: async generator of (delta_content, finished), like AIBackend methods
+        """
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, self.get, key)
+        if entry is not None:
+            for delta_content in entry["deltas"]:
+                yield delta_content, False
+            yield "\n", True
+            return
+        if self.mode == REPLAY:
+            raise ResponseCacheMiss(f"{key.kind} of leaf {key.leaf_id} not cached in replay mode")
+
+        deltas = []
+        started = time.perf_counter()
+        async for delta_content, finished in agenerate():
+            yield delta_content, finished
+            if finished:
+                # only complete answers are stored, an abandoned stream is not
+                await loop.run_in_executor(None, self.put, key, model, system_prompt, user_content, deltas,
+                                           time.perf_counter() - started)
+                return
+            deltas.append(delta_content)
+
+
+result_cache = ResultCache(
+    os.environ.get("LLM_RESULT_CACHE_DIR", DEFAULT_CACHE_DIR),
+    max_bytes=int(os.environ.get("LLM_RESULT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+    mode=os.environ.get("LLM_RESULT_CACHE_MODE", READ_WRITE),
+)
@@ -0,0 +1,100 @@
+"""
+Coalescing of identical in-flight generations.
+
+While a prompt is being answered, every other request for the same prompt
+(model, system prompt, user content) subscribes to the running stream instead
+of starting its own: it gets the deltas already produced, then the live ones.
+The upstream call runs as its own task and is cancelled only once every
+subscriber has gone away.
+
+Flights live on the event loop of the server; they are not shared between
+processes.
+"""
+import asyncio
+
+
+class Flight:
+    def __init__(self):
+        # (delta_content, finished) items produced so far, replayed to late subscribers
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        # set and replaced whenever items, done or error change
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights = {}
+        self.started = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def _run(self, key, flight, agenerate):
+        stream = agenerate()
+        try:
+            async for item in stream:
+                flight.items.append(item)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            await stream.aclose()
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+    async def stream(self, key, agenerate):
+        """
+        streams the generation of key, joining the one in flight if there is one
+        :param key: identifies the generation, e.g. llama.response_cache.request_key of the prompt
+        :param agenerate: no-argument callable returning an async generator of (delta_content, finished)
+        :return: async generator of (delta_content, finished)
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, agenerate))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        flight.subscribers += 1
+
+        position = 0
+        try:
+            while True:
+                changed = flight.changed
+                while position < len(flight.items):
+                    position += 1
+                    yield flight.items[position - 1]
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await changed.wait()
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # the last subscriber left, nobody needs the rest of the generation
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+                self.cancelled += 1
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,118 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from llama.summary_tree_format import MappedSummaryTree, load_summary_tree
+from llama.offset_index import OffsetIndex, offset_index_url, get_offset_index
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class SummaryCache:
+    """
+    Bounded LRU cache of parsed (flattened) summary trees, book texts and offset indexes.
+
+    Entries are keyed by path and remember the file's mtime, so a file rewritten
+    by another process (e.g. a summary worker) is reloaded on the next access.
+    Eviction is by the estimated in-memory size of the entries.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _get(self, path, load, size_of):
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime_ns:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        # load outside of the lock so a slow file does not block other readers
+        value = load(path)
+        size = size_of(value, path)
+        with self._lock:
+            self._remove(path)
+            if size <= self.max_bytes:
+                self._entries[path] = (mtime_ns, value, size)
+                self._total_bytes += size
+                while self._total_bytes > self.max_bytes:
+                    _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                    self._total_bytes -= evicted_size
+                    self.evictions += 1
+        return value
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._total_bytes -= entry[2]
+        return entry is not None
+
+    def get_book_content(self, book_content_url):
+        return self._get(book_content_url, _load_book_content, lambda content, path: sys.getsizeof(content))
+
+    def get_summary_tree(self, summary_tree_url):
+        """
+        :return: the tree as a FlatSummaryTree
+        """
+        return self._get(summary_tree_url, load_summary_tree, _summary_tree_size)
+
+    def get_offset_index(self, book_content_url):
+        book_content = self.get_book_content(book_content_url)
+        index_url = offset_index_url(book_content_url)
+        if not os.path.exists(index_url):
+            # books uploaded before offset indexes existed
+            get_offset_index(book_content_url, book_content)
+        offset_index = self._get(index_url, OffsetIndex.load, lambda index, path: os.path.getsize(path))
+        if offset_index.num_chars != len(book_content):
+            return get_offset_index(book_content_url, book_content)
+        return offset_index
+
+    def invalidate(self, path):
+        with self._lock:
+            if self._remove(path):
+                self.invalidations += 1
+
+    def invalidate_book(self, book_content_url, summary_tree_url=None):
+        self.invalidate(book_content_url)
+        self.invalidate(offset_index_url(book_content_url))
+        if summary_tree_url is not None:
+            self.invalidate(summary_tree_url)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def _load_book_content(book_content_url):
+    with open(book_content_url, 'r') as book_file:
+        return book_file.read()
+
+
+def _summary_tree_size(summary_tree, summary_tree_url):
+    if isinstance(summary_tree, MappedSummaryTree):
+        return os.path.getsize(summary_tree_url)
+    # a tree parsed from a pickle is a few times larger than the pickle
+    return 4 * os.path.getsize(summary_tree_url)
+
+
+summary_cache = SummaryCache(int(os.environ.get("SUMMARY_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)))
@@ -0,0 +1,409 @@
+"""
+Durable queue of summary tree jobs, stored in SQLite.
+
+/book/add only enqueues a job; separate worker processes claim jobs by
+priority and build the trees. Every finished leaf and reduction is
+checkpointed, so a job whose worker died is claimed again once its lease
+expires and resumes from the last checkpoint instead of starting over.
+
+    python -m llama.summary_jobs worker --processes 2
+
+The queue file is read from SUMMARY_JOB_DB and the lease from
+SUMMARY_JOB_LEASE_SECONDS.
+"""
+import os
+import sys
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from collections import namedtuple
+from contextlib import closing
+
+DEFAULT_JOB_DB_URL = "/home/swpp/readability_users/summary_jobs.sqlite3"
+DEFAULT_LEASE_SECONDS = 120.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+SummaryJob = namedtuple("SummaryJob", [
+    "job_id", "book_id", "content_url", "priority", "status", "attempts",
+    "worker", "error", "created_at", "updated_at", "num_current_inference", "num_total_inference", "fan_out",
+    "fan_out_capped",
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    book_id INTEGER NOT NULL,
+    content_url TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    error TEXT,
+    heartbeat REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    num_current_inference INTEGER NOT NULL DEFAULT 0,
+    num_total_inference INTEGER NOT NULL DEFAULT 0,
+    fan_out INTEGER,
+    fan_out_capped INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, priority DESC, job_id);
+CREATE INDEX IF NOT EXISTS jobs_by_book ON jobs (book_id);
+CREATE INDEX IF NOT EXISTS jobs_by_content ON jobs (content_url, status);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_id INTEGER NOT NULL,
+    node_id INTEGER NOT NULL,
+    start_idx INTEGER NOT NULL,
+    end_idx INTEGER NOT NULL,
+    summary_content TEXT NOT NULL,
+    PRIMARY KEY (job_id, node_id)
+);
+"""
+JOB_COLUMNS = ", ".join(SummaryJob._fields)
+# columns added after the first release of the queue, with their definitions
+ADDED_COLUMNS = {
+    "num_current_inference": "INTEGER NOT NULL DEFAULT 0",
+    "num_total_inference": "INTEGER NOT NULL DEFAULT 0",
+    # children per reduction of the run that made the checkpoints, NULL until a worker starts the job
+    "fan_out": "INTEGER",
+    # whether its reductions take at most fan_out children, see llama.preprocess_summary.build_reduction_plan
+    "fan_out_capped": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class SummaryJobQueue:
+    def __init__(self, path=DEFAULT_JOB_DB_URL, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param path: SQLite file shared by the API server and the workers
+        :param lease_seconds: a running job without a heartbeat for this long is claimed again
+        :param max_attempts: number of claims after which a failing job is given up
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for name, definition in ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def _connect(self):
+        # autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def enqueue(self, book_id, content_url, priority=0):
+        """
+        queues the summary tree of a book. A book that already has an active job
+        keeps it, raised to the higher of the two priorities.
+        :param content_url: absolute path of the book content
+        :return: job id
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT job_id FROM jobs WHERE book_id = ? AND status IN {ACTIVE_STATUSES}", (book_id,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET priority = MAX(priority, ?), updated_at = ? WHERE job_id = ?",
+                             (priority, now, row[0]))
+                job_id = row[0]
+            else:
+                job_id = conn.execute(
+                    "INSERT INTO jobs (book_id, content_url, priority, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (book_id, content_url, priority, QUEUED, now, now)).lastrowid
+            conn.execute("COMMIT")
+        return job_id
+
+    def claim(self, worker):
+        """
+        takes the highest priority queued job, or a running job whose lease expired.
+        Jobs of a book whose content is being summarized by a live job wait for it,
+        so identical uploads are summarized once and then share the tree.
+        :return: SummaryJob, or None if there is nothing to do
+        """
+        now = time.time()
+        expired = now - self.lease_seconds
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs AS candidate "
+                "WHERE (status = ? OR (status = ? AND heartbeat < ?)) AND NOT EXISTS ("
+                "    SELECT 1 FROM jobs AS live WHERE live.content_url = candidate.content_url "
+                "    AND live.job_id != candidate.job_id AND live.status = ? AND live.heartbeat >= ?) "
+                "ORDER BY priority DESC, job_id LIMIT 1",
+                (QUEUED, RUNNING, expired, RUNNING, expired)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job = SummaryJob(*row)
+            conn.execute("UPDATE jobs SET status = ?, worker = ?, heartbeat = ?, attempts = attempts + 1, "
+                         "updated_at = ? WHERE job_id = ?", (RUNNING, worker, now, now, job.job_id))
+            conn.execute("COMMIT")
+        return job._replace(status=RUNNING, worker=worker, attempts=job.attempts + 1, updated_at=now)
+
+    def heartbeat(self, job_id, worker):
+        """
+        renews the lease of a running job
+        :return: False if the job was cancelled or claimed by another worker
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            updated = conn.execute("UPDATE jobs SET heartbeat = ?, updated_at = ? "
+                                   "WHERE job_id = ? AND worker = ? AND status = ?",
+                                   (now, now, job_id, worker, RUNNING)).rowcount
+        return updated == 1
+
+    def checkpoint(self, job_id, worker, node_id, summary):
+        """
+        records a finished node of the summary tree and renews the lease
+        :raise JobCancelled: if the job no longer belongs to this worker
+        """
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            owned = conn.execute("UPDATE jobs SET heartbeat = ?, updated_at = ? "
+                                 "WHERE job_id = ? AND worker = ? AND status = ?",
+                                 (now, now, job_id, worker, RUNNING)).rowcount
+            if owned:
+                conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                             (job_id, node_id, summary.start_idx, summary.end_idx, summary.summary_content))
+            conn.execute("COMMIT")
+        if not owned:
+            raise JobCancelled(f"summary job {job_id} is no longer run by {worker}")
+
+    def record_fan_out(self, job_id, worker, fan_out, capped=False):
+        """
+        records the fan-out of the running tree build, and whether its reductions are capped at
+        fan_out children. Checkpoints of another fan-out number the nodes of another tree, and are removed.
+        :raise JobCancelled: if the job no longer belongs to this worker
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT fan_out, fan_out_capped FROM jobs "
+                               "WHERE job_id = ? AND worker = ? AND status = ?",
+                               (job_id, worker, RUNNING)).fetchone()
+            if row is not None and tuple(row) != (fan_out, int(capped)):
+                conn.execute("UPDATE jobs SET fan_out = ?, fan_out_capped = ?, updated_at = ? WHERE job_id = ?",
+                             (fan_out, int(capped), time.time(), job_id))
+                conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+            conn.execute("COMMIT")
+        if row is None:
+            raise JobCancelled(f"summary job {job_id} is no longer run by {worker}")
+
+    def report_progress(self, job_id, worker, num_current_inference, num_total_inference):
+        """
+        records the progress of a running job for readers in other processes, see llama.progress_tracker
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("UPDATE jobs SET num_current_inference = ?, num_total_inference = ? "
+                         "WHERE job_id = ? AND worker = ? AND status = ?",
+                         (num_current_inference, num_total_inference, job_id, worker, RUNNING))
+
+    def get_checkpoints(self, job_id):
+        """
+        :return: {node_id: (start_idx, end_idx, summary_content)}, see SummaryTreeScheduler.run
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT node_id, start_idx, end_idx, summary_content FROM checkpoints "
+                                "WHERE job_id = ?", (job_id,)).fetchall()
+        return {node_id: (start_idx, end_idx, summary_content) for node_id, start_idx, end_idx, summary_content in rows}
+
+    def _finish(self, conn, job_id, status, error=None):
+        conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE job_id = ?",
+                     (status, error, time.time(), job_id))
+        conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+
+    def complete(self, job_id, worker):
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            owned = conn.execute("SELECT 1 FROM jobs WHERE job_id = ? AND worker = ? AND status = ?",
+                                 (job_id, worker, RUNNING)).fetchone()
+            if owned:
+                self._finish(conn, job_id, DONE)
+            conn.execute("COMMIT")
+
+    def fail(self, job_id, worker, error):
+        """
+        puts a failed job back in the queue, keeping its checkpoints,
+        or gives it up after max_attempts claims
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts FROM jobs WHERE job_id = ? AND worker = ? AND status = ?",
+                               (job_id, worker, RUNNING)).fetchone()
+            if row is not None and row[0] >= self.max_attempts:
+                self._finish(conn, job_id, FAILED, error)
+            elif row is not None:
+                conn.execute("UPDATE jobs SET status = ?, worker = NULL, error = ?, updated_at = ? WHERE job_id = ?",
+                             (QUEUED, error, time.time(), job_id))
+            conn.execute("COMMIT")
+
+    def cancel(self, book_id):
+        """
+        cancels the active job of a book. A worker running it stops at its next checkpoint.
+        :return: number of cancelled jobs
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            job_ids = [row[0] for row in conn.execute(
+                f"SELECT job_id FROM jobs WHERE book_id = ? AND status IN {ACTIVE_STATUSES}", (book_id,))]
+            for job_id in job_ids:
+                self._finish(conn, job_id, CANCELLED)
+            conn.execute("COMMIT")
+        return len(job_ids)
+
+    def get_job(self, job_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return SummaryJob(*row) if row is not None else None
+
+    def status(self, book_id):
+        """
+        :return: the latest job of a book as a dict with its number of checkpointed nodes, or None
+        """
+        with closing(self._connect()) as conn:
+            row = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE book_id = ? ORDER BY job_id DESC LIMIT 1",
+                               (book_id,)).fetchone()
+            if row is None:
+                return None
+            job = SummaryJob(*row)
+            num_checkpoints = conn.execute("SELECT COUNT(*) FROM checkpoints WHERE job_id = ?",
+                                           (job.job_id,)).fetchone()[0]
+        status = job._asdict()
+        del status["content_url"]
+        status["num_checkpoints"] = num_checkpoints
+        return status
+
+
+_summary_job_queue = None
+_summary_job_queue_lock = threading.Lock()
+
+
+def get_summary_job_queue():
+    """
+    returns the process-wide queue, creating it on first use.
+    Use as a FastAPI dependency: ``job_queue = Depends(get_summary_job_queue)``
+    """
+    global _summary_job_queue
+    with _summary_job_queue_lock:
+        if _summary_job_queue is None:
+            _summary_job_queue = SummaryJobQueue(
+                os.environ.get("SUMMARY_JOB_DB", DEFAULT_JOB_DB_URL),
+                lease_seconds=float(os.environ.get("SUMMARY_JOB_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)),
+            )
+        return _summary_job_queue
+
+
+def run_job(job_queue, job, db_pool, proxy_ai_backend=None):
+    """
+    builds the summary tree of a claimed job, resuming from its checkpoints
+    :return: final status of the job
+    """
+    # imported here so the worker CLI can extend sys.path first
+    from llama.preprocess_summary import generate_summary_tree
+
+    stop_heartbeat = threading.Event()
+
+    def keep_lease():
+        while not stop_heartbeat.wait(job_queue.lease_seconds / 3):
+            if not job_queue.heartbeat(job.job_id, job.worker):
+                return
+
+    heartbeat_thread = threading.Thread(target=keep_lease, daemon=True)
+    heartbeat_thread.start()
+    try:
+        with open(job.content_url, 'r') as book_file:
+            story = book_file.read()
+        generate_summary_tree(
+            job.book_id, story, db_pool,
+            proxy_ai_backend=proxy_ai_backend,
+            checkpoints=job_queue.get_checkpoints(job.job_id),
+            checkpoint_fan_out=(job.fan_out, bool(job.fan_out_capped)),
+            on_fan_out=lambda fan_out, capped: job_queue.record_fan_out(job.job_id, job.worker, fan_out, capped),
+            on_node_complete=lambda node_id, summary: job_queue.checkpoint(job.job_id, job.worker, node_id, summary),
+            on_progress=lambda num_current, num_total: job_queue.report_progress(
+                job.job_id, job.worker, num_current, num_total),
+        )
+    except JobCancelled:
+        return CANCELLED
+    except Exception as e:
+        print(f"SUMMARY JOB {job.job_id} FAILED: {e!r}")
+        job_queue.fail(job.job_id, job.worker, repr(e))
+        return job_queue.get_job(job.job_id).status
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+    job_queue.complete(job.job_id, job.worker)
+    return DONE
+
+
+def run_worker(job_queue, db_pool, poll_interval=1.0, stop_event=None, ai_backend=None):
+    """
+    claims and runs jobs until stop_event is set
+    :param ai_backend: backend of every job, the one named by AI_BACKEND by default,
+        created once for the worker rather than for every book
+    """
+    # imported here so the worker CLI can extend sys.path first
+    from llama.custom_type import ProxyAIBackend
+    from llama.backend_registry import get_backend
+
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    stop_event = stop_event or threading.Event()
+    ai_backend = ai_backend or get_backend()
+    while not stop_event.is_set():
+        job = job_queue.claim(worker)
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+        print(f"SUMMARY JOB {job.job_id} (book {job.book_id}) CLAIMED BY {worker}, ATTEMPT {job.attempts}")
+        run_job(job_queue, job, db_pool, ProxyAIBackend(ai_backend))
+
+
+def _worker_process(poll_interval):
+    from database import get_db_pool
+    run_worker(get_summary_job_queue(), get_db_pool(), poll_interval=poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="summary tree job queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker = subparsers.add_parser("worker", help="run summary workers until interrupted")
+    worker.add_argument("--processes", type=int, default=1, help="number of worker processes")
+    worker.add_argument("--poll-interval", type=float, default=1.0, help="seconds between polls of an empty queue")
+    status = subparsers.add_parser("status", help="print the latest job of a book")
+    status.add_argument("book_id", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "status":
+        print(get_summary_job_queue().status(args.book_id))
+        return 0
+
+    # pickled trees and the backends reference top-level modules of backend/ and backend/llama/
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+    processes = [multiprocessing.Process(target=_worker_process, args=(args.poll_interval,))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Versioned, memory-mappable on-disk format for summary trees.
+
+Layout (little endian):
+
+    header    magic b"RSUMTREE", format version, node count, leaf count,
+              followed by the byte offset of each section
+    sections  start_idx    int64[nodes]
+              end_idx      int64[nodes]
+              parent       int32[nodes]    -1 for the root
+              first_child  int32[nodes]    -1 for leaves
+              child_count  int32[nodes]
+              text_offset  int64[nodes+1]  summary i is heap[text_offset[i]:text_offset[i+1]]
+              leaf_nodes   int32[leaves]   sorted by start_idx
+              leaf_start   int64[leaves]
+              leaf_boundary int8[leaves]   since version 2, see llama.boundary_index, -1 when unknown
+              heap         utf-8 summary texts
+
+Nodes are numbered breadth first like FlatSummaryTree, so the file is a
+serialized FlatSummaryTree without the covering sets, which are cheap to walk
+from the parent column. Sections are 8-byte aligned and read through
+memoryviews of an mmap, so a request only touches the pages it needs.
+
+Existing pickled trees can be migrated in bulk:
+
+    python -m llama.summary_tree_format migrate /home/swpp/readability_users
+"""
+import os
+import sys
+import mmap
+import pickle
+import struct
+import argparse
+
+from llama.flat_summary_tree import FlatSummaryTree
+
+SUMMARY_TREE_MAGIC = b"RSUMTREE"
+SUMMARY_TREE_VERSION = 2
+SUMMARY_TREE_EXTENSION = ".sumtree"
+UNKNOWN_BOUNDARY = -1
+
+SECTIONS_V1 = (
+    ("start_idx", "q"),
+    ("end_idx", "q"),
+    ("parent", "i"),
+    ("first_child", "i"),
+    ("child_count", "i"),
+    ("text_offset", "q"),
+    ("leaf_nodes", "i"),
+    ("leaf_start", "q"),
+    ("heap", "B"),
+)
+SECTIONS = SECTIONS_V1[:-1] + (("leaf_boundary", "b"),) + SECTIONS_V1[-1:]
+SECTIONS_BY_VERSION = {1: SECTIONS_V1, 2: SECTIONS}
+
+
+def _header(sections):
+    # magic, version, number of nodes, number of leaves, one offset per section
+    return struct.Struct("<8sIII" + "Q" * len(sections))
+
+
+SUMMARY_TREE_HEADER = _header(SECTIONS)
+SUMMARY_TREE_PREFIX = struct.Struct("<8sI")
+
+
+class UnsupportedSummaryTreeVersion(Exception):
+    pass
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def write_summary_tree(summary_tree, path):
+    """
+    :param summary_tree: root Summary or FlatSummaryTree
+    :param path: destination, replaced atomically so readers mapping the old file are unaffected
+    """
+    if not isinstance(summary_tree, FlatSummaryTree):
+        summary_tree = FlatSummaryTree.from_summary(summary_tree)
+
+    texts = [(content or "").encode("utf-8") for content in summary_tree.summary_contents]
+    text_offsets = [0]
+    for text in texts:
+        text_offsets.append(text_offsets[-1] + len(text))
+    columns = {
+        "start_idx": summary_tree.start_idxs,
+        "end_idx": summary_tree.end_idxs,
+        "parent": summary_tree.parents,
+        "first_child": summary_tree.first_children,
+        "child_count": summary_tree.child_counts,
+        "text_offset": text_offsets,
+        "leaf_nodes": summary_tree.leaf_nodes,
+        "leaf_start": summary_tree.leaf_start_idxs,
+        "leaf_boundary": (summary_tree.leaf_boundaries if summary_tree.leaf_boundaries is not None
+                          else [UNKNOWN_BOUNDARY] * len(summary_tree.leaf_nodes)),
+    }
+
+    payloads = []
+    for name, type_code in SECTIONS:
+        if name == "heap":
+            payloads.append(b"".join(texts))
+        else:
+            values = columns[name]
+            payloads.append(struct.pack(f"<{len(values)}{type_code}", *values))
+
+    offsets = []
+    offset = _align(SUMMARY_TREE_HEADER.size)
+    for payload in payloads:
+        offsets.append(offset)
+        offset = _align(offset + len(payload))
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as tree_file:
+        tree_file.write(SUMMARY_TREE_HEADER.pack(
+            SUMMARY_TREE_MAGIC, SUMMARY_TREE_VERSION, len(summary_tree), len(summary_tree.leaf_nodes), *offsets))
+        for section_offset, payload in zip(offsets, payloads):
+            tree_file.write(b"\0" * (section_offset - tree_file.tell()))
+            tree_file.write(payload)
+    os.replace(tmp_path, path)
+
+
+class _TextHeap:
+    def __init__(self, heap, text_offsets):
+        self.heap = heap
+        self.text_offsets = text_offsets
+
+    def __len__(self):
+        return len(self.text_offsets) - 1
+
+    def __getitem__(self, node_id):
+        return str(self.heap[self.text_offsets[node_id]:self.text_offsets[node_id + 1]], "utf-8")
+
+
+class MappedSummaryTree(FlatSummaryTree):
+    """
+    FlatSummaryTree backed by a memory-mapped summary tree file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as tree_file:
+            self._mmap = mmap.mmap(tree_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = SUMMARY_TREE_PREFIX.unpack_from(self._mmap, 0)
+        if magic != SUMMARY_TREE_MAGIC:
+            raise ValueError(f"{path} is not a summary tree file")
+        if version not in SECTIONS_BY_VERSION:
+            raise UnsupportedSummaryTreeVersion(f"{path} has format version {version}, expected {SUMMARY_TREE_VERSION}")
+        version_sections = SECTIONS_BY_VERSION[version]
+        _, _, node_count, leaf_count, *offsets = _header(version_sections).unpack_from(self._mmap, 0)
+
+        view = memoryview(self._mmap)
+        counts = {"text_offset": node_count + 1, "leaf_nodes": leaf_count, "leaf_start": leaf_count,
+                  "leaf_boundary": leaf_count}
+        sections = {}
+        for (name, type_code), offset in zip(version_sections, offsets):
+            if name == "heap":
+                sections[name] = view[offset:]
+                continue
+            count = counts.get(name, node_count)
+            sections[name] = view[offset:offset + count * struct.calcsize(type_code)].cast(type_code)
+
+        self.start_idxs = sections["start_idx"]
+        self.end_idxs = sections["end_idx"]
+        self.parents = sections["parent"]
+        self.first_children = sections["first_child"]
+        self.child_counts = sections["child_count"]
+        self.summary_contents = _TextHeap(sections["heap"], sections["text_offset"])
+        self.leaf_nodes = sections["leaf_nodes"]
+        self.leaf_start_idxs = sections["leaf_start"]
+        leaf_boundaries = sections.get("leaf_boundary")
+        if leaf_boundaries is not None and leaf_count and leaf_boundaries[0] == UNKNOWN_BOUNDARY:
+            leaf_boundaries = None
+        self.leaf_boundaries = leaf_boundaries
+        self.covering_sets = None
+
+    def find_included_summaries(self, child_summary):
+        # walk up the parent column, like Summary.find_included_summaries
+        included_summaries = []
+        node_id = child_summary.node_id
+        while self.parents[node_id] != -1:
+            parent = self.parents[node_id]
+            first_child = self.first_children[parent]
+            for sibling in range(first_child, first_child + self.child_counts[parent]):
+                if self.end_idxs[sibling] <= self.start_idxs[node_id]:
+                    included_summaries.append(self.node(sibling))
+            node_id = parent
+        return included_summaries
+
+
+def is_summary_tree_file(path):
+    with open(path, 'rb') as tree_file:
+        return tree_file.read(len(SUMMARY_TREE_MAGIC)) == SUMMARY_TREE_MAGIC
+
+
+def migrated_summary_tree_url(summary_tree_url):
+    return os.path.splitext(summary_tree_url)[0] + SUMMARY_TREE_EXTENSION
+
+
+def load_summary_tree(summary_tree_url):
+    """
+    loads a summary tree in either format as a FlatSummaryTree.
+    A pickle that has been migrated is read from its .sumtree sibling instead,
+    unless the pickle was rewritten after the migration.
+    """
+    if is_summary_tree_file(summary_tree_url):
+        return MappedSummaryTree(summary_tree_url)
+    migrated_url = migrated_summary_tree_url(summary_tree_url)
+    if os.path.exists(migrated_url) and os.path.getmtime(migrated_url) >= os.path.getmtime(summary_tree_url):
+        return MappedSummaryTree(migrated_url)
+    with open(summary_tree_url, 'rb') as pickle_file:
+        return FlatSummaryTree.from_summary(pickle.load(pickle_file))
+
+
+def migrate_pickled_summary_trees(paths, overwrite=False):
+    """
+    converts every *_summary.pkl under paths into a .sumtree file next to it
+    :return: (number of converted trees, list of (path, error) for trees that failed)
+    """
+    pickle_urls = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                pickle_urls.extend(os.path.join(dirpath, filename)
+                                   for filename in filenames if filename.endswith("_summary.pkl"))
+        else:
+            pickle_urls.append(path)
+
+    converted, failed = 0, []
+    for pickle_url in sorted(pickle_urls):
+        migrated_url = migrated_summary_tree_url(pickle_url)
+        if os.path.exists(migrated_url) and not overwrite:
+            continue
+        try:
+            with open(pickle_url, 'rb') as pickle_file:
+                write_summary_tree(pickle.load(pickle_file), migrated_url)
+            converted += 1
+        except Exception as e:
+            failed.append((pickle_url, e))
+    return converted, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="summary tree file utilities")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="convert pickled summary trees to the .sumtree format")
+    migrate.add_argument("paths", nargs="+", help="*_summary.pkl files or directories to search")
+    migrate.add_argument("--overwrite", action="store_true", help="reconvert trees that were already migrated")
+    args = parser.parse_args(argv)
+
+    # pickled trees reference the top-level custom_type module
+    sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+    converted, failed = migrate_pickled_summary_trees(args.paths, overwrite=args.overwrite)
+    print(f"converted {converted} summary trees")
+    for pickle_url, error in failed:
+        print(f"failed to convert {pickle_url}: {error}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
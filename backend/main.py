@@ -3,6 +3,7 @@ from typing import Union
 from fastapi.staticfiles import StaticFiles
 from routers.ai import ai
 from routers.book import book
+from routers.metrics import metrics
 from routers.user import user
 from fastapi import FastAPI
 
@@ -11,6 +12,7 @@ app = FastAPI()
 app.include_router(ai)
 app.include_router(book)
 app.include_router(user)
+app.include_router(metrics)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 if __name__ == "__main__":
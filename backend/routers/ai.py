@@ -1,13 +1,15 @@
 from fastapi import APIRouter, Request, Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from llama.run_quiz import get_quizzes_from_intermediate, get_quizzes_from_text
 from llama.run_summary import get_summary_from_intermediate, get_summary_from_text
 from sse_starlette.sse import EventSourceResponse
-import mysql.connector
 import os
 
+from database import DatabasePool, get_db_pool
 from routers.user import get_user_with_access_token
-from llama.custom_type import ProxyAIBackend, GPT4Backend
+from llama.custom_type import ProxyAIBackend
+from llama.backend_registry import get_backend
 
 class QuizReportRequest(BaseModel):
     quiz_id: str
@@ -15,8 +17,14 @@ class QuizReportRequest(BaseModel):
 
 ai = APIRouter()
 
+def get_book_row(db_pool, book_id):
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
+        return cursor.fetchall()
+
 @ai.get("/summary")
-async def ai_summary(request: Request, book_id: str, progress: float, email: str = Depends(get_user_with_access_token)):
+async def ai_summary(request: Request, book_id: str, progress: float, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     """
     :param book_id: book id to generate summary from
     :param progress: cutoff to which the summary is generated
@@ -29,15 +37,8 @@ async def ai_summary(request: Request, book_id: str, progress: float, email: str
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
-    result = cursor.fetchall()
+    # blocking query, kept off the event loop like the prepare stage
+    result = await run_in_threadpool(get_book_row, db_pool, book_id)
 
     # if the num_total_inferences is 1, 
     # then the books was too short to divide.
@@ -46,11 +47,11 @@ async def ai_summary(request: Request, book_id: str, progress: float, email: str
 
     user_dirname = f"/home/swpp/readability_users/"
     book_content_url = os.path.join(user_dirname,result[0][6])
-    ai_backend = ProxyAIBackend(GPT4Backend())
+    ai_backend = ProxyAIBackend(get_backend())
 
     if result[0][8] == 1:
         async def event_generator():
-            for delta_content, finished in ai_backend.get_summary_from_text(progress, book_content_url):
+            async for delta_content, finished in ai_backend.aget_summary_from_text(progress, book_content_url):
                 if await request.is_disconnected():
                     return
                 yield {
@@ -61,7 +62,7 @@ async def ai_summary(request: Request, book_id: str, progress: float, email: str
 
     summary_tree_url = os.path.join(user_dirname,result[0][7])
     async def event_generator():
-        for delta_content, finished in ai_backend.get_summary_from_intermediate(progress, book_content_url, summary_tree_url):
+        async for delta_content, finished in ai_backend.aget_summary_from_intermediate(progress, book_content_url, summary_tree_url):
             if await request.is_disconnected():
                 return
             yield {
@@ -71,7 +72,7 @@ async def ai_summary(request: Request, book_id: str, progress: float, email: str
     return EventSourceResponse(event_generator())
 
 @ai.get("/quiz")
-def ai_quiz(request: Request, book_id: str, progress: float, email: str = Depends(get_user_with_access_token)):
+def ai_quiz(request: Request, book_id: str, progress: float, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     """
     :param book_id: book id to generate quiz from
     :param progress: progress of the book
@@ -84,25 +85,15 @@ def ai_quiz(request: Request, book_id: str, progress: float, email: str = Depend
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    if not books_db.is_connected():
-        books_db.reconnect()
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
-    result = cursor.fetchall()
+    result = get_book_row(db_pool, book_id)
     
     user_dirname = f"/home/swpp/readability_users/"
     book_content_url = os.path.join(user_dirname,result[0][6])
-    ai_backend = ProxyAIBackend(GPT4Backend())
+    ai_backend = ProxyAIBackend(get_backend())
 
     if result[0][8] == 1:
         async def event_generator():
-            for delta_content, finished in ai_backend.get_quiz_from_text(progress, book_content_url):
+            async for delta_content, finished in ai_backend.aget_quiz_from_text(progress, book_content_url):
                 if await request.is_disconnected():
                     return
                 yield {
@@ -113,7 +104,7 @@ def ai_quiz(request: Request, book_id: str, progress: float, email: str = Depend
 
     summary_tree_url = os.path.join(user_dirname,result[0][7])
     async def event_generator():
-        for delta_content, finished in ai_backend.get_quiz_from_intermediate(progress, book_content_url, summary_tree_url):
+        async for delta_content, finished in ai_backend.aget_quiz_from_intermediate(progress, book_content_url, summary_tree_url):
             if await request.is_disconnected():
                 return
             yield {
@@ -1,16 +1,23 @@
-from fastapi import APIRouter, File, UploadFile, Depends, HTTPException, status, BackgroundTasks
-from fastapi import BackgroundTasks
+from fastapi import APIRouter, File, UploadFile, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
-import mysql.connector
 import io
 import PIL.Image as Image
 import os
 import uuid
-import asyncio
+import json
+from contextlib import aclosing
+from sse_starlette.sse import EventSourceResponse
 
+from database import DatabasePool, get_db_pool
 from routers.user import get_user_with_access_token
-from llama.preprocess_summary import generate_summary_tree
+from llama.content_store import store_book_content
+from llama.summary_cache import summary_cache
+from llama.summary_jobs import SummaryJobQueue, get_summary_job_queue, DONE
+from llama.progress_tracker import read_progress
+from llama.progress_broadcast import progress_broadcast
+from llama.prefetch import prefetch_scheduler
 
 class BookAddRequest(BaseModel):
     # TODO: Replace email when using OAuth
@@ -18,25 +25,22 @@ class BookAddRequest(BaseModel):
     content: str
     author: str = None
     cover_image: str = None
+    # summary jobs with a higher priority are built first
+    priority: int = 0
 
 
 book = APIRouter()
 
 @book.get("/test_db")
-def test_book_get(query: str):
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(query)
-    result = cursor.fetchall()
+def test_book_get(query: str, db_pool: DatabasePool = Depends(get_db_pool)):
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(query)
+        result = cursor.fetchall()
     return {"test":result}
 
 @book.get("/books")
-def book_list(email: str = Depends(get_user_with_access_token)):
+def book_list(email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -44,15 +48,10 @@ def book_list(email: str = Depends(get_user_with_access_token)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT * FROM Books WHERE email = '{email}'")
-    result = cursor.fetchall()
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"SELECT * FROM Books WHERE email = '{email}'")
+        result = cursor.fetchall()
 
     books = []
     for row in result:
@@ -69,7 +68,7 @@ def book_list(email: str = Depends(get_user_with_access_token)):
 
 
 @book.get("/book/{book_id}/detail")
-def book_detail(book_id: str, email: str = Depends(get_user_with_access_token)):
+def book_detail(book_id: str, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -77,15 +76,10 @@ def book_detail(book_id: str, email: str = Depends(get_user_with_access_token)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
-    result = cursor.fetchall()
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
+        result = cursor.fetchall()
 
     return {
         "title": result[0][2],
@@ -96,7 +90,7 @@ def book_detail(book_id: str, email: str = Depends(get_user_with_access_token)):
     }
 
 @book.put("/book/{book_id}/progress")
-def book_progress(book_id: str, progress: float, email: str = Depends(get_user_with_access_token)):
+def book_progress(book_id: str, progress: float, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -104,36 +98,71 @@ def book_progress(book_id: str, progress: float, email: str = Depends(get_user_w
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(f"UPDATE Books SET progress = {progress} WHERE id = '{book_id}'")
-    books_db.commit()
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"UPDATE Books SET progress = {progress} WHERE id = '{book_id}'")
+        books_db.commit()
+        if prefetch_scheduler is not None:
+            cursor.execute(f"SELECT content, summary_tree FROM Books WHERE id = '{book_id}'")
+            result = cursor.fetchall()
+
+    if prefetch_scheduler is not None and len(result) > 0:
+        # generates the summary of the next leaf in the background when the reader is about to reach it
+        user_dirname = f"/home/swpp/readability_users/"
+        content_url, summary_tree_url = result[0]
+        prefetch_scheduler.observe(email, book_id, progress, os.path.join(user_dirname, content_url),
+                                   os.path.join(user_dirname, summary_tree_url) if summary_tree_url else None)
     return {}
 
+def get_username(db_pool, email):
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"SELECT username FROM Users WHERE email = '{email}'")
+        return cursor.fetchall()
+
+def save_cover_image(cover_image, image_url):
+    image = Image.open(io.BytesIO(bytearray.fromhex(cover_image)))
+    image.save(image_url)
+
+def insert_book(db_pool, email, req, image_url, content_url):
+    """
+    adds the book, linked to the finished summary tree of identical content if there is one
+    :return: (book id, whether the tree still has to be built)
+    """
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(
+            "SELECT summary_tree, num_total_inference, num_current_inference FROM Books "
+            "WHERE content = %s AND summary_tree IS NOT NULL LIMIT 1", (content_url,))
+        finished_books = cursor.fetchall()
+        if finished_books:
+            # the same text already has a finished tree: link to it instead of summarizing again
+            summary_tree_url, num_total_inference, num_current_inference = finished_books[0]
+            cursor.execute(
+                "INSERT INTO Books (email, title, author, progress, cover_image, content, summary_tree, "
+                "num_total_inference, num_current_inference) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                (email, req.title, req.author, 0.0, image_url, content_url, summary_tree_url,
+                 num_total_inference, num_current_inference))
+        else:
+            cursor.execute(
+                "INSERT INTO Books (email, title, author, progress, cover_image, content)"
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                (email, req.title, req.author, 0.0, image_url, content_url))
+        books_db.commit()
+        return cursor.lastrowid, not finished_books
+
 @book.post("/book/add")
-async def book_add(background_tasks:BackgroundTasks, req: BookAddRequest, email: str = Depends(get_user_with_access_token)):
+async def book_add(req: BookAddRequest, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool), job_queue: SummaryJobQueue = Depends(get_summary_job_queue)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-
-    # from the Users table, get the user's username by querying with the email
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT username FROM Users WHERE email = '{email}'")
-    result = cursor.fetchall()
+
+    # from the Users table, get the user's username by querying with the email.
+    # Blocking queries, kept off the event loop: a wait for a pooled connection would stall every request.
+    result = await run_in_threadpool(get_username, db_pool, email)
     if len(result) == 0:
         return {"error": "User does not exist"}
 
@@ -148,32 +177,23 @@ async def book_add(background_tasks:BackgroundTasks, req: BookAddRequest, email:
 
     book_uuid = uuid.uuid4()
     image_url = f"{user_dirname}/{book_uuid}.png"
-    content_url = f"{user_dirname}/{book_uuid}.txt"
 
-    with open(content_url, 'w') as book_file:
-        book_file.write(req.content)
+    # identical uploads share one copy of the text, and with it the summary tree
+    content_url, _ = await run_in_threadpool(store_book_content, "/home/swpp/readability_users", req.content)
+    book_content_path = os.path.join("/home/swpp/readability_users", content_url)
 
-    content_url = "/".join(content_url.split("/")[-2:])
     # asssumes that the client is sending the image as a byte array.
     if req.cover_image != "":
-        image = Image.open(io.BytesIO(bytearray.fromhex(req.cover_image)))
-        image.save(image_url)
+        await run_in_threadpool(save_cover_image, req.cover_image, image_url)
         image_url = "/".join(image_url.split("/")[-2:])
     else:
         image_url = None
 
-    add_book = (
-        "INSERT INTO Books (email, title, author, progress, cover_image, content)"
-        "VALUES (%s, %s, %s, %s, %s, %s)"
-    )
-    book_data = (email, req.title, req.author, 0.0, image_url, content_url)
-
-    cursor = books_db.cursor()
-    cursor.execute(add_book, book_data)
-    books_db.commit()
-    book_id = cursor.lastrowid
+    book_id, needs_summary = await run_in_threadpool(insert_book, db_pool, email, req, image_url, content_url)
 
-    background_tasks.add_task(generate_summary_tree, book_id, req.content)
+    if needs_summary:
+        # the tree is built by a summary worker, see llama/summary_jobs.py
+        await run_in_threadpool(job_queue.enqueue, book_id, book_content_path, req.priority)
     return {}
 
 @book.get("/book/image")
@@ -199,25 +219,53 @@ def book_content(content_url: str, email: str = Depends(get_user_with_access_tok
     return FileResponse(content_url)
 
 @book.delete("/book/delete")
-def book_delete(book_id: str, email: str = Depends(get_user_with_access_token)):
+def book_delete(book_id: str, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool), job_queue: SummaryJobQueue = Depends(get_summary_job_queue)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    books_db.cursor().execute(f"DELETE FROM Books WHERE id = '{book_id}'")
-    books_db.commit()
+    with db_pool.connection() as books_db:
+        cursor = books_db.cursor()
+        cursor.execute(f"SELECT content, summary_tree FROM Books WHERE id = '{book_id}'")
+        result = cursor.fetchall()
+        cursor.execute(f"DELETE FROM Books WHERE id = '{book_id}'")
+        books_db.commit()
+    job_queue.cancel(int(book_id))
+
+    user_dirname = "/home/swpp/readability_users/"
+    for content_url, summary_tree_url in result:
+        summary_cache.invalidate_book(
+            os.path.join(user_dirname, content_url),
+            os.path.join(user_dirname, summary_tree_url) if summary_tree_url else None,
+        )
     return {}
 
+def get_summary_progress(book_id, db_pool, job_queue):
+    """
+    reads the progress from the summary workers, and from the Books table only
+    for books without a job (e.g. uploaded before the job queue existed) or whose
+    finished job never reported a total
+    """
+    progress = read_progress(book_id, job_queue)
+    if progress is None or (progress["status"] == DONE and not progress["num_total_inference"]):
+        with db_pool.connection() as books_db:
+            cursor = books_db.cursor()
+            cursor.execute(f"SELECT num_total_inference, num_current_inference FROM Books WHERE id = '{book_id}'")
+            num_total_inference, num_current_inference = cursor.fetchall()[0]
+        progress = {
+            "book_id": book_id,
+            "num_current_inference": num_current_inference or 0,
+            "num_total_inference": num_total_inference or 0,
+            "status": "done" if num_total_inference and num_current_inference >= num_total_inference else "unknown",
+        }
+    num_total_inference = progress["num_total_inference"]
+    progress["summary_progress"] = float(progress["num_current_inference"] / num_total_inference) if num_total_inference else 0.0
+    return progress
+
 @book.get("/book/{book_id}/current_inference")
-def book_inference(book_id: str, email: str = Depends(get_user_with_access_token)):
+def book_inference(book_id: int, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool), job_queue: SummaryJobQueue = Depends(get_summary_job_queue)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -225,17 +273,49 @@ def book_inference(book_id: str, email: str = Depends(get_user_with_access_token
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    books_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = books_db.cursor()
-    cursor.execute(f"SELECT * FROM Books WHERE id = '{book_id}'")
-    result = cursor.fetchall()
-
-    num_total_inference = result[0][8]
-    num_current_inference = result[0][9]
-    current_ratio = float(num_current_inference/ num_total_inference)
-    return {"summary_progress": current_ratio}
+    progress = get_summary_progress(book_id, db_pool, job_queue)
+    return {"summary_progress": progress["summary_progress"]}
+
+@book.get("/book/{book_id}/summary_progress")
+async def book_summary_progress(request: Request, book_id: int, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool), job_queue: SummaryJobQueue = Depends(get_summary_job_queue)):
+    """
+    pushes a "progress" event whenever the summary progress of the book changes,
+    and closes once the summary tree is finished, failed or cancelled.
+    The progress is read once per book for all its subscribers, see llama.progress_broadcast
+    """
+    if email is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    async def event_generator():
+        # closed as soon as the client leaves, so the poll of the book stops with its last subscriber
+        async with aclosing(progress_broadcast.subscribe(
+                book_id, lambda: get_summary_progress(book_id, db_pool, job_queue))) as progress_stream:
+            async for progress in progress_stream:
+                if await request.is_disconnected():
+                    return
+                yield {
+                    "event": "progress",
+                    "data": json.dumps(progress)
+                }
+    return EventSourceResponse(event_generator())
+
+@book.get("/book/{book_id}/summary_job")
+def book_summary_job(book_id: int, email: str = Depends(get_user_with_access_token), job_queue: SummaryJobQueue = Depends(get_summary_job_queue)):
+    if email is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    job_status = job_queue.status(book_id)
+    if job_status is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="No summary job for this book.",
+        )
+    return job_status
@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends
+
+from database import DatabasePool, get_db_pool
+from llama.summary_cache import summary_cache
+from llama.response_cache import response_cache
+from llama.result_cache import result_cache
+from llama.prefetch import prefetch_scheduler
+from llama.single_flight import single_flight
+from llama.request_pipeline import stage_timings
+from llama.prompt_builder import prompt_report
+
+metrics = APIRouter()
+
+@metrics.get("/metrics/db_pool")
+def db_pool_metrics(db_pool: DatabasePool = Depends(get_db_pool)):
+    return db_pool.metrics()
+
+@metrics.get("/metrics/summary_cache")
+def summary_cache_metrics():
+    return summary_cache.stats()
+
+@metrics.get("/metrics/response_cache")
+def response_cache_metrics():
+    return response_cache.stats()
+
+@metrics.get("/metrics/result_cache")
+def result_cache_metrics():
+    return result_cache.stats()
+
+@metrics.get("/metrics/prefetch")
+def prefetch_metrics():
+    return prefetch_scheduler.stats() if prefetch_scheduler is not None else {"enabled": False}
+
+@metrics.get("/metrics/single_flight")
+def single_flight_metrics():
+    return single_flight.stats()
+
+@metrics.get("/metrics/request_timings")
+def request_timings_metrics():
+    return stage_timings.stats()
+
+@metrics.get("/metrics/prompt_tokens")
+def prompt_tokens_metrics():
+    return prompt_report.stats()
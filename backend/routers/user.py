@@ -1,12 +1,13 @@
 from fastapi import APIRouter, HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-import mysql.connector
 import os
 import jwt
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
+from database import DatabasePool, get_db_pool
+
 class UserSignupRequest(BaseModel):
     username: str
     email: str
@@ -29,17 +30,11 @@ def check_token_expired(token):
         current_time = datetime.now(timezone.utc).timestamp()
         return current_time > exp_timestamp
 
-def get_user_with_access_token(access_token):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-
-    cursor = users_db.cursor()
-    cursor.execute(f"SELECT * FROM Users WHERE access_token = '{access_token}'")
-    result = cursor.fetchall()
+def get_user_with_access_token(access_token, db_pool: DatabasePool = Depends(get_db_pool)):
+    with db_pool.connection() as users_db:
+        cursor = users_db.cursor()
+        cursor.execute(f"SELECT * FROM Users WHERE access_token = '{access_token}'")
+        result = cursor.fetchall()
 
     if len(result) == 0:
         print("no user by len")
@@ -65,46 +60,35 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 @user.post("/user/signup")
-def user_signup(user_signup_request: UserSignupRequest):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-    cursor = users_db.cursor()
-
-    cursor.execute(f"SELECT * FROM Users WHERE email = '{user_signup_request.email}'")
-    result = cursor.fetchall()
-    if len(result) != 0:
-        raise HTTPException(
-                status_code=409,
-                detail="Email already exists"
-            )
-        # return {"error": "Email already exists"}
+def user_signup(user_signup_request: UserSignupRequest, db_pool: DatabasePool = Depends(get_db_pool)):
+    with db_pool.connection() as users_db:
+        cursor = users_db.cursor()
 
-    cursor.execute(f"SELECT * FROM Users WHERE username = '{user_signup_request.username}'")
-    result = cursor.fetchall()
-    if len(result) != 0:
-        raise HTTPException(
-                status_code=409,
-                detail="Username already exists"
-            )
-        # return {"error": "Username already exists"}
-
-    hashed_password = get_password_hash(user_signup_request.password)
-    cursor.execute(f"INSERT INTO Users (username, email, password) VALUES ('{user_signup_request.username}', '{user_signup_request.email}', '{hashed_password}')")
-    users_db.commit()
+        cursor.execute(f"SELECT * FROM Users WHERE email = '{user_signup_request.email}'")
+        result = cursor.fetchall()
+        if len(result) != 0:
+            raise HTTPException(
+                    status_code=409,
+                    detail="Email already exists"
+                )
+            # return {"error": "Email already exists"}
+
+        cursor.execute(f"SELECT * FROM Users WHERE username = '{user_signup_request.username}'")
+        result = cursor.fetchall()
+        if len(result) != 0:
+            raise HTTPException(
+                    status_code=409,
+                    detail="Username already exists"
+                )
+            # return {"error": "Username already exists"}
+
+        hashed_password = get_password_hash(user_signup_request.password)
+        cursor.execute(f"INSERT INTO Users (username, email, password) VALUES ('{user_signup_request.username}', '{user_signup_request.email}', '{hashed_password}')")
+        users_db.commit()
     os.mkdir(f"/home/swpp/readability_users/{user_signup_request.username}")
     return {"success": True}
 
-def check_user_exists_in_db(email:str, password:str):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
+def check_user_exists_in_db(users_db, email:str, password:str):
     cursor = users_db.cursor()
     cursor.execute(f"SELECT * FROM Users WHERE email = '{email}'")
     result = cursor.fetchall()
@@ -127,36 +111,17 @@ def create_jwt_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def insert_access_token_to_user(email, access_token):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
+def insert_access_token_to_user(users_db, email, access_token):
     cursor = users_db.cursor()
     cursor.execute(f"UPDATE Users SET access_token = '{access_token}' WHERE email = '{email}'")
     users_db.commit()
 
-def insert_refresh_token_to_user(email, refresh_token):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
+def insert_refresh_token_to_user(users_db, email, refresh_token):
     cursor = users_db.cursor()
     cursor.execute(f"UPDATE Users SET refresh_token = '{refresh_token}' WHERE email = '{email}'")
     users_db.commit()
 
-def get_user_refresh_token(email):
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
-
+def get_user_refresh_token(users_db, email):
     cursor = users_db.cursor()
     cursor.execute(f"SELECT * FROM Users WHERE email = '{email}'")
     result = cursor.fetchall()
@@ -168,38 +133,40 @@ def get_user_refresh_token(email):
     return result[0][5]
 
 @user.post("/token")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
+def login(form_data: OAuth2PasswordRequestForm = Depends(), db_pool: DatabasePool = Depends(get_db_pool)):
     email = form_data.username
     password = form_data.password
 
-    result = check_user_exists_in_db(email, password) 
-    if not result:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect email or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-
-    token_data = {"sub": email}
-    access_token_expires = timedelta(weeks=ACCESS_TOKEN_EXPIRE_WEEKS)
-    access_token = create_jwt_token(
-        data=token_data, expires_delta=access_token_expires
-    )
+    with db_pool.connection() as users_db:
+        result = check_user_exists_in_db(users_db, email, password) 
+        if not result:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Incorrect email or password",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
 
-    refresh_token = get_user_refresh_token(email)
-    if not refresh_token or not check_token_expired(refresh_token):
-        refresh_token_expires = timedelta(weeks=REFRESH_TOKEN_EXPIRE_WEEKS)
-        refresh_token = create_jwt_token(
-            data=token_data, expires_delta=refresh_token_expires
+        token_data = {"sub": email}
+        access_token_expires = timedelta(weeks=ACCESS_TOKEN_EXPIRE_WEEKS)
+        access_token = create_jwt_token(
+            data=token_data, expires_delta=access_token_expires
         )
-        insert_refresh_token_to_user(email, refresh_token)
 
-    insert_access_token_to_user(email, access_token)
+        refresh_token = get_user_refresh_token(users_db, email)
+        if not refresh_token or not check_token_expired(refresh_token):
+            refresh_token_expires = timedelta(weeks=REFRESH_TOKEN_EXPIRE_WEEKS)
+            refresh_token = create_jwt_token(
+                data=token_data, expires_delta=refresh_token_expires
+            )
+            insert_refresh_token_to_user(users_db, email, refresh_token)
+
+        insert_access_token_to_user(users_db, email, access_token)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 @user.get("/user/info")
 def get_user_info(
-    access_token: str
+    access_token: str,
+    db_pool: DatabasePool = Depends(get_db_pool)
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -207,18 +174,13 @@ def get_user_info(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    if not get_user_with_access_token(access_token):
+    if not get_user_with_access_token(access_token, db_pool):
         raise credentials_exception
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
 
-    cursor = users_db.cursor()
-    cursor.execute(f"SELECT * FROM Users WHERE access_token = '{access_token}'")
-    result = cursor.fetchall()
+    with db_pool.connection() as users_db:
+        cursor = users_db.cursor()
+        cursor.execute(f"SELECT * FROM Users WHERE access_token = '{access_token}'")
+        result = cursor.fetchall()
 
     if len(result) == 0:
         return None
@@ -231,7 +193,7 @@ def get_user_info(
     }
 
 @user.post("/token/refresh")
-def refresh_access_token(refresh_token: str):
+def refresh_access_token(refresh_token: str, db_pool: DatabasePool = Depends(get_db_pool)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials.",
@@ -263,48 +225,38 @@ def refresh_access_token(refresh_token: str):
         data={"sub": email}, expires_delta=access_token_expires
     )
 
-    insert_access_token_to_user(email, new_access_token)
+    with db_pool.connection() as users_db:
+        insert_access_token_to_user(users_db, email, new_access_token)
     return {"access_token": new_access_token, "token_type": "bearer"}
 
 @user.post("/user/change_password")
-def update_user_password(password: str, email: str = Depends(get_user_with_access_token)):
+def update_user_password(password: str, email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-        
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
+
     hashed_password = get_password_hash(password)
-    cursor = users_db.cursor()
-    cursor.execute(f"UPDATE Users SET password = '{hashed_password}' WHERE email = '{email}'")
-    users_db.commit()
+    with db_pool.connection() as users_db:
+        cursor = users_db.cursor()
+        cursor.execute(f"UPDATE Users SET password = '{hashed_password}' WHERE email = '{email}'")
+        users_db.commit()
     return {}
 
 @user.delete("/user/delete_user")
-def delete_user(email: str = Depends(get_user_with_access_token)):
+def delete_user(email: str = Depends(get_user_with_access_token), db_pool: DatabasePool = Depends(get_db_pool)):
     if email is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-        
-    users_db = mysql.connector.connect(
-        host=os.environ["MYSQL_ENDPOINT"],
-        user=os.environ["MYSQL_USER"],
-        password=os.environ["MYSQL_PWD"],
-        database="readability",
-    )
 
-    user_cursor = users_db.cursor()
-    user_cursor.execute(f"DELETE FROM Users WHERE email = '{email}'")
-    user_cursor.execute(f"DELETE FROM Books WHERE email = '{email}'")
-    users_db.commit()
+    with db_pool.connection() as users_db:
+        user_cursor = users_db.cursor()
+        user_cursor.execute(f"DELETE FROM Users WHERE email = '{email}'")
+        user_cursor.execute(f"DELETE FROM Books WHERE email = '{email}'")
+        users_db.commit()
     return {}
@@ -0,0 +1,121 @@
+import sys
+import json
+import time
+import asyncio
+import openai
+from aiohttp import web
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import AIBackend, GPT4Backend, ProxyAIBackend
+
+NUM_STREAMS = 16
+NUM_CHUNKS = 5
+CHUNK_LATENCY = 0.05
+
+
+async def fake_chat_completions(request):
+	"""
+	streams NUM_CHUNKS chat completion chunks CHUNK_LATENCY seconds apart, like the OpenAI API
+	"""
+	body = await request.json()
+	response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+	await response.prepare(request)
+	for i in range(NUM_CHUNKS + 1):
+		await asyncio.sleep(CHUNK_LATENCY)
+		finished = i == NUM_CHUNKS
+		chunk = {
+			"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+			"choices": [{"index": 0, "delta": {} if finished else {"content": f"{i} "},
+				     "finish_reason": "stop" if finished else None}],
+		}
+		await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+	await response.write(b"data: [DONE]\n\n")
+	return response
+
+class BlockingAIBackend(AIBackend):
+	def get_summary_from_text(self, progress, book_content_url):
+		for i in range(NUM_CHUNKS):
+			time.sleep(CHUNK_LATENCY)
+			yield f"{i} ", False
+		time.sleep(CHUNK_LATENCY)
+		yield "\n", True
+
+async def measure_event_loop_stalls(stop):
+	"""
+	:return: longest time the event loop was unable to run this task
+	"""
+	longest_stall = 0.0
+	while not stop.is_set():
+		started = time.perf_counter()
+		await asyncio.sleep(0.005)
+		longest_stall = max(longest_stall, time.perf_counter() - started - 0.005)
+	return longest_stall
+
+async def run_streams(stream_factory):
+	async def consume():
+		return [item async for item in stream_factory()]
+
+	stop = asyncio.Event()
+	stall_task = asyncio.create_task(measure_event_loop_stalls(stop))
+	started = time.perf_counter()
+	results = await asyncio.gather(*[consume() for _ in range(NUM_STREAMS)])
+	elapsed = time.perf_counter() - started
+	stop.set()
+	return results, elapsed, await stall_task
+
+def test_parallel_streams_from_fake_provider(monkeypatch):
+	expected = [(f"{i} ", False) for i in range(NUM_CHUNKS)] + [("\n", True)]
+	single_stream_seconds = (NUM_CHUNKS + 1) * CHUNK_LATENCY
+
+	async def scenario():
+		app = web.Application()
+		app.router.add_post("/v1/chat/completions", fake_chat_completions)
+		runner = web.AppRunner(app)
+		await runner.setup()
+		site = web.TCPSite(runner, "127.0.0.1", 0)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+		monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{port}/v1")
+		monkeypatch.setattr(openai, "api_key", "sk-fake")
+		try:
+			# identical requests would share one stream, measure separate ones
+			backend = ProxyAIBackend(GPT4Backend(response_cache=None, single_flight=None))
+			return await run_streams(lambda: backend.summary_generator.astream_completion("system", "user"))
+		finally:
+			await runner.cleanup()
+
+	results, elapsed, longest_stall = asyncio.run(scenario())
+	assert results == [expected] * NUM_STREAMS
+	# the streams overlap instead of running one after another
+	assert elapsed < 3 * single_stream_seconds < NUM_STREAMS * single_stream_seconds
+	assert longest_stall < CHUNK_LATENCY
+
+def test_blocking_backend_is_bridged_off_the_event_loop():
+	expected = [(f"{i} ", False) for i in range(NUM_CHUNKS)] + [("\n", True)]
+	single_stream_seconds = (NUM_CHUNKS + 1) * CHUNK_LATENCY
+	backend = ProxyAIBackend(BlockingAIBackend())
+
+	results, elapsed, longest_stall = asyncio.run(run_streams(lambda: backend.aget_summary_from_text(0.5, "book.txt")))
+	assert results == [expected] * NUM_STREAMS
+	assert elapsed < 3 * single_stream_seconds
+	assert longest_stall < CHUNK_LATENCY
+
+def test_abandoned_bridged_stream_is_closed():
+	closed = []
+
+	class ClosingBackend(AIBackend):
+		def get_summary_from_text(self, progress, book_content_url):
+			try:
+				for i in range(100):
+					time.sleep(0.01)
+					yield f"{i} ", False
+			finally:
+				closed.append(True)
+
+	async def scenario():
+		stream = ClosingBackend().aget_summary_from_text(0.5, "book.txt")
+		assert await stream.__anext__() == ("0 ", False)
+		await stream.aclose()
+		await asyncio.sleep(0.05)
+
+	asyncio.run(scenario())
+	assert closed == [True]
@@ -0,0 +1,40 @@
+import sys
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import AIBackend, GPT4Backend, GPT3Backend
+from llama.backend_registry import (
+	UnknownBackend, backend_names, create_backend, get_backend, get_backend_class, register_backend
+)
+from benchmarks.startup import measure_import
+
+
+class EchoBackend(AIBackend):
+	def __init__(self, prefix=""):
+		self.prefix = prefix
+
+def test_backends_by_name(monkeypatch):
+	assert get_backend_class("gpt-4") is GPT4Backend
+	assert get_backend_class("gpt-3.5-turbo") is GPT3Backend
+	assert "llama-2-7b-chat" in backend_names()
+	with pytest.raises(UnknownBackend):
+		get_backend_class("gpt-5")
+
+	register_backend("echo", EchoBackend)
+	assert create_backend("echo", prefix="> ").prefix == "> "
+	monkeypatch.setenv("AI_BACKEND", "echo")
+	assert isinstance(create_backend(), EchoBackend)
+
+def test_backend_instances_are_shared(monkeypatch):
+	register_backend("shared-echo", EchoBackend)
+	monkeypatch.setenv("AI_BACKEND", "shared-echo")
+	backend = get_backend()
+	assert isinstance(backend, EchoBackend)
+	assert get_backend("shared-echo") is backend
+	assert create_backend() is not backend
+	# registering the name again replaces its instance
+	register_backend("shared-echo", EchoBackend)
+	assert get_backend() is not backend
+
+def test_api_does_not_import_torch():
+	for module in ("main", "llama.custom_type"):
+		assert measure_import(module)["heavy_modules"] == []
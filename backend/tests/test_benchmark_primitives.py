@@ -0,0 +1,37 @@
+import sys
+import copy
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from benchmarks.primitives import LEAF_TOKENS, check, make_book, make_tree, run_suite, scaling_exponent, tokenizer
+
+
+def test_synthetic_inputs():
+	assert abs(len(tokenizer.encode(make_book(5000))) - 5000) < 250
+	root, leaves = make_tree(7)
+	assert len(leaves) == 7
+	assert (root.start_idx, root.end_idx) == (0, 7 * LEAF_TOKENS - 1)
+	assert root.find_leaf_summary(3 * LEAF_TOKENS + 5) is leaves[3]
+
+def test_scaling_exponent():
+	assert scaling_exponent([(10, 1.0)]) is None
+	assert abs(scaling_exponent([(10, 1e-3), (100, 1e-2), (1000, 1e-1)]) - 1.0) < 1e-9
+	assert abs(scaling_exponent([(10, 1e-4), (100, 1e-2)]) - 2.0) < 1e-9
+
+def test_regression_check():
+	baseline = run_suite(book_tokens=(1000, 4000), tree_leaves=(10, 100), min_seconds=0.01)
+	assert set(baseline["exponents"]) == {
+		"split_large_text", "split_list", "get_number_of_inferences",
+		"Summary.find_leaf_summary", "Summary.find_included_summaries",
+	}
+	assert check(baseline, baseline) == []
+
+	slower = copy.deepcopy(baseline)
+	slower["results"]["split_list[100]"]["seconds"] *= 3
+	assert [failure.split()[0] for failure in check(slower, baseline)] == ["split_list[100]"]
+	assert check(slower, baseline, threshold=4) == []
+
+	steeper = copy.deepcopy(baseline)
+	steeper["exponents"]["split_list"] += 1
+	assert check(steeper, baseline) == [
+		f"split_list scales as size^{steeper['exponents']['split_list']:.2f}, "
+		f"the baseline as size^{baseline['exponents']['split_list']:.2f}"
+	]
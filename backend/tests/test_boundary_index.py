@@ -0,0 +1,57 @@
+import sys
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.boundary_index import (
+	BoundaryIndex, boundary_index_url, load_boundary_index, tokenizer,
+	NO_BOUNDARY, SENTENCE, PARAGRAPH, HEADING
+)
+
+BOOK = ("CHAPTER I\n\nIt was dark. The sea was grey! \"Go,\" he said.\n\n"
+	"II.\n\nShe came back. They left.\nThe end?\n\nPart Two: The Shore\n\nDone.")
+
+
+def boundaries(book):
+	boundary_index = BoundaryIndex.build(book)
+	tokens = tokenizer.encode(book)
+	return [(tokenizer.decode(tokens[token_offset:]), kind)
+		for token_offset, kind in zip(boundary_index.token_offsets, boundary_index.kinds)]
+
+def test_boundary_kinds():
+	found = boundaries(BOOK)
+	assert [(text.split()[0], kind) for text, kind in found] == [
+		("CHAPTER", HEADING), ("It", PARAGRAPH), ("The", SENTENCE), ('"Go,"', SENTENCE), ("II.", HEADING),
+		("She", PARAGRAPH), ("They", SENTENCE), ("The", SENTENCE), ("Part", HEADING), ("Done.", PARAGRAPH),
+	]
+	# every boundary starts a new unit of the text
+	assert all(BOOK.endswith(text) for text, _ in found)
+
+def test_best_boundary():
+	boundary_index = BoundaryIndex.build(BOOK)
+	heading = boundary_index.token_offsets[list(boundary_index.kinds).index(HEADING, 1)]
+	assert boundary_index.best_boundary(heading + 3, 1, heading + 3) == heading
+	assert boundary_index.kind_at(heading) == HEADING
+	assert boundary_index.kind_at(heading + 1) == NO_BOUNDARY
+	# a range without boundaries
+	assert boundary_index.best_boundary(2, 1, 2) is None
+	# the nearest of equally strong boundaries
+	sentences = [offset for offset, kind in zip(boundary_index.token_offsets, boundary_index.kinds) if kind == SENTENCE]
+	assert boundary_index.best_boundary(sentences[1] - 1, sentences[0], sentences[1]) == sentences[1]
+	assert boundary_index.best_boundary(sentences[0] + 1, sentences[0], sentences[1]) == sentences[0]
+
+def test_save_and_load(tmp_path):
+	book_content_url = str(tmp_path / "book.txt")
+	assert boundary_index_url(book_content_url) == str(tmp_path / "book_boundaries.bin")
+	assert load_boundary_index(book_content_url, BOOK) is None
+
+	built = BoundaryIndex.build(BOOK)
+	built.save(boundary_index_url(book_content_url))
+	loaded = load_boundary_index(book_content_url, BOOK)
+	assert list(loaded.token_offsets) == list(built.token_offsets)
+	assert list(loaded.kinds) == list(built.kinds)
+	assert (loaded.num_chars, loaded.num_tokens) == (len(BOOK), len(tokenizer.encode(BOOK)))
+	# stale for other content
+	assert load_boundary_index(book_content_url, BOOK + " More.") is None
+
+def test_empty_book():
+	boundary_index = BoundaryIndex.build("")
+	assert (len(boundary_index.token_offsets), boundary_index.num_tokens) == (0, 0)
+	assert boundary_index.best_boundary(0, 0, 10) is None
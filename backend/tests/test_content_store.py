@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.content_store import store_book_content, content_url_for, CONTENT_DIRNAME
+from llama.offset_index import OffsetIndex, offset_index_url
+from llama.boundary_index import BoundaryIndex, boundary_index_url, NO_BOUNDARY, tokenizer
+from llama.chunking import slice_bounds
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+	content_url, created = store_book_content(str(tmp_path), "It was a dark and stormy night.")
+	assert created
+	assert content_url == content_url_for("It was a dark and stormy night.")
+	assert content_url.startswith(CONTENT_DIRNAME + "/")
+
+	book_content_url = os.path.join(str(tmp_path), content_url)
+	with open(book_content_url) as book_file:
+		assert book_file.read() == "It was a dark and stormy night."
+	assert OffsetIndex.load(offset_index_url(book_content_url)).num_chars == len("It was a dark and stormy night.")
+	assert BoundaryIndex.load(boundary_index_url(book_content_url)).num_chars == len("It was a dark and stormy night.")
+
+	mtime = os.path.getmtime(book_content_url)
+	assert store_book_content(str(tmp_path), "It was a dark and stormy night.") == (content_url, False)
+	assert os.path.getmtime(book_content_url) == mtime
+
+	other_url, created = store_book_content(str(tmp_path), "It was a bright cold day in April.")
+	assert created and other_url != content_url
+	assert sorted(os.listdir(os.path.join(str(tmp_path), CONTENT_DIRNAME))) == sorted([
+		os.path.basename(url) for book_url in (content_url, other_url)
+		for url in (book_url, offset_index_url(book_url), boundary_index_url(book_url))
+	])
+
+
+def test_leaves_are_exact_offset_checkpoints(tmp_path):
+	book_content = " ".join(f"Sentence number {i} ends here." for i in range(3000))
+	content_url, _ = store_book_content(str(tmp_path), book_content)
+	book_content_url = os.path.join(str(tmp_path), content_url)
+	offset_index = OffsetIndex.load(offset_index_url(book_content_url))
+	boundary_index = BoundaryIndex.load(boundary_index_url(book_content_url))
+	token_starts = tokenizer.decode_with_offsets(tokenizer.encode(book_content))[1]
+
+	bounds = list(slice_bounds(offset_index.num_tokens, boundary_index))
+	assert len(bounds) > 2
+	for start_idx, end_idx in bounds:
+		assert boundary_index.kind_at(start_idx) != NO_BOUNDARY
+		assert offset_index.token_to_char(start_idx) == token_starts[start_idx]
+		# every leaf starts with a whole sentence
+		assert book_content[offset_index.token_to_char(start_idx):].lstrip().startswith("Sentence number")
+
+
+def test_concurrent_identical_uploads(tmp_path):
+	book_content = " ".join(f"Sentence number {i} ends here." for i in range(2000))
+	barrier = threading.Barrier(8)
+
+	def upload():
+		barrier.wait()
+		return store_book_content(str(tmp_path), book_content)
+
+	with ThreadPoolExecutor(max_workers=8) as executor:
+		results = list(executor.map(lambda _: upload(), range(8)))
+	content_url = content_url_for(book_content)
+	assert {url for url, _ in results} == {content_url}
+	book_content_url = os.path.join(str(tmp_path), content_url)
+	with open(book_content_url) as book_file:
+		assert book_file.read() == book_content
+	assert OffsetIndex.load(offset_index_url(book_content_url)).num_chars == len(book_content)
+	assert BoundaryIndex.load(boundary_index_url(book_content_url)).num_chars == len(book_content)
+	# no temporary file is left behind
+	assert len(os.listdir(os.path.join(str(tmp_path), CONTENT_DIRNAME))) == 3
@@ -0,0 +1,90 @@
+import pytest
+import sys
+import threading
+import time
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+import database
+from database import DatabasePool, PoolTimeoutError
+
+
+class FakeConnection:
+	def __init__(self, pool):
+		self.pool = pool
+		self.pings = 0
+
+	def ping(self, reconnect=False, attempts=1, delay=0):
+		self.pings += 1
+		if self.pool.fail_ping:
+			raise ConnectionError("server has gone away")
+
+	def close(self):
+		self.pool.returned.append(self)
+
+
+class FakeMySQLConnectionPool:
+	def __init__(self, pool_name, pool_size, pool_reset_session, **kwargs):
+		self.pool_size = pool_size
+		self.kwargs = kwargs
+		self.returned = []
+		self.fail_ping = False
+
+	def get_connection(self):
+		return FakeConnection(self)
+
+
+@pytest.fixture(autouse=True)
+def fake_mysql_pool(monkeypatch):
+	monkeypatch.setattr(database.pooling, "MySQLConnectionPool", FakeMySQLConnectionPool)
+
+
+def test_connection_is_health_checked_and_released():
+	db_pool = DatabasePool(pool_size=2, host="localhost")
+	with db_pool.connection() as connection:
+		assert connection.pings == 1
+		assert db_pool.metrics()["in_use"] == 1
+	assert db_pool._pool.returned == [connection]
+	assert db_pool._pool.kwargs == {"host": "localhost"}
+
+	metrics = db_pool.metrics()
+	assert metrics["in_use"] == 0
+	assert metrics["checkouts"] == 1
+
+def test_connection_is_released_on_error():
+	db_pool = DatabasePool(pool_size=1, host="localhost")
+	with pytest.raises(RuntimeError):
+		with db_pool.connection():
+			raise RuntimeError("query failed")
+	# the only slot must be free again
+	with db_pool.connection():
+		pass
+	assert db_pool.metrics()["checkouts"] == 2
+
+def test_failed_health_check_releases_slot():
+	db_pool = DatabasePool(pool_size=1, host="localhost")
+	db_pool._get_pool().fail_ping = True
+	with pytest.raises(ConnectionError):
+		db_pool.acquire()
+	metrics = db_pool.metrics()
+	assert metrics["health_check_failures"] == 1
+	assert metrics["in_use"] == 0
+
+def test_exhausted_pool_waits_and_times_out():
+	db_pool = DatabasePool(pool_size=1, checkout_timeout=0.05, host="localhost")
+	connection = db_pool.acquire()
+	with pytest.raises(PoolTimeoutError):
+		db_pool.acquire()
+	assert db_pool.metrics()["timeouts"] == 1
+
+	threading.Timer(0.1, db_pool.release, args=(connection,)).start()
+	db_pool.checkout_timeout = 5
+	with db_pool.connection():
+		pass
+	metrics = db_pool.metrics()
+	assert metrics["max_wait_seconds"] >= 0.05
+	assert metrics["mean_wait_seconds"] > 0
+
+def test_invalid_pool_size():
+	with pytest.raises(ValueError):
+		DatabasePool(pool_size=0)
+	with pytest.raises(ValueError):
+		DatabasePool(pool_size=database.pooling.CNX_POOL_MAXSIZE + 1)
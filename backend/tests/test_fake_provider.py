@@ -0,0 +1,97 @@
+import sys
+import time
+import asyncio
+import aiohttp
+import openai
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import GPT4Backend
+from llama.backend_registry import get_backend_class
+from benchmarks.fake_provider import (
+	FakeBackend, FakeProvider, FakeProviderConfig, FakeProviderError, FakeRateLimited, start_server
+)
+from benchmarks.load_test import parse_args, percentile, run_load_test
+
+
+def make_backend(provider):
+	return FakeBackend(provider, response_cache=None, result_cache=None, single_flight=None)
+
+def test_fake_backend_streams_at_the_configured_pace():
+	provider = FakeProvider(FakeProviderConfig(ttft_seconds=0.1, tokens_per_second=100, output_tokens=5))
+	assert get_backend_class("fake") is FakeBackend
+
+	started = time.perf_counter()
+	result = list(make_backend(provider).precompute_intermediate_from_text("some text"))
+	elapsed = time.perf_counter() - started
+	assert result == [(token, False) for token in provider.tokens("some text")] + [("\n", True)]
+	assert len(result) == 6
+	assert 0.1 + 4 * 0.01 <= elapsed < 0.5
+
+def test_fake_provider_injects_failures():
+	rate_limited = FakeProvider(FakeProviderConfig(ttft_seconds=0.0, rate_limit_rate=1.0))
+	with pytest.raises(FakeRateLimited):
+		list(make_backend(rate_limited).precompute_intermediate_from_text("text"))
+
+	failing = FakeProvider(FakeProviderConfig(ttft_seconds=0.0, error_rate=1.0))
+
+	async def consume():
+		return [item async for item in make_backend(failing).astream_completion("system", "text")]
+
+	with pytest.raises(FakeProviderError):
+		asyncio.run(consume())
+
+	mixed = FakeProvider(FakeProviderConfig(error_rate=0.2, rate_limit_rate=0.1), seed=0)
+	outcomes = [mixed.outcome() for _ in range(1000)]
+	stats = mixed.stats()
+	assert stats["requests"] == 1000
+	assert 50 < stats["rate_limited"] < 150
+	assert 150 < stats["error"] < 250
+	assert outcomes.count("success") == stats["success"]
+
+def test_fake_openai_server(monkeypatch):
+	provider = FakeProvider(FakeProviderConfig(ttft_seconds=0.1, tokens_per_second=200, output_tokens=4))
+	rate_limited = FakeProvider(FakeProviderConfig(rate_limit_rate=1.0))
+
+	async def scenario():
+		runner, api_base = await start_server(provider)
+		limited_runner, limited_api_base = await start_server(rate_limited)
+		monkeypatch.setattr(openai, "api_base", api_base)
+		monkeypatch.setattr(openai, "api_key", "sk-fake")
+		try:
+			backend = GPT4Backend(response_cache=None, result_cache=None, single_flight=None)
+			started = time.perf_counter()
+			stream = backend.astream_completion("system", "user")
+			first = await stream.__anext__()
+			ttft = time.perf_counter() - started
+			rest = [item async for item in stream]
+
+			async with aiohttp.ClientSession() as session:
+				async with session.post(f"{limited_api_base}/chat/completions",
+							json={"model": "gpt-4", "messages": [{"role": "user", "content": "x"}]}) as response:
+					return [first] + rest, ttft, response.status, response.headers.get("Retry-After")
+		finally:
+			await runner.cleanup()
+			await limited_runner.cleanup()
+
+	result, ttft, status, retry_after = asyncio.run(scenario())
+	assert result == [(token, False) for token in provider.tokens("user")] + [("\n", True)]
+	assert ttft >= 0.1
+	assert (status, retry_after) == (429, "1")
+
+def test_percentile():
+	assert percentile([], 50) is None
+	assert percentile([3.0], 99) == 3.0
+	values = list(range(1, 101))
+	assert percentile(values, 50) == 50.5
+	assert percentile(values, 95) == pytest.approx(95.05)
+	assert percentile(values, 100) == 100
+
+def test_load_test_against_the_api(tmp_path):
+	args = parse_args(["--clients", "4", "--requests", "2", "--ttft", "0.05", "--tokens-per-second", "500",
+			   "--output-tokens", "10", "--workdir", str(tmp_path), "--timeout", "60"])
+	result = asyncio.run(run_load_test(args))
+	assert (result["requests"], result["errors"]) == (8, 0)
+	assert result["ttft_seconds"]["p50"] >= 0.05
+	assert result["ttft_seconds"]["p50"] <= result["ttft_seconds"]["p99"] <= result["latency_seconds"]["p99"]
+	assert result["tokens_per_second"] > 0
+	assert result["cpu_seconds"]["server"] > 0
@@ -0,0 +1,152 @@
+import sys
+import time
+import threading
+import pytest
+import torch
+from transformers import BatchEncoding, GPT2Config, GPT2LMHeadModel
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.generation_engine import GenerationEngine, EngineOverloaded
+from llama.llama_backend import LLaMABackend
+
+PAD, EOS = 0, 1
+
+
+class CharTokenizer:
+	"""
+	one token per lowercase letter, enough to drive a small model on CPU
+	"""
+	pad_token_id = PAD
+	eos_token_id = EOS
+	eos_token = "</s>"
+	padding_side = "right"
+
+	def encode(self, text):
+		return [2 + (ord(char) - ord("a")) % 26 for char in text if char.isalpha()]
+
+	def __call__(self, prompts, return_tensors="pt", padding=True, add_special_tokens=True):
+		rows = [self.encode(prompt) for prompt in prompts]
+		width = max(len(row) for row in rows)
+		return BatchEncoding({
+			"input_ids": torch.tensor([[PAD] * (width - len(row)) + row for row in rows]),
+			"attention_mask": torch.tensor([[0] * (width - len(row)) + [1] * len(row) for row in rows]),
+		})
+
+	def decode(self, token_ids, skip_special_tokens=True):
+		return "".join(chr(ord("a") + token - 2) for token in token_ids if token >= 2)
+
+@pytest.fixture(scope="module")
+def model():
+	torch.manual_seed(0)
+	config = GPT2Config(vocab_size=28, n_positions=4096, n_embd=32, n_layer=2, n_head=2,
+			    bos_token_id=EOS, eos_token_id=EOS, pad_token_id=PAD)
+	return GPT2LMHeadModel(config).eval()
+
+PROMPTS = ["once upon a time", "the king", "a dragon slept under the mountain", "she ran",
+	   "it was a dark and stormy night", "call me ishmael", "the end", "in a hole in the ground"]
+
+def generate_all(engine, prompts, max_new_tokens=12):
+	results = [None] * len(prompts)
+
+	def generate(i):
+		results[i] = "".join(engine.submit(prompts[i], max_new_tokens))
+
+	threads = [threading.Thread(target=generate, args=(i,)) for i in range(len(prompts))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+def test_batches_give_the_same_text_as_single_prompts(model):
+	single = GenerationEngine(model, CharTokenizer(), max_batch_size=1, do_sample=False)
+	batched = GenerationEngine(model, CharTokenizer(), max_batch_size=4, max_wait_seconds=0.2, do_sample=False)
+	try:
+		expected = [
+			"".join(single.submit(prompt, 12)) for prompt in PROMPTS
+		]
+		assert generate_all(batched, PROMPTS) == expected
+		assert all(0 < len(text) <= 12 for text in expected)
+		stats = batched.stats()
+		assert stats["requests"] == len(PROMPTS)
+		assert stats["batches"] < len(PROMPTS)
+	finally:
+		single.shutdown()
+		batched.shutdown()
+
+def test_cached_prefix_gives_the_same_text(model):
+	prefix = "summarize the following story "
+	uncached = GenerationEngine(model, CharTokenizer(), max_batch_size=4, max_wait_seconds=0.2,
+				    prefix_cache=False, do_sample=False)
+	cached = GenerationEngine(model, CharTokenizer(), max_batch_size=4, max_wait_seconds=0.2, do_sample=False)
+	try:
+		expected = ["".join(uncached.submit(prompt, 12, prefix=prefix)) for prompt in PROMPTS]
+		results = [None] * len(PROMPTS)
+
+		def generate(i):
+			results[i] = "".join(cached.submit(PROMPTS[i], 12, prefix=prefix))
+
+		threads = [threading.Thread(target=generate, args=(i,)) for i in range(len(PROMPTS))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert results == expected
+		stats = cached.stats()
+		# the prefix is prefilled by the first batch only
+		assert stats["prefix_misses"] == 1
+		assert stats["prefix_hits"] == stats["batches"] - 1
+	finally:
+		uncached.shutdown()
+		cached.shutdown()
+
+class BlockingModel:
+	def __init__(self):
+		self.release = threading.Event()
+		self.batch_sizes = []
+
+	def generate(self, input_ids, streamer, **kwargs):
+		self.batch_sizes.append(len(input_ids))
+		self.release.wait()
+		streamer.put(input_ids)
+		streamer.put(torch.full((len(input_ids), 1), 2))
+		streamer.end()
+
+def test_queue_is_bounded():
+	model = BlockingModel()
+	engine = GenerationEngine(model, CharTokenizer(), max_batch_size=1, max_wait_seconds=0.0, max_queue=1)
+	first = engine.submit("first")
+	# the worker takes the first prompt, the second one fills the queue
+	time.sleep(0.05)
+	second = engine.submit("second")
+	with pytest.raises(EngineOverloaded):
+		engine.submit("third", timeout=0.01)
+
+	model.release.set()
+	assert list(first) == ["a"]
+	assert list(second) == ["a"]
+	engine.shutdown()
+	assert model.batch_sizes == [1, 1]
+
+def test_llama_backend_on_cpu(model):
+	backend = LLaMABackend(model=model, tokenizer=CharTokenizer(), device="cpu", max_batch_size=4, max_new_tokens=8)
+	try:
+		results = [None] * 4
+
+		def precompute(i):
+			results[i] = list(backend.precompute_intermediate_from_text(PROMPTS[i]))
+
+		threads = [threading.Thread(target=precompute, args=(i,)) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		for result in results:
+			assert result[-1] == ("\n", True)
+			assert 0 < len("".join(delta for delta, _ in result[:-1])) <= 8
+		summary = list(backend.precompute_summary_from_intermediate(PROMPTS[0]))
+		assert summary[-1] == ("\n", True) and 0 < len(summary) <= 9
+		assert backend.max_concurrency == 4
+		# summaries of at most 8 tokens within the 4096 positions of the model
+		assert 400 < backend.max_reduction_fan_out() < 4096 // 9
+	finally:
+		backend.shutdown()
@@ -0,0 +1,49 @@
+import pytest
+import sys
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.offset_index import OffsetIndex, offset_index_url, get_offset_index, tokenizer
+
+BOOK = "Once upon a time, 한국어 텍스트도 있습니다. " * 200 + "The end."
+
+def test_offset_index_url():
+	assert offset_index_url("/home/swpp/readability_users/user/book.txt") == "/home/swpp/readability_users/user/book_offsets.bin"
+
+def test_char_to_token_matches_tokenizer():
+	token_starts = tokenizer.decode_with_offsets(tokenizer.encode(BOOK))[1]
+	for stride in (1, 16):
+		offset_index = OffsetIndex.build(BOOK, stride=stride)
+		assert offset_index.num_tokens == len(token_starts)
+		assert offset_index.char_to_token(0) == 0
+		assert offset_index.char_to_token(len(BOOK)) == len(token_starts)
+		for char_index in range(1, len(BOOK), 37):
+			exact = sum(1 for start in token_starts if start < char_index)
+			assert abs(offset_index.char_to_token(char_index) - exact) <= stride
+
+def test_token_to_char_matches_tokenizer():
+	token_starts = tokenizer.decode_with_offsets(tokenizer.encode(BOOK))[1]
+	offset_index = OffsetIndex.build(BOOK, stride=1)
+	for token_index in range(0, len(token_starts), 7):
+		assert offset_index.token_to_char(token_index) == token_starts[token_index]
+	assert offset_index.token_to_char(len(token_starts)) == len(BOOK)
+
+def test_exact_token_offsets():
+	token_starts = tokenizer.decode_with_offsets(tokenizer.encode(BOOK))[1]
+	exact = [5, 101, 102, 700]
+	offset_index = OffsetIndex.build(BOOK, stride=64, token_char_starts=token_starts, exact_token_offsets=exact)
+	assert offset_index.num_tokens == len(token_starts)
+	for token_index in exact:
+		assert offset_index.token_to_char(token_index) == token_starts[token_index]
+		assert offset_index.char_to_token(token_starts[token_index]) == token_index
+
+def test_save_and_load(tmp_path):
+	book_content_url = str(tmp_path / "book.txt")
+	built = get_offset_index(book_content_url, BOOK)
+	loaded = OffsetIndex.load(offset_index_url(book_content_url))
+	assert list(loaded.char_offsets) == list(built.char_offsets)
+	assert list(loaded.token_offsets) == list(built.token_offsets)
+	assert (loaded.num_chars, loaded.num_tokens, loaded.stride) == (built.num_chars, built.num_tokens, built.stride)
+
+def test_empty_book():
+	offset_index = OffsetIndex.build("")
+	assert offset_index.char_to_token(0) == 0
+	assert offset_index.token_to_char(0) == 0
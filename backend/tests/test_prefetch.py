@@ -0,0 +1,131 @@
+import sys
+import asyncio
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import AIBackend, ProxyAIBackend, GPT4Backend
+from llama.content_store import content_hash
+from llama.result_cache import ResultCache, ResultKey, SUMMARY
+from llama.prefetch import PrefetchScheduler, ReadingState
+from test_request_pipeline import book
+
+
+class FakeClock:
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+class CountingBackend(AIBackend):
+	# its answers are replayed to GPT-4 requests below
+	backend_name = "gpt-4"
+
+	def __init__(self):
+		self.contents = []
+
+	def precompute_summary_from_intermediate(self, content):
+		self.contents.append(content)
+		yield "prefetched", False
+		yield "\n", True
+
+def prefetched(future):
+	"""
+	:return: result of the scheduling of an observed update, None when nothing was scheduled
+	"""
+	return future.result() if future is not None else None
+
+def make_scheduler(tmp_path, **kwargs):
+	clock = FakeClock()
+	backend = CountingBackend()
+	result_cache = ResultCache(str(tmp_path / "results"))
+	scheduler = PrefetchScheduler(ProxyAIBackend(backend), result_cache, clock=clock, **kwargs)
+	return scheduler, clock, backend, result_cache
+
+def test_reading_speed():
+	state = ReadingState(0.1, 0.0)
+	state.update(0.2, 10.0)
+	assert abs(state.speed - 0.01) < 1e-9
+	# jumping back starts over
+	state.update(0.05, 20.0)
+	assert state.speed is None
+
+def test_prefetches_next_boundary(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	scheduler, clock, backend, result_cache = make_scheduler(tmp_path, lead_seconds=60)
+
+	# the first update gives no speed, and a slow reader is far from the boundary at 0.5
+	assert scheduler.observe("reader", 1, 0.30, book_content_url, summary_tree_url) is None
+	clock.now = 100.0
+	assert prefetched(scheduler.observe("reader", 1, 0.31, book_content_url, summary_tree_url)) is None
+	# speeding up, the boundary is about 10 seconds away
+	clock.now = 110.0
+	assert prefetched(scheduler.observe("reader", 1, 0.45, book_content_url, summary_tree_url)) is True
+	assert backend.contents == ["first half\n\n"]
+	key = ResultKey(content_hash(book_content), 2, 0, SUMMARY, "gpt-4")
+	assert result_cache.get(key)["deltas"] == ["prefetched"]
+
+	# asking for the summary right after the boundary replays the prefetched one
+	gpt4 = GPT4Backend(response_cache=None, result_cache=result_cache)
+	gpt4._astream_from_provider = None
+	async def scenario():
+		return [item async for item in gpt4.aget_summary_from_intermediate(0.51, book_content_url, summary_tree_url)]
+	assert asyncio.run(scenario()) == [("prefetched", False), ("\n", True)]
+
+	# already cached, and nothing after the last leaf
+	clock.now = 111.0
+	assert prefetched(scheduler.observe("reader", 1, 0.46, book_content_url, summary_tree_url)) is None
+	clock.now = 112.0
+	assert prefetched(scheduler.observe("reader", 1, 0.99, book_content_url, summary_tree_url)) is None
+	assert scheduler.stats()["completed"] == 1
+	scheduler.shutdown()
+
+def test_user_budget(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	scheduler, clock, backend, result_cache = make_scheduler(tmp_path, lead_seconds=60, user_budget_tokens=2)
+
+	scheduler.observe("reader", 1, 0.40, book_content_url, summary_tree_url)
+	clock.now = 10.0
+	assert prefetched(scheduler.observe("reader", 1, 0.45, book_content_url, summary_tree_url)) is None
+	# the prompt alone does not fit the budget
+	assert scheduler.stats()["over_budget"] == 1
+	assert backend.contents == []
+
+	# other users have budgets of their own
+	scheduler.user_budget_tokens = 1000
+	scheduler.observe("another reader", 1, 0.40, book_content_url, summary_tree_url)
+	clock.now = 20.0
+	assert prefetched(scheduler.observe("another reader", 1, 0.45, book_content_url, summary_tree_url)) is True
+	assert len(backend.contents) == 1
+	scheduler.shutdown()
+
+def test_idle_budgets_are_forgotten(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	scheduler, clock, backend, result_cache = make_scheduler(tmp_path, lead_seconds=60, budget_window_seconds=100)
+	scheduler.observe("reader", 1, 0.40, book_content_url, summary_tree_url)
+	clock.now = 10.0
+	assert prefetched(scheduler.observe("reader", 1, 0.45, book_content_url, summary_tree_url)) is True
+	assert scheduler.stats()["budgets"] == 1
+
+	# the window of the first reader has passed when another session starts
+	clock.now = 200.0
+	scheduler.observe("another reader", 2, 0.10, book_content_url, summary_tree_url)
+	assert scheduler.stats()["budgets"] == 0
+	scheduler.shutdown()
+
+def test_progress_updates_only_estimate_the_speed(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	scheduler, clock, backend, result_cache = make_scheduler(tmp_path, lead_seconds=60)
+	scheduler.observe("reader", 1, 0.40, book_content_url, summary_tree_url)
+	clock.now = 10.0
+	# the tree is loaded on the prefetch pool, where a missing one only fails the prefetch
+	future = scheduler.observe("reader", 1, 0.45, book_content_url, str(tmp_path / "missing_summary.sumtree"))
+	assert prefetched(future) is None
+	assert scheduler.stats()["failed"] == 1
+	scheduler.shutdown()
+
+def test_default_backend_follows_ai_backend(tmp_path, monkeypatch):
+	monkeypatch.setenv("AI_BACKEND", "fake")
+	scheduler = PrefetchScheduler(result_cache=ResultCache(str(tmp_path / "results")))
+	# created on the first prefetch, not on import
+	assert scheduler._ai_backend is None
+	assert scheduler.ai_backend.backend_name == "fake"
+	scheduler.shutdown()
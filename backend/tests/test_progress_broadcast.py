@@ -0,0 +1,72 @@
+import sys
+import asyncio
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.progress_broadcast import ProgressBroadcast
+from llama.summary_jobs import RUNNING, DONE
+
+
+class FakeProgress:
+	"""
+	progress of a build that advances by one inference on every read
+	"""
+	def __init__(self, num_total=3, fail_at=None):
+		self.num_total = num_total
+		self.fail_at = fail_at
+		self.reads = 0
+
+	def __call__(self):
+		num_current = min(self.reads, self.num_total)
+		self.reads += 1
+		if num_current == self.fail_at:
+			raise ConnectionError("job queue unavailable")
+		return {
+			"book_id": 1,
+			"num_current_inference": num_current,
+			"num_total_inference": self.num_total,
+			"status": DONE if num_current == self.num_total else RUNNING,
+		}
+
+async def collect(stream):
+	return [progress async for progress in stream]
+
+def test_subscribers_share_one_poll():
+	broadcast = ProgressBroadcast(poll_seconds=0.02)
+	read = FakeProgress()
+
+	async def main():
+		return await asyncio.gather(*[collect(broadcast.subscribe(1, read)) for _ in range(10)])
+
+	results = asyncio.run(main())
+	assert read.reads == broadcast.stats()["reads"] == 4
+	assert results == [results[0]] * 10
+	assert [progress["num_current_inference"] for progress in results[0]] == [0, 1, 2, 3]
+	assert results[0][-1]["status"] == DONE
+	assert broadcast.stats()["polled_books"] == 0
+
+def test_poll_stops_with_its_last_subscriber():
+	broadcast = ProgressBroadcast(poll_seconds=0.02)
+	read = FakeProgress(num_total=1000)
+
+	async def main():
+		stream = broadcast.subscribe(1, read)
+		first = await stream.__anext__()
+		assert broadcast.stats()["polled_books"] == 1
+		await stream.aclose()
+		await asyncio.sleep(0.1)
+		return first
+
+	assert asyncio.run(main())["num_current_inference"] == 0
+	assert broadcast.stats()["polled_books"] == 0
+	assert read.reads <= 2
+
+def test_read_errors_reach_every_subscriber():
+	broadcast = ProgressBroadcast(poll_seconds=0.02)
+	read = FakeProgress(fail_at=1)
+
+	async def main():
+		return await asyncio.gather(*[collect(broadcast.subscribe(1, read)) for _ in range(3)],
+					    return_exceptions=True)
+
+	assert all(isinstance(result, ConnectionError) for result in asyncio.run(main()))
+	assert broadcast.stats()["polled_books"] == 0
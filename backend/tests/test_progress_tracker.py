@@ -0,0 +1,50 @@
+import sys
+import time
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+import llama.progress_tracker
+from llama.progress_tracker import ProgressTracker, read_progress
+from llama.summary_jobs import SummaryJobQueue, RUNNING, DONE, QUEUED
+
+
+def test_persists_at_coarse_intervals():
+	tracker = ProgressTracker(flush_seconds=0.05)
+	persisted, changes = [], []
+	progress = tracker.start(1, 10, persist=lambda *args: persisted.append(args), on_change=lambda *args: changes.append(args))
+	for _ in range(3):
+		progress.advance()
+	assert persisted == [(0, 10)]
+	assert tracker.get(1) == {"book_id": 1, "num_current_inference": 3, "num_total_inference": 10, "status": RUNNING}
+
+	time.sleep(0.06)
+	progress.advance()
+	assert persisted == [(0, 10), (4, 10)]
+	progress.finish()
+	assert persisted == [(0, 10), (4, 10), (10, 10)]
+	assert changes == [(0, 10), (1, 10), (2, 10), (3, 10), (4, 10), (10, 10)]
+	assert tracker.get(1)["status"] == DONE
+	assert tracker.get(2) is None
+
+def test_resumed_progress_starts_from_checkpoints():
+	tracker = ProgressTracker()
+	persisted = []
+	progress = tracker.start(1, 10, num_current=7, persist=lambda *args: persisted.append(args))
+	progress.advance(5)
+	assert tracker.get(1)["num_current_inference"] == 10
+	assert persisted == [(7, 10)]
+
+def test_read_progress_from_job_queue(tmp_path, monkeypatch):
+	monkeypatch.setattr(llama.progress_tracker, "progress_tracker", ProgressTracker())
+	job_queue = SummaryJobQueue(str(tmp_path / "jobs.sqlite3"))
+	assert read_progress(1, job_queue) is None
+
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	assert read_progress(1, job_queue) == {"book_id": 1, "num_current_inference": 0, "num_total_inference": 0, "status": QUEUED}
+	job_queue.claim("worker-a")
+	job_queue.report_progress(job_id, "worker-a", 3, 7)
+	assert read_progress(1, job_queue) == {"book_id": 1, "num_current_inference": 3, "num_total_inference": 7, "status": RUNNING}
+	# a worker that lost the job does not report anymore
+	job_queue.report_progress(job_id, "worker-b", 6, 7)
+	assert read_progress(1, job_queue)["num_current_inference"] == 3
+
+	llama.progress_tracker.progress_tracker.start(1, 7, num_current=5)
+	assert read_progress(1, job_queue)["num_current_inference"] == 5
@@ -0,0 +1,83 @@
+import os
+import sys
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import GPT4Backend
+from llama.constants import GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW, GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE
+from llama.prompt_builder import (
+	MODEL_CONTEXT_TOKENS, MESSAGE_OVERHEAD_TOKENS, PromptReport, content_budget, fit_content, output_budget, tokenizer
+)
+from llama.request_pipeline import TEXT, prepare_request, prepare_content
+import llama.custom_type
+from test_request_pipeline import book
+from test_response_cache import FakeCompletions
+
+
+def test_fit_content_keeps_the_end():
+	content = "".join(f"word{i} " for i in range(500))
+	assert fit_content(content) == (content, len(tokenizer.encode(content)), 0)
+
+	fitted = fit_content(content, 100)
+	assert fitted.num_tokens == 100
+	assert fitted.trimmed_tokens == len(tokenizer.encode(content)) - 100
+	assert content.endswith(fitted.content)
+
+def test_content_budget():
+	system_tokens = len(tokenizer.encode(GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW))
+	assert content_budget("gpt-4", GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW) == \
+		MODEL_CONTEXT_TOKENS["gpt-4"] - output_budget("gpt-4") - system_tokens - MESSAGE_OVERHEAD_TOKENS
+	assert content_budget("gpt-3.5-turbo", "system") < content_budget("gpt-4", "system")
+
+def test_raw_text_falls_back_to_summary_tree(book):
+	book_content, book_content_url, summary_tree_url = book
+	read_tokens = len(tokenizer.encode(prepare_content(TEXT, 0.75, book_content_url)))
+
+	fitting = prepare_request(TEXT, 0.75, book_content_url, max_content_tokens=read_tokens)
+	assert (fitting.trimmed_tokens, fitting.fell_back, fitting.num_tokens) == (0, False, read_tokens)
+
+	# the tree stored next to the book replaces the raw text that does not fit
+	fallback = prepare_request(TEXT, 0.75, book_content_url, max_content_tokens=read_tokens // 2)
+	assert fallback.fell_back
+	assert fallback.content.startswith("first half\n\n")
+	assert fallback.num_tokens <= read_tokens // 2
+
+	# without a tree the oldest text is trimmed
+	os.remove(summary_tree_url)
+	trimmed = prepare_request(TEXT, 0.75, book_content_url, max_content_tokens=100)
+	assert (trimmed.num_tokens, trimmed.fell_back) == (100, False)
+	assert trimmed.trimmed_tokens == read_tokens - 100
+
+def test_backend_reports_prompt_tokens(book, monkeypatch):
+	book_content, book_content_url, summary_tree_url = book
+	report = PromptReport()
+	monkeypatch.setattr(llama.custom_type, "prompt_report", report)
+	backend = GPT4Backend(response_cache=None)
+	backend.completion_with_backoff = FakeCompletions(["a summary"])
+
+	list(backend.get_summary_from_text(0.5, book_content_url))
+	assert backend.completion_with_backoff.requests[0]["max_tokens"] == output_budget("gpt-4")
+	stats = report.stats()["gpt-4"]
+	read_tokens = len(tokenizer.encode(prepare_content(TEXT, 0.5, book_content_url)))
+	system_tokens = len(tokenizer.encode(GPT_SYSTEM_SUMMARY_PROMPT_FROM_RAW))
+	assert stats["requests"] == 1
+	assert stats["prompt_tokens"] == read_tokens + system_tokens + MESSAGE_OVERHEAD_TOKENS
+	assert (stats["trimmed"], stats["fallbacks"]) == (0, 0)
+
+def test_fallback_is_answered_like_the_summary_tree(book, monkeypatch):
+	book_content, book_content_url, summary_tree_url = book
+	report = PromptReport()
+	monkeypatch.setattr(llama.custom_type, "prompt_report", report)
+	# room for 300 tokens of summaries and raw text after the intermediate prompt, less than the text read
+	intermediate_tokens = len(tokenizer.encode(GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE))
+	context_tokens = output_budget("gpt-4") + intermediate_tokens + MESSAGE_OVERHEAD_TOKENS + 300
+	monkeypatch.setitem(MODEL_CONTEXT_TOKENS, "gpt-4", context_tokens)
+	backend = GPT4Backend(response_cache=None)
+	backend.completion_with_backoff = FakeCompletions(["a summary"])
+
+	list(backend.get_summary_from_text(0.75, book_content_url))
+	messages = backend.completion_with_backoff.requests[0]["messages"]
+	assert messages[0]["content"] == GPT_SYSTEM_SUMMARY_PROMPT_FROM_INTERMEDIATE
+	assert len(tokenizer.encode(messages[1]["content"])) == 300
+	stats = report.stats()["gpt-4"]
+	assert stats["fallbacks"] == 1
+	# the request fills the context of the intermediate prompt exactly
+	assert stats["prompt_tokens"] == context_tokens - output_budget("gpt-4")
@@ -0,0 +1,18 @@
+import sys
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from benchmarks.reduction_fan_out import format_results, run_benchmark
+from benchmarks.fake_provider import FakeProviderConfig
+from llama.preprocess_summary import BUDGET_FAN_OUT
+
+
+def test_calls_shrink_with_the_fan_out():
+	config = FakeProviderConfig(ttft_seconds=0.0, tokens_per_second=1e5, output_tokens=16)
+	results = run_benchmark(["2", "4", BUDGET_FAN_OUT], 20000, config, sample_texts=("the_lottery.txt",))
+	by_fan_out = results["the_lottery.txt"]
+	# 6 leaves reduced in pairs to 3, then 1 summary; in one call of all 6 with fan-out 4 or the budget
+	assert [by_fan_out[fan_out]["calls"] for fan_out in ("2", "4", BUDGET_FAN_OUT)] == [10, 7, 7]
+	assert by_fan_out[BUDGET_FAN_OUT]["fan_out"] == 6
+	assert by_fan_out["2"]["depth"] == 3
+	assert by_fan_out["4"]["depth"] == by_fan_out[BUDGET_FAN_OUT]["depth"] == 2
+	assert by_fan_out["2"]["prompt_tokens"] > by_fan_out[BUDGET_FAN_OUT]["prompt_tokens"]
+	assert "budget=6" in format_results(results)
@@ -0,0 +1,103 @@
+import sys
+import asyncio
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import Summary
+from llama.offset_index import build_offset_index, tokenizer
+from llama.summary_tree_format import write_summary_tree
+from llama.request_pipeline import (
+	TEXT, INTERMEDIATE, BUCKETS_PER_LEAF, PreparePool, StageTimings, prepare_content, prepare_request, timed_stream
+)
+import llama.request_pipeline
+
+
+@pytest.fixture
+def book(tmp_path):
+	book_content = "".join(f"Sentence number {i} of the story. " for i in range(200))
+	book_content_url = str(tmp_path / "book.txt")
+	with open(book_content_url, "w") as book_file:
+		book_file.write(book_content)
+	build_offset_index(book_content_url, book_content)
+
+	num_tokens = len(tokenizer.encode(book_content))
+	half = num_tokens // 2
+	leaves = [
+		Summary(start_idx=0, end_idx=half - 1, summary_content="first half", children=[]),
+		Summary(start_idx=half, end_idx=num_tokens - 1, summary_content="second half", children=[]),
+	]
+	root = Summary(start_idx=0, end_idx=num_tokens - 1, summary_content="whole", children=leaves)
+	for leaf in leaves:
+		leaf.parent = root
+	summary_tree_url = str(tmp_path / "book_summary.sumtree")
+	write_summary_tree(root, summary_tree_url)
+	return book_content, book_content_url, summary_tree_url
+
+def test_prepare_content(book):
+	book_content, book_content_url, summary_tree_url = book
+	assert prepare_content(TEXT, 0.25, book_content_url) == book_content[:int(0.25 * len(book_content))]
+
+	# in the second leaf, the first half is summarized and only the rest of the read text is raw
+	content = prepare_content(INTERMEDIATE, 0.75, book_content_url, summary_tree_url)
+	summaries, raw_text = content.split("\n\n", 1)
+	assert summaries == "first half"
+	assert book_content[:int(0.75 * len(book_content))].endswith(raw_text)
+	assert len(raw_text) < len(book_content) / 2
+
+	with pytest.raises(ValueError):
+		prepare_content("audio", 0.5, book_content_url)
+
+def test_prepare_request_locates_reader(book):
+	book_content, book_content_url, summary_tree_url = book
+	first = prepare_request(INTERMEDIATE, 0.51, book_content_url, summary_tree_url)
+	nearby = prepare_request(INTERMEDIATE, 0.52, book_content_url, summary_tree_url)
+	later = prepare_request(INTERMEDIATE, 0.99, book_content_url, summary_tree_url)
+	other_leaf = prepare_request(INTERMEDIATE, 0.25, book_content_url, summary_tree_url)
+
+	assert first.content == prepare_content(INTERMEDIATE, 0.51, book_content_url, summary_tree_url)
+	assert first.content_hash == later.content_hash == other_leaf.content_hash
+	# readers close to each other share a bucket, the end of the leaf is the last bucket
+	assert (first.leaf_id, first.bucket) == (nearby.leaf_id, nearby.bucket) == (2, 0)
+	assert (later.leaf_id, later.bucket) == (2, BUCKETS_PER_LEAF - 1)
+	assert other_leaf.leaf_id == 1
+
+	text = prepare_request(TEXT, 0.99, book_content_url)
+	assert (text.leaf_id, text.bucket) == (0, BUCKETS_PER_LEAF - 1)
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_prepare_pool(book, kind, monkeypatch):
+	book_content, book_content_url, summary_tree_url = book
+	timings = StageTimings()
+	monkeypatch.setattr(llama.request_pipeline, "stage_timings", timings)
+	prepare_pool = PreparePool(kind, max_workers=2)
+
+	async def scenario():
+		return await asyncio.gather(
+			prepare_pool.prepare(TEXT, 0.5, book_content_url),
+			prepare_pool.prepare(INTERMEDIATE, 0.75, book_content_url, summary_tree_url),
+		)
+
+	try:
+		text_content, intermediate_content = asyncio.run(scenario())
+	finally:
+		prepare_pool.shutdown()
+	assert text_content.content == prepare_content(TEXT, 0.5, book_content_url)
+	assert intermediate_content.content == prepare_content(INTERMEDIATE, 0.75, book_content_url, summary_tree_url)
+	assert timings.stats()["prepare"]["count"] == 2
+
+def test_timed_stream(monkeypatch):
+	timings = StageTimings()
+	monkeypatch.setattr(llama.request_pipeline, "stage_timings", timings)
+
+	async def stream():
+		await asyncio.sleep(0.02)
+		yield "a", False
+		await asyncio.sleep(0.02)
+		yield "\n", True
+
+	async def scenario():
+		return [item async for item in timed_stream(stream())]
+
+	assert asyncio.run(scenario()) == [("a", False), ("\n", True)]
+	stats = timings.stats()
+	assert stats["model_first_token"]["count"] == stats["model_stream"]["count"] == 1
+	assert 0.02 <= stats["model_first_token"]["total_seconds"] < stats["model_stream"]["total_seconds"]
@@ -0,0 +1,123 @@
+import os
+import sys
+import pytest
+import asyncio
+import threading
+from types import SimpleNamespace
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import GPT4Backend, GPT3Backend
+from llama.response_cache import ResponseCache, ResponseCacheMiss, request_key, REPLAY, OFF
+
+
+def chunk(content=None, finish_reason=None):
+	return SimpleNamespace(choices=[SimpleNamespace(finish_reason=finish_reason, delta=SimpleNamespace(content=content))])
+
+class FakeCompletions:
+	def __init__(self, deltas):
+		self.deltas = deltas
+		self.requests = []
+
+	def __call__(self, **kwargs):
+		self.requests.append(kwargs)
+		return iter([chunk(delta) for delta in self.deltas] + [chunk(finish_reason="stop")])
+
+def make_backend(backend_class, response_cache, deltas=("Hello", ", ", "world")):
+	backend = backend_class(response_cache=response_cache)
+	backend.completion_with_backoff = FakeCompletions(list(deltas))
+	return backend
+
+def test_replays_cached_response(tmp_path):
+	response_cache = ResponseCache(str(tmp_path))
+	backend = make_backend(GPT4Backend, response_cache)
+
+	first = list(backend.precompute_intermediate_from_text("a passage"))
+	second = list(backend.precompute_intermediate_from_text("a passage"))
+	assert first == second == [("Hello", False), (", ", False), ("world", False), ("\n", True)]
+	assert len(backend.completion_with_backoff.requests) == 1
+
+	stats = response_cache.stats()
+	assert (stats["hits"], stats["misses"], stats["stores"]) == (1, 1, 1)
+	assert stats["dollars_saved"] > 0
+	assert stats["seconds_saved"] >= 0
+
+def test_key_covers_model_and_prompt(tmp_path):
+	response_cache = ResponseCache(str(tmp_path))
+	gpt4 = make_backend(GPT4Backend, response_cache)
+	gpt3 = make_backend(GPT3Backend, response_cache)
+
+	list(gpt4.precompute_intermediate_from_text("a passage"))
+	list(gpt4.precompute_final_from_intermediate("a passage"))
+	list(gpt3.precompute_intermediate_from_text("a passage"))
+	list(gpt4.precompute_intermediate_from_text("another passage"))
+	assert len(gpt4.completion_with_backoff.requests) == 3
+	assert len(gpt3.completion_with_backoff.requests) == 1
+	assert request_key("gpt-4", "system", "user") != request_key("gpt-4", "systemuser", "")
+
+def test_abandoned_stream_is_not_stored(tmp_path):
+	response_cache = ResponseCache(str(tmp_path))
+	backend = make_backend(GPT4Backend, response_cache)
+
+	stream = backend.precompute_intermediate_from_text("a passage")
+	next(stream)
+	stream.close()
+	list(backend.precompute_intermediate_from_text("a passage"))
+	assert len(backend.completion_with_backoff.requests) == 2
+
+def test_replay_and_off_modes(tmp_path):
+	backend = make_backend(GPT4Backend, ResponseCache(str(tmp_path), mode=REPLAY))
+	with pytest.raises(ResponseCacheMiss):
+		list(backend.precompute_intermediate_from_text("a passage"))
+	assert backend.completion_with_backoff.requests == []
+
+	list(make_backend(GPT4Backend, ResponseCache(str(tmp_path))).precompute_intermediate_from_text("a passage"))
+	assert list(backend.precompute_intermediate_from_text("a passage"))[-1] == ("\n", True)
+
+	backend = make_backend(GPT4Backend, ResponseCache(str(tmp_path), mode=OFF))
+	list(backend.precompute_intermediate_from_text("a passage"))
+	assert len(backend.completion_with_backoff.requests) == 1
+
+def test_evicts_least_recently_used(tmp_path):
+	response_cache = ResponseCache(str(tmp_path), max_bytes=10 ** 6)
+	response_cache.put("gpt-4", "system", "first", ["x" * 300], 1.0)
+	entry_size = response_cache.stats()["bytes"]
+	response_cache.max_bytes = int(entry_size * 2.5)
+
+	response_cache.put("gpt-4", "system", "second", ["x" * 300], 1.0)
+	first_path = response_cache._path(request_key("gpt-4", "system", "first"))
+	second_path = response_cache._path(request_key("gpt-4", "system", "second"))
+	os.utime(first_path, ns=(1, 1))
+	os.utime(second_path, ns=(2, 2))
+	# reading an entry makes it the most recently used
+	assert response_cache.get("gpt-4", "system", "first") is not None
+	response_cache.put("gpt-4", "system", "third", ["x" * 300], 1.0)
+
+	assert response_cache.get("gpt-4", "system", "second") is None
+	assert response_cache.get("gpt-4", "system", "first") is not None
+	assert response_cache.get("gpt-4", "system", "third") is not None
+	assert response_cache.stats()["evictions"] == 1
+	assert response_cache.stats()["bytes"] <= response_cache.max_bytes
+
+def test_async_stream_reads_and_writes_off_the_event_loop(tmp_path):
+	response_cache = ResponseCache(str(tmp_path))
+	threads = []
+	for name in ("_load", "_store"):
+		method = getattr(response_cache, name)
+		def recorded(*args, method=method):
+			threads.append(threading.get_ident())
+			return method(*args)
+		setattr(response_cache, name, recorded)
+
+	async def provider():
+		yield "Hello", False
+		yield "\n", True
+
+	async def scenario():
+		results = [[item async for item in response_cache.astream("gpt-4", "system", "user", provider)]
+			   for _ in range(2)]
+		return results, threading.get_ident()
+
+	results, loop_thread = asyncio.run(scenario())
+	assert results == [[("Hello", False), ("\n", True)]] * 2
+	# a miss, a store and a hit
+	assert len(threads) == 3 and loop_thread not in threads
+	assert response_cache.stats()["hits"] == 1
@@ -0,0 +1,134 @@
+import sys
+import asyncio
+import threading
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import Summary, AIBackend, ProxyAIBackend, GPT4Backend, GPT3Backend
+from llama.flat_summary_tree import FlatSummaryTree
+from llama.content_store import content_hash
+from llama.result_cache import ResultCache, ResultKey, SUMMARY, QUIZ
+from llama.preprocess_summary import precompute_leaf_results
+from test_request_pipeline import book
+
+
+class FakeProvider:
+	def __init__(self):
+		self.requests = []
+
+	def __call__(self, system_prompt, content):
+		self.requests.append((system_prompt, content))
+		return self.stream(len(self.requests))
+
+	async def stream(self, number):
+		yield f"answer {number}", False
+		yield "\n", True
+
+def make_backend(result_cache, backend_class=GPT4Backend):
+	backend = backend_class(response_cache=None, result_cache=result_cache)
+	backend._astream_from_provider = FakeProvider()
+	return backend
+
+def collect(stream):
+	async def scenario():
+		return [item async for item in stream]
+	return asyncio.run(scenario())
+
+def test_replays_answer_of_the_same_bucket(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	result_cache = ResultCache(str(tmp_path / "results"))
+	backend = make_backend(result_cache)
+
+	first = collect(backend.aget_summary_from_intermediate(0.51, book_content_url, summary_tree_url))
+	nearby = collect(backend.aget_summary_from_intermediate(0.52, book_content_url, summary_tree_url))
+	assert first == nearby == [("answer 1", False), ("\n", True)]
+	assert len(backend._astream_from_provider.requests) == 1
+
+	# another leaf, another bucket or a quiz is a new answer
+	collect(backend.aget_summary_from_intermediate(0.25, book_content_url, summary_tree_url))
+	collect(backend.aget_summary_from_intermediate(0.99, book_content_url, summary_tree_url))
+	quiz = collect(backend.aget_quiz_from_intermediate(0.51, book_content_url, summary_tree_url))
+	assert quiz == [("answer 4", False), ("\n", True)]
+	assert len(backend._astream_from_provider.requests) == 4
+
+	stats = result_cache.stats()
+	assert (stats["hits"], stats["stores"]) == (1, 4)
+	assert stats["dollars_saved"] > 0
+
+def test_backends_do_not_share_answers(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	result_cache = ResultCache(str(tmp_path / "results"))
+	gpt4 = make_backend(result_cache)
+	gpt3 = make_backend(result_cache, GPT3Backend)
+
+	collect(gpt4.aget_summary_from_intermediate(0.51, book_content_url, summary_tree_url))
+	assert collect(gpt3.aget_summary_from_intermediate(0.51, book_content_url, summary_tree_url)) == [
+		("answer 1", False), ("\n", True)]
+	assert len(gpt3._astream_from_provider.requests) == 1
+	assert collect(ProxyAIBackend(gpt4).aget_summary_from_intermediate(0.51, book_content_url, summary_tree_url)) == [
+		("answer 1", False), ("\n", True)]
+	assert len(gpt4._astream_from_provider.requests) == 1
+
+def test_cache_is_read_and_written_off_the_event_loop(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	result_cache = ResultCache(str(tmp_path / "results"))
+	threads = []
+	for name in ("_load", "_store"):
+		method = getattr(result_cache, name)
+		def recorded(*args, method=method):
+			threads.append(threading.get_ident())
+			return method(*args)
+		setattr(result_cache, name, recorded)
+	backend = make_backend(result_cache)
+
+	async def scenario():
+		for _ in range(2):
+			[item async for item in backend.aget_quiz_from_intermediate(0.51, book_content_url, summary_tree_url)]
+		return threading.get_ident()
+
+	loop_thread = asyncio.run(scenario())
+	# a miss, a store and a hit
+	assert len(threads) == 3 and loop_thread not in threads
+
+def test_abandoned_answer_is_not_stored(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	result_cache = ResultCache(str(tmp_path / "results"))
+	backend = make_backend(result_cache)
+
+	async def scenario():
+		stream = backend.aget_quiz_from_text(0.5, book_content_url)
+		await stream.__anext__()
+		await stream.aclose()
+
+	asyncio.run(scenario())
+	key = ResultKey(content_hash(book_content), 0, 2, QUIZ, "gpt-4")
+	assert not result_cache.contains(key)
+
+class LeafSummaryBackend(AIBackend):
+	backend_name = "gpt-4"
+
+	def __init__(self):
+		self.contents = []
+
+	def precompute_summary_from_intermediate(self, content):
+		self.contents.append(content)
+		yield "summary up to here", False
+		yield "\n", True
+
+def test_precompute_leaf_results(book, tmp_path):
+	book_content, book_content_url, summary_tree_url = book
+	leaves = [Summary(start_idx=i * 10, end_idx=i * 10 + 9, summary_content=f"leaf {i}", children=[]) for i in range(3)]
+	root = Summary(start_idx=0, end_idx=29, summary_content="root", children=leaves)
+	for leaf in leaves:
+		leaf.parent = root
+	summary_tree = FlatSummaryTree.from_summary(root)
+	result_cache = ResultCache(str(tmp_path / "results"))
+	backend = LeafSummaryBackend()
+
+	assert precompute_leaf_results(ProxyAIBackend(backend), book_content, summary_tree, result_cache) == 2
+	# the first leaf has nothing before it
+	assert sorted(backend.contents) == ["leaf 0\n\n", "leaf 0\n\nleaf 1\n\n"]
+	key = ResultKey(content_hash(book_content), 3, 0, SUMMARY, "gpt-4")
+	assert result_cache.get(key)["deltas"] == ["summary up to here"]
+
+	# results already stored are not generated again
+	assert precompute_leaf_results(ProxyAIBackend(backend), book_content, summary_tree, result_cache) == 0
+	assert len(backend.contents) == 2
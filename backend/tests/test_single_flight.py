@@ -0,0 +1,98 @@
+import sys
+import asyncio
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import GPT4Backend
+from llama.single_flight import SingleFlight
+
+NUM_CHUNKS = 5
+CHUNK_LATENCY = 0.02
+EXPECTED = [(f"{i} ", False) for i in range(NUM_CHUNKS)] + [("\n", True)]
+
+
+class FakeProvider:
+	def __init__(self, fail_after=None):
+		self.fail_after = fail_after
+		self.calls = 0
+		self.closed = 0
+
+	def __call__(self, *args):
+		self.calls += 1
+		return self.stream()
+
+	async def stream(self):
+		try:
+			for i in range(NUM_CHUNKS):
+				await asyncio.sleep(CHUNK_LATENCY)
+				if i == self.fail_after:
+					raise ConnectionError("provider unavailable")
+				yield f"{i} ", False
+			await asyncio.sleep(CHUNK_LATENCY)
+			yield "\n", True
+		finally:
+			self.closed += 1
+
+async def consume(stream, delay=0.0):
+	await asyncio.sleep(delay)
+	return [item async for item in stream]
+
+def test_identical_streams_share_one_generation():
+	single_flight = SingleFlight()
+	provider = FakeProvider()
+
+	async def scenario():
+		# the late subscribers join after a few deltas were produced
+		return await asyncio.gather(*[
+			consume(single_flight.stream("prompt", provider), delay)
+			for delay in (0.0, 0.0, 0.0, 2.5 * CHUNK_LATENCY, 4.5 * CHUNK_LATENCY)
+		])
+
+	assert asyncio.run(scenario()) == [EXPECTED] * 5
+	assert provider.calls == 1
+	assert single_flight.stats() == {"in_flight": 0, "started": 1, "coalesced": 4, "cancelled": 0}
+
+def test_generation_is_cancelled_when_every_subscriber_left():
+	single_flight = SingleFlight()
+	provider = FakeProvider()
+
+	async def scenario():
+		first = single_flight.stream("prompt", provider)
+		second = single_flight.stream("prompt", provider)
+		assert await first.__anext__() == ("0 ", False)
+		assert await second.__anext__() == ("0 ", False)
+		await first.aclose()
+		# one subscriber is left, the generation goes on
+		assert await second.__anext__() == ("1 ", False)
+		await second.aclose()
+		await asyncio.sleep(2 * CHUNK_LATENCY)
+
+	asyncio.run(scenario())
+	assert provider.closed == 1
+	assert single_flight.stats()["cancelled"] == 1
+	assert single_flight.stats()["in_flight"] == 0
+
+def test_errors_reach_every_subscriber():
+	single_flight = SingleFlight()
+	provider = FakeProvider(fail_after=2)
+
+	async def scenario():
+		return await asyncio.gather(*[consume(single_flight.stream("prompt", provider)) for _ in range(3)],
+					    return_exceptions=True)
+
+	results = asyncio.run(scenario())
+	assert all(isinstance(result, ConnectionError) for result in results)
+	assert provider.calls == 1
+
+def test_backend_joins_only_identical_prompts():
+	backend = GPT4Backend(response_cache=None, result_cache=None, single_flight=SingleFlight())
+	backend._astream_from_provider = FakeProvider()
+
+	async def scenario():
+		return await asyncio.gather(
+			consume(backend.astream_completion("system", "user")),
+			consume(backend.astream_completion("system", "user")),
+			consume(backend.astream_completion("system", "another user")),
+		)
+
+	assert asyncio.run(scenario()) == [EXPECTED] * 3
+	assert backend._astream_from_provider.calls == 2
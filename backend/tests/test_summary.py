@@ -2,14 +2,26 @@ import pytest
 import sys
 sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
 from llama.preprocess_summary import (
-    split_large_text, split_list, MAX_SIZE, 
+    split_large_text, split_list, MAX_SIZE, iter_token_windows, iter_slices, count_tokens,
     reduce_multiple_summaries_to_one, reduce_summaries_list, 
-    generate_summary_tree, update_summary_path_url, get_number_of_inferences
+    generate_summary_tree, update_summary_path_url, get_number_of_inferences,
+    build_reduction_plan, SummaryTreeScheduler, get_fan_out, get_fallback, precompute_with_retry, BUDGET_FAN_OUT
 )
-from llama.custom_type import Summary, ProxyAIBackend, GPT4Backend, GPT3Backend
+from llama.chunking import slice_bounds, get_number_of_slices
+from llama.boundary_index import BoundaryIndex, NO_BOUNDARY, SENTENCE, PARAGRAPH, HEADING
+from array import array
+from llama.custom_type import Summary, AIBackend, ProxyAIBackend, GPT4Backend, GPT3Backend
+from contextlib import contextmanager
+import threading
+import time
+from llama.flat_summary_tree import FlatSummaryTree
+import os
+import re
+import pickle
 import random
 import string
 import tiktoken
+import llama.preprocess_summary
 
 tokenizer = tiktoken.get_encoding("cl100k_base")
 def test_split_text():
@@ -21,6 +33,82 @@ def test_split_text():
 	# breakpoint()
 	assert sum([(end_start[0]-end_start[1]+1) for end_start in [(split['end_idx'], split['start_idx']) for split in split_large]]) == len(tokenizer.encode("".join(random_letters)))
 
+def test_token_windows_match_encode():
+	rng = random.Random(0)
+	pieces = list(string.ascii_letters + string.digits + string.punctuation) + [
+		" ", "  ", "\n", "\r\n", "\t", "'s", "'ll", "é", "e\u0301", "한국어", "😀", "a" * 40]
+	for _ in range(200):
+		text = "".join(rng.choices(pieces, k=rng.randrange(300)))
+		for window_chars in (1, 7, 64):
+			windows = list(iter_token_windows(text, window_chars))
+			assert [token for tokens in windows for token in tokens] == tokenizer.encode(text)
+
+def test_iter_slices_streams_the_same_slices(monkeypatch):
+	with open(os.path.join(os.path.dirname(llama.preprocess_summary.__file__), "the_open_boat.txt")) as story_file:
+		story = story_file.read()
+	tokens = tokenizer.encode(story)
+	slices = split_large_text(story)
+	assert len(slices) > 1
+	assert [(split["start_idx"], split["end_idx"]) for split in slices][-1][1] == len(tokens) - 1
+	assert "".join(split["sliced_text"] for split in slices) == story
+	assert list(iter_slices(story, count_tokens(story, 100), window_chars=100)) == slices
+
+	# with the number of tokens known, the first slice is yielded after tokenizing little more than it
+	encoded_chars = []
+	real_tokenizer = llama.preprocess_summary.tokenizer
+
+	class CountingTokenizer:
+		def encode(self, text):
+			encoded_chars.append(len(text))
+			return real_tokenizer.encode(text)
+
+		def decode(self, tokens):
+			return real_tokenizer.decode(tokens)
+
+	monkeypatch.setattr(llama.preprocess_summary, "tokenizer", CountingTokenizer())
+	assert next(iter_slices(story, len(tokens), window_chars=1000)) == slices[0]
+	assert len(slices[0]["sliced_text"]) <= sum(encoded_chars) < len(slices[0]["sliced_text"]) + 2000
+
+	with pytest.raises(ValueError):
+		list(iter_slices(story, len(tokens) + 1))
+	with pytest.raises(ValueError):
+		list(iter_slices(story, len(tokens) - 1))
+
+def test_slice_bounds_move_to_boundaries():
+	rng = random.Random(0)
+	for num_tokens in (1, MAX_SIZE, MAX_SIZE + 1, 10 * MAX_SIZE - 7, 57_321):
+		token_offsets = sorted(rng.sample(range(1, num_tokens), min(num_tokens - 1, num_tokens // 40)))
+		kinds = [rng.choice((SENTENCE, SENTENCE, SENTENCE, PARAGRAPH)) for _ in token_offsets]
+		boundary_index = BoundaryIndex(array('q', token_offsets), array('b', kinds), 0, num_tokens)
+		even = list(slice_bounds(num_tokens))
+		bounds = list(slice_bounds(num_tokens, boundary_index, tolerance=0.1))
+		assert len(bounds) == len(even) == get_number_of_slices(num_tokens)
+		assert bounds[0][0] == 0 and bounds[-1][1] == num_tokens
+		assert all(previous[1] == following[0] for previous, following in zip(bounds, bounds[1:]))
+		assert all(0 < end_idx - start_idx <= MAX_SIZE for start_idx, end_idx in bounds)
+		# random boundaries are dense enough that every cut lands on one, not far from the even cut,
+		# unless the slices are so full that the cuts cannot move
+		if num_tokens <= 0.9 * len(bounds) * MAX_SIZE:
+			assert all(boundary_index.kind_at(start_idx) != NO_BOUNDARY for start_idx, _ in bounds[1:])
+		assert all(abs(bound[0] - even_bound[0]) <= 0.2 * MAX_SIZE for bound, even_bound in zip(bounds, even))
+
+	# the strongest boundary within tolerance wins over nearer sentences
+	boundary_index = BoundaryIndex(array('q', [3500, 3599, 3601, 3700]), array('b', [HEADING, SENTENCE, SENTENCE, PARAGRAPH]), 0, 7200)
+	assert list(slice_bounds(7200, boundary_index, tolerance=0.1)) == [(0, 3500), (3500, 7200)]
+	assert list(slice_bounds(7200, boundary_index, tolerance=0.01)) == [(0, 3599), (3599, 7200)]
+	# no boundary within tolerance: the even cut
+	assert list(slice_bounds(7200, boundary_index, tolerance=0.0)) == [(0, 3600), (3600, 7200)]
+
+def test_iter_slices_cut_at_boundaries():
+	with open(os.path.join(os.path.dirname(llama.preprocess_summary.__file__), "the_open_boat.txt")) as story_file:
+		story = story_file.read()
+	boundary_index = BoundaryIndex.build(story)
+	slices = list(iter_slices(story, boundary_index=boundary_index, window_chars=1000))
+	assert len(slices) == get_number_of_slices(boundary_index.num_tokens)
+	assert "".join(split["sliced_text"] for split in slices) == story
+	assert all(boundary_index.kind_at(split["start_idx"]) >= PARAGRAPH for split in slices)
+	assert all(split["sliced_text"].endswith("\n") for split in slices)
+
 def test_find_included_summary():
 	summary1 = Summary(
 		start_idx=0,
@@ -100,6 +188,58 @@ def test_find_included_summary():
 	assert set(summary1.find_included_summaries(summary1_2_2)) == set([summary1_1, summary1_2_1])
 	assert set(summary1.find_included_summaries(summary1_2_3)) == set([summary1_1, summary1_2_1, summary1_2_2])
 
+def build_random_summary_tree(num_leaves, max_fan_out):
+	summaries_list = [
+		Summary(start_idx=i * 10, end_idx=i * 10 + 9, summary_content=f"leaf{i}", children=[])
+		for i in range(num_leaves)
+	]
+	while len(summaries_list) > 1:
+		reduced_list = []
+		i = 0
+		while i < len(summaries_list):
+			group = summaries_list[i:i + random.randint(2, max_fan_out)]
+			i += len(group)
+			reduced = Summary(start_idx=group[0].start_idx, end_idx=group[-1].end_idx,
+					 summary_content=f"node{len(reduced_list)}_{group[0].start_idx}", children=group)
+			for summary in group:
+				summary.parent = reduced
+			reduced_list.append(reduced)
+		summaries_list = reduced_list
+	return summaries_list[0]
+
+def assert_same_query_results(summary_tree, flat_tree, word_indices):
+	for word_index in word_indices:
+		leaf = summary_tree.find_leaf_summary(word_index)
+		flat_leaf = flat_tree.find_leaf_summary(word_index)
+		if leaf is None:
+			assert flat_leaf is None
+			continue
+		assert (flat_leaf.start_idx, flat_leaf.end_idx, flat_leaf.summary_content) == (leaf.start_idx, leaf.end_idx, leaf.summary_content)
+		included = [(s.start_idx, s.end_idx, s.summary_content) for s in summary_tree.find_included_summaries(leaf)]
+		flat_included = [(s.start_idx, s.end_idx, s.summary_content) for s in flat_tree.find_included_summaries(flat_leaf)]
+		assert flat_included == included
+
+def test_flat_summary_tree():
+	random.seed(7)
+	for num_leaves, max_fan_out in [(1, 2), (2, 2), (7, 2), (100, 3), (513, 5)]:
+		summary_tree = build_random_summary_tree(num_leaves, max_fan_out)
+		flat_tree = summary_tree.to_flat()
+		assert len(flat_tree.leaf_nodes) == num_leaves
+		assert_same_query_results(summary_tree, flat_tree, range(-1, num_leaves * 10 + 2))
+
+def test_summary_slots_and_legacy_pickle():
+	summary = Summary(start_idx=0, end_idx=9, summary_content="summary")
+	assert not hasattr(summary, "__dict__")
+	assert pickle.loads(pickle.dumps(summary)) == summary
+
+	# trees pickled before Summary had __slots__ reference the top-level custom_type module
+	llama_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "llama")
+	sys.path.append(llama_path)
+	with open(os.path.join(llama_path, "medium_summary.pkl"), 'rb') as pickle_file:
+		summary_tree = pickle.load(pickle_file)
+	assert summary_tree.children[0].parent is summary_tree
+	assert_same_query_results(summary_tree, FlatSummaryTree.from_summary(summary_tree), range(0, summary_tree.end_idx + 1, 50))
+
 def test_split_list():
     # Test case with an even-sized list
     list1 = [1, 2, 3, 4, 5, 6]
@@ -162,9 +302,273 @@ def test_get_number_of_inferences():
 	assert get_number_of_inferences(len(list4)) == expected4, "Failed on list smaller than split size"
 	print("fourth case passed")
 
+def test_k_ary_split_list():
+	assert split_list(list(range(10)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7, 8, 9]]
+	assert split_list(list(range(11)), 4) == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9, 10]]
+	assert split_list(list(range(7)), 8) == [list(range(7))]
+	for split_size in range(2, 9):
+		for num_items in range(1, 100):
+			groups = split_list(list(range(num_items)), split_size)
+			assert [item for group in groups for item in group] == list(range(num_items))
+			assert len(groups) == max(num_items // split_size, 1)
+			assert all(len(group) < 2 * split_size for group in groups)
+
+def test_k_ary_number_of_inferences():
+	for fan_out in range(2, 9):
+		for num_leaves in range(1, 200):
+			plan = build_reduction_plan(num_leaves, fan_out)
+			assert num_leaves + len(plan) == get_number_of_inferences(num_leaves, fan_out)
+			assert all(len(node.children) < 2 * fan_out for node in plan)
+			# only the root is a final reduction
+			assert [node.is_intermediate for node in plan] == [True] * (len(plan) - 1) + [False] * bool(plan)
+	assert get_number_of_inferences(100, 4) == 100 + 25 + 6 + 1
+
+def test_capped_reductions_fit_the_fan_out():
+	assert split_list(list(range(11)), 6, capped=True) == [[0, 1, 2, 3, 4], [5, 6, 7, 8, 9, 10]]
+	assert split_list(list(range(3)), 2, capped=True) == [[0], [1, 2]]
+	# 11 leaves of the GPT-4 budget: 2 reductions of at most 6, then the root
+	assert len(build_reduction_plan(11, 6, capped=True)) == 3
+	for fan_out in range(2, 9):
+		for num_leaves in range(1, 200):
+			plan = build_reduction_plan(num_leaves, fan_out, capped=True)
+			assert num_leaves + len(plan) == get_number_of_inferences(num_leaves, fan_out, capped=True)
+			assert max((len(node.children) for node in plan), default=2) <= fan_out
+			assert min((len(node.children) for node in plan), default=2) >= 2
+			# every node but the root is reduced exactly once
+			children = sorted(child for node in plan for child in node.children)
+			assert children == list(range(num_leaves + len(plan) - 1))
+			assert [node.is_intermediate for node in plan] == [True] * (len(plan) - 1) + [False] * bool(plan)
+
+def test_budget_fan_out():
+	assert get_fan_out(ProxyAIBackend(SlowAIBackend()), 4) == 4
+	assert get_fan_out(ProxyAIBackend(SlowAIBackend()), "3") == 3
+	# a backend without a known context reduces pairs
+	assert get_fan_out(ProxyAIBackend(SlowAIBackend()), BUDGET_FAN_OUT) == 2
+	# 7k tokens of GPT-4 content hold 6 summaries of at most 1024 tokens
+	assert get_fan_out(ProxyAIBackend(GPT4Backend(response_cache=None)), BUDGET_FAN_OUT) == 6
+	assert get_fan_out(ProxyAIBackend(GPT3Backend(response_cache=None)), BUDGET_FAN_OUT) == 2
+
+def test_fallback_fits_the_fan_out():
+	assert get_fallback(2, capped=True) is GPT3Backend
+	# pairs and the summary left over reduce 3 summaries, more than GPT-3.5 fits
+	assert get_fallback(2) is None
+	assert get_fallback(6, capped=True) is None
+	scheduler = SummaryTreeScheduler(ProxyAIBackend(GPT4Backend()), FakeDBPool(), 1, fan_out=BUDGET_FAN_OUT)
+	assert (scheduler.fan_out, scheduler.capped, scheduler.fallback) == (6, True, None)
+	scheduler = SummaryTreeScheduler(ProxyAIBackend(GPT3Backend()), FakeDBPool(), 1, fan_out=BUDGET_FAN_OUT)
+	assert (scheduler.fan_out, scheduler.capped, scheduler.fallback) == (2, True, GPT3Backend)
+
+	# without a fallback the same backend is retried
+	backend = SlowAIBackend(latency=0, failures=7)
+	proxy_ai_backend = ProxyAIBackend(backend)
+	assert precompute_with_retry(proxy_ai_backend, "precompute_intermediate_from_text", "slice", None) == "summary of slice\n"
+	assert proxy_ai_backend.summary_generator is backend
+
+def test_scheduler_reduces_k_children():
+	backend = SlowAIBackend(latency=0)
+	db_pool = FakeDBPool()
+	root = SummaryTreeScheduler(ProxyAIBackend(backend), db_pool, 1, fan_out=4).run(make_slices(20))
+	assert len(backend.calls) == get_number_of_inferences(20, 4) == 20 + 5 + 1
+	assert db_pool.books_db.num_current_inference == db_pool.books_db.num_total_inference == 26
+	assert [len(child.children) for child in root.children] == [4, 4, 4, 4, 4]
+	assert [leaf.start_idx for leaf in collect_leaves(root)] == [i * 10 for i in range(20)]
+
 def test_proxy_pattern():
 	ai_backend = ProxyAIBackend(GPT4Backend())
 	assert type(ai_backend.summary_generator) == GPT4Backend
 	ai_backend.summary_generator = GPT3Backend()
 	assert type(ai_backend.summary_generator) == GPT3Backend
 
+
+
+class FakeCursor:
+	def __init__(self, books_db):
+		self.books_db = books_db
+
+	def execute(self, query):
+		match = re.search(r"num_total_inference = (\d+), num_current_inference = (\d+)", query)
+		if match:
+			with self.books_db.lock:
+				self.books_db.num_total_inference = int(match.group(1))
+				self.books_db.num_current_inference = int(match.group(2))
+				self.books_db.num_writes += 1
+
+class FakeBooksDB:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.num_total_inference = 0
+		self.num_current_inference = 0
+		self.num_writes = 0
+
+	def cursor(self):
+		return FakeCursor(self)
+
+	def commit(self):
+		pass
+
+class FakeDBPool:
+	def __init__(self):
+		self.books_db = FakeBooksDB()
+
+	@contextmanager
+	def connection(self):
+		yield self.books_db
+
+class SlowAIBackend(AIBackend):
+	def __init__(self, latency=0.05, max_concurrency=None, failures=0, slow_texts=(), slow_latency=0.3):
+		self.latency = latency
+		self.max_concurrency = max_concurrency
+		self.failures = failures
+		self.slow_texts = slow_texts
+		self.slow_latency = slow_latency
+		self.lock = threading.Lock()
+		self.running = 0
+		self.max_running = 0
+		self.calls = []
+
+	def generate(self, kind, content):
+		with self.lock:
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+			fail = self.failures > 0
+			self.failures -= 1
+			self.calls.append((kind, content, time.perf_counter()))
+		try:
+			time.sleep(self.slow_latency if content in self.slow_texts else self.latency)
+			if fail:
+				raise ConnectionError("provider unavailable")
+			yield f"{kind} of {content}", False
+			yield "\n", True
+		finally:
+			with self.lock:
+				self.running -= 1
+
+	def precompute_intermediate_from_text(self, sliced_text):
+		return self.generate("summary", sliced_text)
+
+	def precompute_intermediate_from_intermediate(self, content):
+		return self.generate("intermediate", content)
+
+	def precompute_final_from_intermediate(self, content):
+		return self.generate("final", content)
+
+def make_slices(num_slices):
+	return [{"sliced_text": f"slice{i}", "start_idx": i * 10, "end_idx": i * 10 + 9} for i in range(num_slices)]
+
+class FallbackAIBackend(SlowAIBackend):
+	def __init__(self):
+		super().__init__(latency=0)
+
+	def precompute_intermediate_from_text(self, sliced_text):
+		yield f"fallback summary of {sliced_text}", False
+		yield "\n", True
+
+def test_fallback_is_per_call():
+	backend = SlowAIBackend(latency=0, failures=6)
+	proxy_ai_backend = ProxyAIBackend(backend)
+	assert precompute_with_retry(proxy_ai_backend, "precompute_intermediate_from_text", "slice",
+				     FallbackAIBackend) == "fallback summary of slice\n"
+	# the calls sharing the proxy keep its backend
+	assert proxy_ai_backend.summary_generator is backend
+	assert precompute_with_retry(proxy_ai_backend, "precompute_intermediate_from_text", "slice",
+				     FallbackAIBackend) == "summary of slice\n"
+	assert len(backend.calls) == 7
+
+def collect_leaves(summary):
+	if not summary.children:
+		return [summary]
+	return [leaf for child in summary.children for leaf in collect_leaves(child)]
+
+def test_build_reduction_plan():
+	for num_leaves in range(1, 40):
+		plan = build_reduction_plan(num_leaves)
+		assert num_leaves + len(plan) == get_number_of_inferences(num_leaves)
+		children = [child for node in plan for child in node.children]
+		assert sorted(children) == list(range(num_leaves + len(plan) - 1))
+	plan = build_reduction_plan(6)
+	assert [node.children for node in plan] == [[0, 1], [2, 3], [4, 5], [6, 7, 8]]
+	assert [node.is_intermediate for node in plan] == [True, True, True, False]
+
+def test_scheduler_summarizes_leaves_concurrently():
+	backend = SlowAIBackend(latency=0.05)
+	db_pool = FakeDBPool()
+
+	started = time.perf_counter()
+	root = SummaryTreeScheduler(ProxyAIBackend(backend), db_pool, 1, max_workers=4).run(make_slices(16))
+	elapsed = time.perf_counter() - started
+
+	leaves = collect_leaves(root)
+	assert [leaf.summary_content for leaf in leaves] == [f"summary of slice{i}\n" for i in range(16)]
+	assert [leaf.start_idx for leaf in leaves] == [i * 10 for i in range(16)]
+	assert (root.start_idx, root.end_idx) == (0, 159)
+	assert backend.max_running == 4
+	assert elapsed < get_number_of_inferences(16) * 0.05 / 2
+	assert db_pool.books_db.num_current_inference == get_number_of_inferences(16)
+	# progress reaches MySQL when the build starts and finishes, not once per inference
+	assert db_pool.books_db.num_writes == 2
+
+def test_scheduler_respects_backend_limit():
+	backend = SlowAIBackend(latency=0.01, max_concurrency=1)
+	SummaryTreeScheduler(ProxyAIBackend(backend), FakeDBPool(), 1, max_workers=8).run(make_slices(5))
+	assert backend.max_running == 1
+
+def test_scheduler_retries_failed_calls():
+	backend = SlowAIBackend(latency=0, failures=2)
+	db_pool = FakeDBPool()
+	root = SummaryTreeScheduler(ProxyAIBackend(backend), db_pool, 1, max_workers=1).run(make_slices(1))
+	assert root.summary_content == "summary of slice0\n"
+	assert db_pool.books_db.num_current_inference == 1
+
+def test_scheduler_reduces_without_level_barriers():
+	# slice7 is slow: the reductions over slices 0-5 must not wait for it
+	backend = SlowAIBackend(latency=0.01, slow_texts=("slice7",), slow_latency=0.5)
+	SummaryTreeScheduler(ProxyAIBackend(backend), FakeDBPool(), 1, max_workers=8).run(make_slices(8))
+	slow_leaf_started = next(started for kind, content, started in backend.calls if content == "slice7")
+	first_level_two = min(started for kind, content, started in backend.calls
+			      if content.startswith("intermediate of summary"))
+	assert first_level_two - slow_leaf_started < 0.5
+
+def test_scheduler_reads_leaves_lazily():
+	backend = SlowAIBackend(latency=0.01)
+	produced = []
+
+	def produce_slices():
+		for sliced_text_dict in make_slices(8):
+			time.sleep(0.02)
+			produced.append(time.perf_counter())
+			yield sliced_text_dict
+
+	root = SummaryTreeScheduler(ProxyAIBackend(backend), FakeDBPool(), 1, max_workers=4).run(
+		produce_slices(), {0: (0, 9, "restored")}, num_leaves=8)
+	assert [leaf.summary_content for leaf in collect_leaves(root)] == ["restored"] + [f"summary of slice{i}\n" for i in range(1, 8)]
+	first_leaf_started = min(started for kind, content, started in backend.calls if kind == "summary")
+	assert first_leaf_started < produced[-1]
+
+def test_reduce_summaries_list():
+	leaves = [Summary(start_idx=i * 10, end_idx=i * 10 + 9, summary_content=f"leaf{i}", children=[]) for i in range(3)]
+	root = reduce_summaries_list(ProxyAIBackend(SlowAIBackend(latency=0)), FakeDBPool(), 1, leaves)
+	assert root.summary_content == "final of leaf0\nleaf1\nleaf2\n"
+	assert root.children == leaves
+
+def test_scheduler_resumes_from_checkpoints():
+	backend = SlowAIBackend(latency=0)
+	checkpoints = {}
+	root = SummaryTreeScheduler(
+		ProxyAIBackend(backend), FakeDBPool(), 1,
+		on_node_complete=lambda node_id, summary: checkpoints.__setitem__(
+			node_id, (summary.start_idx, summary.end_idx, summary.summary_content))
+	).run(make_slices(6))
+	assert len(checkpoints) == get_number_of_inferences(6)
+
+	# keep the leaves and the first reduction, as if the worker died afterwards
+	plan = build_reduction_plan(6)
+	partial = {node_id: checkpoints[node_id] for node_id in list(range(6)) + [plan[0].node_id]}
+	resumed_backend = SlowAIBackend(latency=0)
+	db_pool = FakeDBPool()
+	resumed_root = SummaryTreeScheduler(ProxyAIBackend(resumed_backend), db_pool, 1).run(make_slices(6), partial)
+
+	assert len(resumed_backend.calls) == len(plan) - 1
+	assert db_pool.books_db.num_current_inference == get_number_of_inferences(6)
+	assert resumed_root.summary_content == root.summary_content
+	assert [leaf.summary_content for leaf in collect_leaves(resumed_root)] == [leaf.summary_content for leaf in collect_leaves(root)]
+	assert all(child.parent is resumed_root for child in resumed_root.children)
@@ -0,0 +1,64 @@
+import os
+import pickle
+import sys
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.summary_cache import SummaryCache
+from llama.offset_index import offset_index_url
+from llama.custom_type import Summary
+
+
+def write_book(tmp_path, name, content):
+	book_content_url = str(tmp_path / f"{name}.txt")
+	with open(book_content_url, 'w') as book_file:
+		book_file.write(content)
+	return book_content_url
+
+def test_hits_and_misses(tmp_path):
+	cache = SummaryCache()
+	book_content_url = write_book(tmp_path, "book", "hello world")
+	assert cache.get_book_content(book_content_url) == "hello world"
+	assert cache.get_book_content(book_content_url) == "hello world"
+	stats = cache.stats()
+	assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+
+def test_summary_tree_is_deserialized_once(tmp_path):
+	cache = SummaryCache()
+	summary_tree_url = str(tmp_path / "book_summary.pkl")
+	with open(summary_tree_url, 'wb') as pickle_file:
+		pickle.dump(Summary(start_idx=0, end_idx=9, summary_content="summary"), pickle_file)
+	first = cache.get_summary_tree(summary_tree_url)
+	assert cache.get_summary_tree(summary_tree_url) is first
+	assert first.find_leaf_summary(0).summary_content == "summary"
+
+def test_rewritten_file_is_reloaded(tmp_path):
+	cache = SummaryCache()
+	book_content_url = write_book(tmp_path, "book", "first")
+	cache.get_book_content(book_content_url)
+	write_book(tmp_path, "book", "second")
+	os.utime(book_content_url, ns=(0, 1))
+	assert cache.get_book_content(book_content_url) == "second"
+	assert cache.stats()["misses"] == 2
+
+def test_lru_eviction_by_size(tmp_path):
+	first_url = write_book(tmp_path, "first", "a" * 1000)
+	second_url = write_book(tmp_path, "second", "b" * 1000)
+	cache = SummaryCache(max_bytes=sys.getsizeof("a" * 1000) + 10)
+	cache.get_book_content(first_url)
+	cache.get_book_content(second_url)
+	stats = cache.stats()
+	assert stats["entries"] == 1
+	assert stats["evictions"] == 1
+	assert stats["bytes"] <= cache.max_bytes
+	cache.get_book_content(second_url)
+	assert cache.stats()["hits"] == 1
+
+def test_invalidate_book(tmp_path):
+	cache = SummaryCache()
+	book_content_url = write_book(tmp_path, "book", "Once upon a time. " * 50)
+	offset_index = cache.get_offset_index(book_content_url)
+	assert os.path.exists(offset_index_url(book_content_url))
+	assert offset_index.num_chars == len("Once upon a time. " * 50)
+	cache.invalidate_book(book_content_url)
+	stats = cache.stats()
+	assert stats["entries"] == 0
+	assert stats["invalidations"] == 2
@@ -0,0 +1,304 @@
+import sys
+import time
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+import re
+from contextlib import contextmanager
+from llama.custom_type import Summary, AIBackend, ProxyAIBackend
+from llama.summary_tree_format import SUMMARY_TREE_EXTENSION
+from llama.summary_jobs import (
+	SummaryJobQueue, JobCancelled, run_job, run_worker,
+	QUEUED, RUNNING, DONE, FAILED, CANCELLED
+)
+import llama.preprocess_summary
+import llama.progress_tracker
+import threading
+from llama.backend_registry import register_backend
+from llama.progress_tracker import ProgressTracker
+from routers.book import get_summary_progress
+
+
+@pytest.fixture
+def job_queue(tmp_path):
+	return SummaryJobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=60, max_attempts=2)
+
+def make_summary(node_id):
+	return Summary(start_idx=node_id, end_idx=node_id, summary_content=f"node {node_id}", children=[])
+
+def test_claim_by_priority(job_queue):
+	low = job_queue.enqueue(1, "/books/1.txt")
+	high = job_queue.enqueue(2, "/books/2.txt", priority=5)
+	later = job_queue.enqueue(3, "/books/3.txt")
+
+	assert job_queue.claim("worker-a").job_id == high
+	job = job_queue.claim("worker-b")
+	assert (job.job_id, job.book_id, job.status, job.attempts) == (low, 1, RUNNING, 1)
+	assert job_queue.claim("worker-c").job_id == later
+	assert job_queue.claim("worker-d") is None
+
+def test_identical_content_is_summarized_once(job_queue):
+	first = job_queue.enqueue(1, "/books/_content/abc.txt")
+	second = job_queue.enqueue(2, "/books/_content/abc.txt", priority=5)
+	other = job_queue.enqueue(3, "/books/_content/def.txt")
+
+	assert job_queue.claim("worker-a").job_id == second
+	# the first upload waits for the running job, which will write the shared tree
+	assert job_queue.claim("worker-b").job_id == other
+	assert job_queue.claim("worker-c") is None
+	job_queue.complete(second, "worker-a")
+	assert job_queue.claim("worker-c").job_id == first
+
+def test_enqueue_keeps_active_job(job_queue):
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	assert job_queue.enqueue(1, "/books/1.txt", priority=3) == job_id
+	assert job_queue.status(1)["priority"] == 3
+
+def test_expired_lease_is_reclaimed(job_queue):
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	job_queue.claim("worker-a")
+	job_queue.checkpoint(job_id, "worker-a", 0, make_summary(0))
+	assert job_queue.claim("worker-b") is None
+
+	job_queue.lease_seconds = 0
+	time.sleep(0.01)
+	job = job_queue.claim("worker-b")
+	assert (job.job_id, job.worker, job.attempts) == (job_id, "worker-b", 2)
+	assert job_queue.get_checkpoints(job_id) == {0: (0, 0, "node 0")}
+	# the first worker lost its lease and must stop
+	with pytest.raises(JobCancelled):
+		job_queue.checkpoint(job_id, "worker-a", 1, make_summary(1))
+	assert not job_queue.heartbeat(job_id, "worker-a")
+	assert job_queue.heartbeat(job_id, "worker-b")
+
+def test_cancel(job_queue):
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	job_queue.claim("worker-a")
+	job_queue.checkpoint(job_id, "worker-a", 0, make_summary(0))
+
+	assert job_queue.cancel(1) == 1
+	assert job_queue.cancel(1) == 0
+	with pytest.raises(JobCancelled):
+		job_queue.checkpoint(job_id, "worker-a", 1, make_summary(1))
+	status = job_queue.status(1)
+	assert (status["status"], status["num_checkpoints"]) == (CANCELLED, 0)
+	assert job_queue.claim("worker-b") is None
+
+def test_fail_requeues_until_max_attempts(job_queue):
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	job_queue.claim("worker-a")
+	job_queue.fail(job_id, "worker-a", "RuntimeError()")
+	assert job_queue.get_job(job_id).status == QUEUED
+
+	job_queue.claim("worker-a")
+	job_queue.fail(job_id, "worker-a", "RuntimeError()")
+	status = job_queue.status(1)
+	assert (status["status"], status["attempts"], status["error"]) == (FAILED, 2, "RuntimeError()")
+	assert job_queue.status(2) is None
+
+def test_run_job_resumes_from_checkpoints(job_queue, tmp_path, monkeypatch):
+	content_url = tmp_path / "book.txt"
+	content_url.write_text("story")
+	calls = []
+
+	def fake_generate_summary_tree(book_id, story, db_pool, proxy_ai_backend, checkpoints, on_node_complete, on_progress,
+					checkpoint_fan_out, on_fan_out):
+		calls.append(dict(checkpoints))
+		for node_id in range(3):
+			if node_id not in checkpoints:
+				on_node_complete(node_id, make_summary(node_id))
+				if len(calls) == 1 and node_id == 1:
+					raise ConnectionError("worker lost its provider")
+
+	monkeypatch.setattr(llama.preprocess_summary, "generate_summary_tree", fake_generate_summary_tree)
+	job_id = job_queue.enqueue(1, str(content_url))
+
+	assert run_job(job_queue, job_queue.claim("worker-a"), db_pool=None) == QUEUED
+	assert run_job(job_queue, job_queue.claim("worker-a"), db_pool=None) == DONE
+	assert calls == [{}, {0: (0, 0, "node 0"), 1: (1, 1, "node 1")}]
+	assert job_queue.get_job(job_id).status == DONE
+	assert job_queue.get_checkpoints(job_id) == {}
+
+def test_run_job_stops_when_cancelled(job_queue, tmp_path, monkeypatch):
+	content_url = tmp_path / "book.txt"
+	content_url.write_text("story")
+
+	def fake_generate_summary_tree(book_id, story, db_pool, proxy_ai_backend, checkpoints, on_node_complete, on_progress,
+					checkpoint_fan_out, on_fan_out):
+		on_node_complete(0, make_summary(0))
+		job_queue.cancel(book_id)
+		on_node_complete(1, make_summary(1))
+		raise AssertionError("cancelled jobs must not continue")
+
+	monkeypatch.setattr(llama.preprocess_summary, "generate_summary_tree", fake_generate_summary_tree)
+	job_id = job_queue.enqueue(1, str(content_url))
+	assert run_job(job_queue, job_queue.claim("worker-a"), db_pool=None) == CANCELLED
+	assert job_queue.get_job(job_id).status == CANCELLED
+
+class LoadedOnceBackend(AIBackend):
+	instances = 0
+
+	def __init__(self):
+		LoadedOnceBackend.instances += 1
+
+def test_worker_creates_its_backend_once(job_queue, tmp_path, monkeypatch):
+	content_url = tmp_path / "book.txt"
+	content_url.write_text("story")
+	register_backend("loaded-once", LoadedOnceBackend)
+	monkeypatch.setenv("AI_BACKEND", "loaded-once")
+	stop_event = threading.Event()
+	backends = []
+
+	def fake_generate_summary_tree(book_id, story, db_pool, proxy_ai_backend, checkpoints, on_node_complete, on_progress,
+					checkpoint_fan_out, on_fan_out):
+		backends.append(proxy_ai_backend.summary_generator)
+		if len(backends) == 3:
+			stop_event.set()
+
+	monkeypatch.setattr(llama.preprocess_summary, "generate_summary_tree", fake_generate_summary_tree)
+	for book_id in range(3):
+		job_queue.enqueue(book_id, str(content_url))
+	run_worker(job_queue, None, poll_interval=0.01, stop_event=stop_event)
+	assert LoadedOnceBackend.instances == 1
+	assert backends == [backends[0]] * 3
+
+class BooksTable:
+	"""
+	the one row of the Books table read and written by generate_summary_tree and get_summary_progress
+	"""
+	def __init__(self, content_url):
+		self.content_url = content_url
+		self.summary_tree = None
+		self.num_total_inference = None
+		self.num_current_inference = None
+
+	@contextmanager
+	def connection(self):
+		yield self
+
+	def cursor(self):
+		return self
+
+	def commit(self):
+		pass
+
+	def execute(self, query):
+		progress = re.search(r"num_total_inference = (\d+), num_current_inference = (\d+)", query)
+		summary_tree = re.search(r"summary_tree = '([^']*)'", query)
+		if progress:
+			self.num_total_inference, self.num_current_inference = int(progress.group(1)), int(progress.group(2))
+		elif summary_tree:
+			self.summary_tree = summary_tree.group(1)
+		elif query.startswith("SELECT content"):
+			self.result = [(self.content_url,)]
+		elif query.startswith("SELECT num_total_inference"):
+			self.result = [(self.num_total_inference, self.num_current_inference)]
+
+	def fetchall(self):
+		return self.result
+
+def run_job_without_inference(job_queue, tmp_path, monkeypatch, story):
+	content_url = tmp_path / "book.txt"
+	content_url.write_text(story)
+	books_table = BooksTable(str(content_url))
+	job_id = job_queue.enqueue(1, str(content_url))
+	assert run_job(job_queue, job_queue.claim("worker-a"), books_table, proxy_ai_backend=ProxyAIBackend(AIBackend())) == DONE
+	# read from the API process, whose tracker never saw the build
+	monkeypatch.setattr(llama.progress_tracker, "progress_tracker", ProgressTracker())
+	return job_queue.get_job(job_id), books_table
+
+def test_single_leaf_job_reports_progress(job_queue, tmp_path, monkeypatch):
+	job, books_table = run_job_without_inference(job_queue, tmp_path, monkeypatch, "A short story.")
+	assert (job.num_current_inference, job.num_total_inference) == (1, 1)
+	assert (books_table.num_current_inference, books_table.num_total_inference) == (1, 1)
+	assert get_summary_progress(1, books_table, job_queue)["summary_progress"] == 1.0
+
+def test_shared_tree_job_reports_progress(job_queue, tmp_path, monkeypatch):
+	# identical content was summarized before: 3 leaves and their 1 reduction
+	(tmp_path / ("book_summary" + SUMMARY_TREE_EXTENSION)).write_bytes(b"")
+	job, books_table = run_job_without_inference(job_queue, tmp_path, monkeypatch, "word " * 8000)
+	assert (job.num_current_inference, job.num_total_inference) == (4, 4)
+	assert books_table.summary_tree == str(tmp_path / ("book_summary" + SUMMARY_TREE_EXTENSION))
+	assert get_summary_progress(1, books_table, job_queue)["summary_progress"] == 1.0
+
+def test_done_job_without_total_reads_books(job_queue, tmp_path, monkeypatch):
+	# jobs finished before the early returns reported their progress
+	monkeypatch.setattr(llama.progress_tracker, "progress_tracker", ProgressTracker())
+	books_table = BooksTable(str(tmp_path / "book.txt"))
+	books_table.num_total_inference = books_table.num_current_inference = 1
+	job_id = job_queue.enqueue(1, books_table.content_url)
+	job_queue.claim("worker-a")
+	job_queue.complete(job_id, "worker-a")
+	assert get_summary_progress(1, books_table, job_queue)["summary_progress"] == 1.0
+
+class EchoBackend(AIBackend):
+	def answer(self, content):
+		yield content[:20], False
+		yield "\n", True
+
+	precompute_intermediate_from_text = precompute_intermediate_from_intermediate = precompute_final_from_intermediate = answer
+
+def test_failed_precompute_keeps_the_published_tree(job_queue, tmp_path, monkeypatch):
+	def failing_precompute(*args):
+		raise ConnectionError("provider unavailable")
+
+	monkeypatch.setattr(llama.preprocess_summary, "precompute_leaf_results", failing_precompute)
+	content_url = tmp_path / "book.txt"
+	content_url.write_text("word " * 8000)
+	books_table = BooksTable(str(content_url))
+	llama.preprocess_summary.generate_summary_tree(1, content_url.read_text(), books_table,
+						       proxy_ai_backend=ProxyAIBackend(EchoBackend()), precompute_results=True)
+	assert books_table.summary_tree == str(tmp_path / ("book_summary" + SUMMARY_TREE_EXTENSION))
+	assert (books_table.num_current_inference, books_table.num_total_inference) == (4, 4)
+
+def test_checkpoints_of_another_fan_out_are_dropped(job_queue):
+	job_id = job_queue.enqueue(1, "/books/1.txt")
+	job = job_queue.claim("worker-a")
+	assert job.fan_out is None
+	job_queue.record_fan_out(job_id, "worker-a", 2)
+	job_queue.checkpoint(job_id, "worker-a", 0, make_summary(0))
+	job_queue.record_fan_out(job_id, "worker-a", 2)
+	assert list(job_queue.get_checkpoints(job_id)) == [0]
+
+	job_queue.record_fan_out(job_id, "worker-a", 6)
+	assert job_queue.get_checkpoints(job_id) == {}
+	assert job_queue.get_job(job_id).fan_out == 6
+	job_queue.checkpoint(job_id, "worker-a", 0, make_summary(0))
+	# the budget fan-out caps the same number of children, in other nodes
+	job_queue.record_fan_out(job_id, "worker-a", 6, capped=True)
+	assert job_queue.get_checkpoints(job_id) == {}
+	assert job_queue.get_job(job_id).fan_out_capped == 1
+	with pytest.raises(JobCancelled):
+		job_queue.record_fan_out(job_id, "worker-b", 2)
+
+class CountingEchoBackend(EchoBackend):
+	def __init__(self):
+		self.calls = 0
+
+	def answer(self, content):
+		self.calls += 1
+		return super().answer(content)
+
+	precompute_intermediate_from_text = precompute_intermediate_from_intermediate = precompute_final_from_intermediate = answer
+
+def test_resume_needs_the_fan_out_of_the_checkpoints(tmp_path):
+	content_url = tmp_path / "book.txt"
+	# 7 leaves: 3 reductions then the root with a fan-out of 2, 2 then the root with a fan-out of 3
+	content_url.write_text("word " * 27000)
+	checkpoints = {}
+
+	def build(fan_out, **kwargs):
+		backend = CountingEchoBackend()
+		fan_outs = []
+		llama.preprocess_summary.generate_summary_tree(
+			1, content_url.read_text(), BooksTable(str(content_url)), proxy_ai_backend=ProxyAIBackend(backend),
+			fan_out=fan_out, on_fan_out=lambda *resolved: fan_outs.append(resolved), **kwargs)
+		assert fan_outs == [(fan_out, False)]
+		return backend.calls
+
+	assert build(2, on_node_complete=lambda node_id, summary: checkpoints.__setitem__(
+		node_id, (summary.start_idx, summary.end_idx, summary.summary_content))) == 11
+	(tmp_path / ("book_summary" + SUMMARY_TREE_EXTENSION)).unlink()
+	assert build(2, checkpoints=checkpoints, checkpoint_fan_out=(2, False)) == 0
+	(tmp_path / ("book_summary" + SUMMARY_TREE_EXTENSION)).unlink()
+	# the nodes of a fan-out of 3 are other nodes: everything is summarized again
+	assert build(3, checkpoints=checkpoints, checkpoint_fan_out=(2, False)) == 10
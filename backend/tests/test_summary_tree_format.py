@@ -0,0 +1,101 @@
+import os
+import pickle
+from array import array
+import struct
+import sys
+import pytest
+sys.path.append('/home/swpp/swpp-2023-project-team-7/backend/')
+from llama.custom_type import Summary
+from llama.flat_summary_tree import FlatSummaryTree
+import llama.summary_tree_format as summary_tree_format
+from llama.summary_tree_format import (
+	MappedSummaryTree, UnsupportedSummaryTreeVersion, SUMMARY_TREE_HEADER, SECTIONS_V1,
+	write_summary_tree, load_summary_tree, migrated_summary_tree_url, main
+)
+
+
+def build_summary_tree(num_leaves):
+	summaries_list = [
+		Summary(start_idx=i * 10, end_idx=i * 10 + 9, summary_content=f"요약 {i}", children=[])
+		for i in range(num_leaves)
+	]
+	while len(summaries_list) > 1:
+		reduced_list = []
+		for i in range(0, len(summaries_list), 3):
+			group = summaries_list[i:i + 3]
+			reduced = Summary(start_idx=group[0].start_idx, end_idx=group[-1].end_idx,
+					 summary_content=f"reduced {group[0].start_idx}-{group[-1].end_idx}", children=group)
+			for summary in group:
+				summary.parent = reduced
+			reduced_list.append(reduced)
+		summaries_list = reduced_list
+	return summaries_list[0]
+
+def test_round_trip_matches_flat_tree(tmp_path):
+	summary_tree = build_summary_tree(50)
+	path = str(tmp_path / "book_summary.sumtree")
+	write_summary_tree(summary_tree, path)
+
+	mapped_tree = load_summary_tree(path)
+	flat_tree = FlatSummaryTree.from_summary(summary_tree)
+	assert isinstance(mapped_tree, MappedSummaryTree)
+	assert len(mapped_tree) == len(flat_tree)
+	for word_index in range(-1, 502):
+		leaf = flat_tree.find_leaf_summary(word_index)
+		assert mapped_tree.find_leaf_summary(word_index) == leaf
+		if leaf is not None:
+			assert mapped_tree.find_included_summaries(leaf) == flat_tree.find_included_summaries(leaf)
+
+def test_leaf_boundaries(tmp_path):
+	flat_tree = FlatSummaryTree.from_summary(build_summary_tree(10))
+	path = str(tmp_path / "book_summary.sumtree")
+	write_summary_tree(flat_tree, path)
+	assert load_summary_tree(path).leaf_boundaries is None
+
+	flat_tree.leaf_boundaries = array('b', [i % 4 for i in range(10)])
+	write_summary_tree(flat_tree, path)
+	mapped_tree = load_summary_tree(path)
+	assert list(mapped_tree.leaf_boundaries) == [i % 4 for i in range(10)]
+	assert mapped_tree.leaf_boundary(mapped_tree.find_leaf_summary(75)) == 3
+	assert flat_tree.leaf_boundary(flat_tree.find_leaf_summary(75)) == 3
+
+def test_reads_version_1(tmp_path, monkeypatch):
+	path = str(tmp_path / "book_summary.sumtree")
+	# write the layout of version 1, without the leaf_boundary section
+	monkeypatch.setattr(summary_tree_format, "SECTIONS", SECTIONS_V1)
+	monkeypatch.setattr(summary_tree_format, "SUMMARY_TREE_HEADER", struct.Struct("<8sIII" + "Q" * len(SECTIONS_V1)))
+	monkeypatch.setattr(summary_tree_format, "SUMMARY_TREE_VERSION", 1)
+	write_summary_tree(build_summary_tree(5), path)
+	monkeypatch.undo()
+
+	mapped_tree = load_summary_tree(path)
+	assert mapped_tree.leaf_boundaries is None
+	assert [mapped_tree.find_leaf_summary(i * 10).summary_content for i in range(5)] == [f"요약 {i}" for i in range(5)]
+
+def test_unsupported_version(tmp_path):
+	path = str(tmp_path / "book_summary.sumtree")
+	write_summary_tree(build_summary_tree(2), path)
+	with open(path, 'r+b') as tree_file:
+		header = list(SUMMARY_TREE_HEADER.unpack(tree_file.read(SUMMARY_TREE_HEADER.size)))
+		header[1] = 99
+		tree_file.seek(0)
+		tree_file.write(SUMMARY_TREE_HEADER.pack(*header))
+	with pytest.raises(UnsupportedSummaryTreeVersion):
+		MappedSummaryTree(path)
+
+def test_migrate_pickles(tmp_path):
+	user_dir = tmp_path / "user"
+	user_dir.mkdir()
+	pickle_url = str(user_dir / "book_summary.pkl")
+	summary_tree = build_summary_tree(7)
+	with open(pickle_url, 'wb') as pickle_file:
+		pickle.dump(summary_tree, pickle_file)
+
+	# not migrated yet: read from the pickle
+	assert not isinstance(load_summary_tree(pickle_url), MappedSummaryTree)
+
+	assert main(["migrate", str(tmp_path)]) == 0
+	assert os.path.exists(migrated_summary_tree_url(pickle_url))
+	migrated_tree = load_summary_tree(pickle_url)
+	assert isinstance(migrated_tree, MappedSummaryTree)
+	assert migrated_tree.find_leaf_summary(65).summary_content == "요약 6"